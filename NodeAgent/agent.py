@@ -7,12 +7,20 @@ import socket
 import select
 import errno
 import json
-from threading import Thread
+import inspect
+import threading
+from concurrent.futures import Future
 from app import task_handler
-from utils.receive_message import receive_message
+from utils.frame_reader import FrameReader
+from utils.write_buffer import WriteBuffer
 from utils.security import authenticate, SSL
-from utils.register_socket import register_socket, deregister_socket
-from utils.encode_message import encode_message
+from utils.register_socket import register_socket, deregister_socket, socket_tenant
+from utils.task_executor import TaskExecutor, TaskContext, run_task, resolve_destination, AGENT_EXECUTOR
+from utils.session_pool import shared_pool
+from utils.result_cache import ResultCache, cache_key
+from utils.metrics import metrics
+from utils.tracing import add_hop
+from utils.message_codec import encode_frame, decode_frame, handshake_offer, budget_deadline, request_key
 from utils.chalk import log
 from utils.resolve_env import \
     resolve_socket_server, resolve_socket_port, resolve_socket_header_length, \
@@ -24,6 +32,19 @@ HEADER_LENGTH = resolve_socket_header_length()
 IP = resolve_socket_server()
 PORT = resolve_socket_port()
 
+# Tags of the agent, e.g. "site:paris,role:edge", to be selected by batch requests
+AGENT_TAGS = [tag.strip() for tag in os.environ.get('AGENT_TAGS', '').split(',') if tag.strip()]
+
+# Metrics
+REQUESTS_RECEIVED = metrics.counter('agent_requests_total', 'Requests received by the agent, by how they were handled', ('outcome',))
+TASK_SECONDS = metrics.histogram('agent_task_seconds', 'Time from a request received by the agent to its result, queueing included', ('outcome',))
+
+# Task handlers declaring a "context" parameter get the TaskContext of the request, to stop once it is cancelled
+try:
+    ACCEPTS_CONTEXT = 'context' in inspect.signature(task_handler.handle_task).parameters
+except (TypeError, ValueError):
+    ACCEPTS_CONTEXT = False
+
 class Agent:
     # Constants
     HEADER_LENGTH = ''
@@ -31,12 +52,22 @@ class Agent:
     PORT = ''
     GLOBAL = {
         'token': '',
-        'socket_id': ''
+        'socket_id': '',
+        'tenant': None
     }
 
     # Variables
     client_socket = None
     client_readers = []
+    reader = None
+    writer = None
+    write_condition = None
+    wakeup_reader = None
+    wakeup_writer = None
+    executor = None
+    tasks = {}
+    codec = 'json'
+    compression = None
 
 
     def __init__(self, header_length: int, ip: str, port: int) -> None:
@@ -47,6 +78,23 @@ class Agent:
             self.HEADER_LENGTH = header_length
             self.IP = ip
             self.PORT = port
+            self.executor = TaskExecutor()
+            self.tasks = {} # (source socket ID, correlation id) -> TaskContext of the queued & running tasks
+            self.results = ResultCache()
+            metrics.gauge('agent_tasks', 'Tasks queued or running on the agent', function=lambda: len(self.executor))
+            metrics.gauge('agent_outbound_bytes', 'Bytes waiting to be written to the server', function=lambda: len(self.writer))
+            metrics.gauge('agent_result_cache', 'Entries, hits, misses & coalesced requests of the result cache', ('stat',), lambda: {(name,): value for name, value in self.results.stats().items()})
+
+            # Task worker processes have their own session pools, only the pool of the thread workers is visible here
+            if AGENT_EXECUTOR == 'thread':
+                metrics.gauge('agent_device_sessions', 'Devices, open & idle sessions, and sessions created, reused & discarded by the session pool', ('stat',), lambda: {(name,): value for name, value in shared_pool().stats().items()})
+
+            # Only the main loop writes to the socket, task workers queue their responses and wake it up
+            self.writer = WriteBuffer()
+            self.write_condition = threading.Condition()
+            self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+            self.wakeup_reader.setblocking(False)
+            self.wakeup_writer.setblocking(False)
 
             print_agent_info()
             self._handle_registration(token=self._handle_authentication())
@@ -97,6 +145,7 @@ class Agent:
             log(f'Socket: {response["message"]}', 'success')
             socket_id = response['data']['socket']['_id']
             self.GLOBAL['socket_id'] = socket_id
+            self.GLOBAL['tenant'] = socket_tenant(response)
 
             log(f'Socket: {socket_id}', 'notification')
             return socket_id
@@ -112,15 +161,12 @@ class Agent:
             log('Socket: Connecting...', 'warning')
 
             ssl_handler = SSL()
-            response = ssl_handler.create_context()
+            response = ssl_handler.ssl_connect((self.IP, self.PORT))
             if response['isError']:
                 log(f'Socket: {response["message"]}', 'danger')
-                self.cleanup()
-            context = response['context']
-            naked_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket = context.wrap_socket(naked_socket)
-            
-            client_socket.connect((self.IP, self.PORT))
+                time.sleep(4)
+                return False
+            client_socket = response['socket']
             client_socket.setblocking(False)
 
             response = ssl_handler.validate_cert(client_socket.getpeercert())
@@ -128,12 +174,24 @@ class Agent:
                 log(f'Socket: {response["message"]}', 'danger')
                 self.cleanup()
 
-            self.client_readers = [*resolve_client_readers(), client_socket]
+            self.client_readers = [*resolve_client_readers(), client_socket, self.wakeup_reader]
             self.client_socket = client_socket
+            self.reader = FrameReader(self.HEADER_LENGTH)
+
+            # Frames queued for the previous socket may have been partially written, start afresh
+            with self.write_condition:
+                self.writer = WriteBuffer()
+                self.write_condition.notify_all()
+            self.codec = 'json'
+            self.compression = None
             self.send_message({
                 'action': 'handshake',
                 'from': self.GLOBAL['socket_id'],
-                'to': 'server'
+                'to': 'server',
+                'type': 'agent',
+                'tenant': self.GLOBAL['tenant'],
+                'tags': AGENT_TAGS,
+                **handshake_offer()
             })
             
             log('Socket: Connected', 'success')
@@ -160,11 +218,14 @@ class Agent:
                 'token': self.GLOBAL['token'],
                 'data': {}
             })
+            self._drain(timeout=2)
 
         except Exception as ex:
             log(f'General error [4648] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
 
         finally:
+            if self.executor:
+                self.executor.shutdown()
             log(f'Socket: Cleanup complete [{os.path.basename(__file__)}]')
             sys.exit()
 
@@ -187,61 +248,269 @@ class Agent:
 
 
     def send_message(self, message) -> bool:
-        '''Send messages to sockets. If message doesnt't exist, False value will be returned.'''
+        '''Queue messages for the socket. If message doesnt't exist, False value will be returned.
+
+        The main loop writes the queue whenever the socket is writable. Task workers calling this function
+        wait while the queue is above its high watermark, so a slow server slows the tasks down instead of growing the queue.
+        '''
         # Make sure message exists
-        if message:
-            self.client_socket.send(encode_message(json.dumps(message) if type(message) == dict else message))
-            return True
-        return False
+        if not message:
+            return False
+
+        data = encode_frame(json.loads(message) if type(message) == str else message, self.codec, self.compression)
+        main_thread = threading.current_thread() is threading.main_thread()
+        with self.write_condition:
+            while not main_thread and self.writer.above_high_watermark():
+                self.write_condition.wait(1)
+            self.writer.append(data)
+
+        if main_thread:
+            self._flush()
+        else:
+            try:
+                self.wakeup_writer.send(b'\0')
+            except BlockingIOError: # a wake up is already pending
+                pass
+        return True
+
+
+    def _flush(self) -> None:
+        '''Write the queued frames until the socket would block. Only called by the main loop.'''
+        with self.write_condition:
+            self.writer.flush(self.client_socket)
+            if self.writer.below_low_watermark():
+                self.write_condition.notify_all()
+
+
+    def _drain(self, timeout: float) -> None:
+        '''Wait until the queued frames are written, or the timeout expires.'''
+        deadline = time.monotonic() + timeout
+        while self.writer and time.monotonic() < deadline:
+            select.select([], [self.client_socket], [], max(deadline - time.monotonic(), 0))
+            self._flush()
+
+
+    def _send_response(self, message: dict, response: dict) -> None:
+        '''Reply to the request message, by reversing the destination & source socket ID's.'''
+        destination = message['to']
+        source = message['from']
+
+        log(f'Socket: Sending message to: {source}, from: {destination}')
+        reply = {
+            'action': 'response',
+            'from': destination,
+            'to': source,
+            'token': message['token'],
+            'correlationId': message.get('correlationId'),
+            'data': response
+        }
+
+        # Traced requests get their trace back, with the hops of the agent
+        if message.get('trace'):
+            reply['trace'] = message['trace']
+        self.send_message(reply)
+
+
+    def _chunk_emitter(self, message: dict):
+        '''Send the chunks of output of a task to the requestor, numbered from 0. The final "response" ends the stream.
+        Sending waits while the socket is backed up, which slows the task down to the pace of the requestor.'''
+        sequence = iter(range(sys.maxsize))
+
+        def emit(chunk) -> None:
+            self.send_message({
+                'action': 'response-chunk',
+                'from': message['to'],
+                'to': message['from'],
+                'token': message['token'],
+                'correlationId': message.get('correlationId'),
+                'sequence': next(sequence),
+                'data': chunk
+            })
+        return emit
 
 
     def _handle_request(self, message: dict) -> None:
-        '''This function will be handled by threading, as it will allow for multiple messages to be processed simultaneously.'''
+        '''Queue the task on the executor, as it will allow for multiple messages to be processed simultaneously.
+        If the queue is full, the requestor gets a "busy" response straight away.'''
         try:
-            destination = message['to']
-            source = message['from']
-            token = message['token']
-            data = message['data']
-
-            log(f'Socket: Received message from socket: {source}', 'notification')
+            log(f'Socket: Received message from socket: {message["from"]}', 'notification')
+            if message.get('trace'):
+                message['trace'] = add_hop(message['trace'], 'agent.receive')
 
-            # Run the task
-            response = task_handler.handle_task(data)
-            log(f'Socket: Sending message to: {source}, from: {destination}')
-            self.send_message({
-                'action': 'response',
-                'from': destination,
-                'to': source,
-                'token': token,
-                'data': response
-            })
+            data = message['data']
+            correlation_id = message.get('correlationId')
+            task_key = request_key(message)
+            deadline = budget_deadline(message.get('budget'))
+            if deadline is not None and deadline <= time.monotonic():
+                REQUESTS_RECEIVED.inc(1, ('expired',))
+                self._send_response(message, {'isError': True, 'timeout': True, 'message': 'Deadline exceeded before the task started'})
+                return
+
+            # Identical requests share the cached result, or the execution in progress
+            execution = None
+            key = cache_key(message)
+            if key is not None:
+                response = self.results.join(key, message, deadline)
+                if 'result' in response:
+                    REQUESTS_RECEIVED.inc(1, ('cached',))
+                    log(f'Socket: Cached result for {correlation_id}', 'notification')
+                    self._send_response(message, response['result'])
+                    return
+                if response.get('coalesced'):
+                    REQUESTS_RECEIVED.inc(1, ('coalesced',))
+                    return
+                execution = response['execution']
+
+            # Output is streamed in "response-chunk" frames when the requestor asked for it, from threads only
+            emit = None
+            if message.get('stream') and self.executor.MODE != 'process':
+                emit = self._chunk_emitter(message)
+            context = TaskContext(correlation_id, deadline, emit, ACCEPTS_CONTEXT)
+            if execution is not None:
+                execution.context = context
+            if task_key:
+                self.tasks[task_key] = context
+
+            received = time.monotonic()
+            if not self.executor.submit(
+                resolve_destination(data), lambda future: self._handle_result(message, future, execution, received),
+                run_task, task_handler.handle_task, context, data, key=task_key
+            ):
+                REQUESTS_RECEIVED.inc(1, ('busy',))
+                self.tasks.pop(task_key, None)
+                log('Socket: Task queue is full, rejecting request', 'warning')
+                busy = {'isError': True, 'busy': True, 'message': 'Agent is busy, try again later'}
+                for member in self.results.complete(execution, busy) if execution else [message]:
+                    self._send_response(member, busy)
+                return
+            REQUESTS_RECEIVED.inc(1, ('run',))
 
         except Exception as ex:
             log(f'General error [3416] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
 
 
+    def _handle_cancel(self, message: dict) -> None:
+        '''The requestor stopped waiting: drop the task if it has not started yet, or else ask it to stop.'''
+        task_key = request_key(message)
+        if task_key is None:
+            return
+
+        # A shared execution is only cancelled once none of its requests awaits it
+        response = self.results.leave(task_key)
+        if not response['isError']:
+            if response['cancel'] is None:
+                return
+            task_key = response['cancel']
+
+        context = self.tasks.get(task_key)
+        if context is None:
+            return
+        context.cancel()
+        if self.executor.cancel(task_key):
+            log(f'Socket: Cancelled queued task {task_key[1]}', 'warning')
+        else:
+            log(f'Socket: Cancelling running task {task_key[1]}', 'warning')
+
+
+    def _handle_stats(self, message: dict) -> None:
+        '''Reply with the metrics of the agent: requests, task durations, queue depths and the result cache.'''
+        self.send_message({
+            'action': 'response',
+            'from': message['to'],
+            'to': message['from'],
+            'correlationId': message.get('correlationId'),
+            'data': {'isError': False, 'metrics': metrics.snapshot()}
+        })
+
+
+    def _handle_result(self, message: dict, future: Future, execution=None, received: float = None) -> None:
+        '''Send the result of the task back to the requestor, and to the requests that joined its execution,
+        unless the request was cancelled.'''
+        context = self.tasks.pop(request_key(message), None)
+        cancelled = future.cancelled() or (context is not None and context.cancelled.is_set())
+
+        response = None
+        if not cancelled:
+            try:
+                response = future.result()
+            except Exception as ex:
+                log(f'Task error [6107] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+                response = {'isError': True, 'message': 'Task failed'}
+
+        if received is not None:
+            outcome = 'cancelled' if cancelled else 'error' if not isinstance(response, dict) or response.get('isError') else 'ok'
+            TASK_SECONDS.observe(time.monotonic() - received, (outcome,))
+
+        members = self.results.complete(execution, response) if execution is not None else [message]
+        if cancelled:
+            return
+
+        for member in members:
+            try:
+                if member.get('trace'):
+                    if context is not None and context.started is not None:
+                        member['trace'] = add_hop(member['trace'], 'task.start', context.started)
+                    member['trace'] = add_hop(member['trace'], 'task.end')
+                self._send_response(member, response)
+
+            except Exception as ex:
+                log(f'General error [3417] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+
     def start(self) -> None:
         '''Receive messages. Loop until error.'''
         while True:
             try:
                 while True:
-                    readers, _, _ = select.select(self.client_readers, [], [], resolve_select_timeout()) # Both STDIN & client_socket have to be readable
-                    
+                    writers = [self.client_socket] if self.writer else [] # Only wait for writability while frames are queued
+                    readers, writers, _ = select.select(self.client_readers, writers, [], resolve_select_timeout()) # Both STDIN & client_socket have to be readable
+
+                    if writers:
+                        self._flush()
+
                     for reader in readers:
                         if reader is self.client_socket:
-                            message = receive_message(self.client_socket, self.HEADER_LENGTH)
+                            connected = self.reader.fill(self.client_socket)
+
+                            for frame in self.reader.frames():
+                                data = decode_frame(frame)
+
+                                # If the agent receives an informational message, log the message to the console
+                                if data['action'] == 'inform':
+                                    log(f'Server: {data["text"]}', data['level'])
+
+                                    # The handshake reply carries the negotiated codec & compression
+                                    if data.get('codec'):
+                                        self.codec, self.compression = data['codec'], data.get('compression')
+
+                                # If the agent received a request from a user. Handle multiple requests asynchronously
+                                if data['action'] == 'request':
+                                    self._handle_request(data)
+
+                                # The requestor stopped waiting for one of its requests
+                                if data['action'] == 'cancel':
+                                    self._handle_cancel(data)
+
+                                # A broker asked for the metrics of the agent
+                                if data['action'] == 'stats':
+                                    self._handle_stats(data)
+
+                                # Heartbeat of the server
+                                if data['action'] == 'ping':
+                                    self.send_message({'action': 'pong', 'from': self.GLOBAL['socket_id'], 'to': 'server'})
+
                             # Server closed down
-                            if message is False:
+                            if not connected:
                                 raise socket.error
-                            data = json.loads(message['payload'])
-
-                            # If the agent receives an informational message, log the message to the console
-                            if data['action'] == 'inform':
-                                log(f'Server: {data["text"]}', data['level'])
 
-                            # If the agent received a request from a user. Handle multiple requests asynchronously
-                            if data['action'] == 'request':
-                                Thread(target=self._handle_request, args=[data]).start()
+                        # A task worker queued a frame
+                        elif reader is self.wakeup_reader:
+                            try:
+                                while self.wakeup_reader.recv(4096):
+                                    pass
+                            except BlockingIOError:
+                                pass
+                            self._flush()
                         else:
                             sys.stdin.readline()
 
@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import asyncio
+from dotenv import load_dotenv
+from utils.async_broker import AsyncBrokerPool
+from utils.broker_pool import BROKER_BATCH_CONCURRENCY, BROKER_BATCH_MAX, REQUEST_SECONDS, outcome, request_timeout
+from utils.broker_registry import BrokerRegistry
+from utils.message_codec import MAX_FRAME_SIZE
+from utils.metrics import metrics
+from utils.tracing import start_trace, sampled, add_hop, breakdown, exporter
+from utils.chalk import log
+from utils.resolve_env import resolve_socket_server, resolve_socket_port, resolve_socket_header_length, resolve_flask_port
+
+load_dotenv()
+
+HEADER_LENGTH = resolve_socket_header_length()
+IP = resolve_socket_server()
+PORT = resolve_socket_port()
+BROKER_POOL_SIZE = int(os.environ.get('BROKER_POOL_SIZE', 4))
+BROKER_REQUEST_TIMEOUT = float(os.environ.get('BROKER_REQUEST_TIMEOUT', 120))
+
+# Event loop of the app, for the leases released by the background threads of the registry
+loop = None
+
+broker_pool = AsyncBrokerPool(BROKER_POOL_SIZE, HEADER_LENGTH, IP, PORT)
+
+
+def release_socket(socket_id: str) -> None:
+    if loop is not None:
+        asyncio.run_coroutine_threadsafe(broker_pool.release(socket_id), loop)
+
+
+broker_registry = BrokerRegistry(on_release=release_socket)
+
+
+async def app(scope: dict, receive, send) -> None:
+    '''ASGI entry point, the asyncio counterpart of the Flask app in "index.py". Serve it with any ASGI server:
+
+        uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+    Every request awaits its response on a pooled broker connection, instead of holding a thread,
+    so a single process keeps thousands of agent requests in flight.
+    '''
+    global loop
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    if loop is None:
+        loop = asyncio.get_running_loop()
+
+    if scope['path'] == '/metrics' and scope['method'] == 'GET':
+        await respond_text(send, metrics.render())
+        return
+
+    routes = {'/api/socket': api_socket, '/api/socket/batch': api_socket_batch}
+    if scope['path'] not in routes:
+        await respond(send, {'isError': True, 'message': 'Not found'}, 404)
+        return
+    if scope['method'] != 'POST':
+        await respond(send, {'isError': True, 'message': 'Method not allowed'}, 405)
+        return
+    await routes[scope['path']](scope, receive, send)
+
+
+async def lifespan(receive, send) -> None:
+    '''Startup & shutdown of the app: the broker socket ID's are deregistered on shutdown.'''
+    global loop
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            loop = asyncio.get_running_loop()
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            await loop.run_in_executor(None, broker_registry.close)
+            broker_pool.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def api_socket(scope: dict, receive, send) -> None:
+    '''Same route as "/api/socket" of "index.py":
+     - The socketId leased for the token is reused, the REST API is only called (in a thread) on a miss
+     - The message is sent to the agent over a pooled broker connection, and its response is awaited
+     - The client may ask for a shorter deadline with the "Request-Timeout" header
+     - Clients sending "Accept: application/x-ndjson" get the output of the task as it is produced
+     - The "Idempotency-Key" header lets retries share the result of the first attempt on the agent
+     - Clients sending "Trace: true" get the latency breakdown of the request in the "trace" field of the response
+    '''
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+    socket_id = None
+
+    try:
+        data = json.loads(await read_body(receive))
+
+        # The client may ask for a shorter deadline, within the limit of the broker
+        timeout = request_timeout(headers.get('request-timeout'), BROKER_REQUEST_TIMEOUT)
+        if timeout is None:
+            await respond(send, {'isError': True, 'message': 'Request-Timeout must be a positive number of seconds'}, 400)
+            return
+
+        token = headers['authorization'].replace('Bearer ', '')
+
+        # Get the socketId leased for the token
+        response = await acquire(token)
+        if response['isError']:
+            await respond(send, response)
+            return
+
+        # Append the socketId to the socket message
+        socket_id = data['from'] = response['socketId']
+
+        # Retries with the same key get the result of the first attempt from the agent
+        if headers.get('idempotency-key'):
+            data['idempotencyKey'] = headers['idempotency-key']
+
+        data.pop('trace', None)
+        if 'application/x-ndjson' in headers.get('accept', ''):
+            await stream(send, data, timeout)
+            return
+
+        traced = headers.get('trace', '').lower() in ('1', 'true', 'yes')
+        if traced or sampled():
+            data['trace'] = add_hop(start_trace(), 'broker.send')
+
+        started = time.monotonic()
+        response = await broker_pool.send_message(data, timeout)
+        REQUEST_SECONDS.observe(time.monotonic() - started, (outcome(response),))
+
+        # Requests that timed out only have the hops of the request
+        trace = None
+        if data.get('trace'):
+            trace = add_hop(response.pop('trace', None) or data['trace'], 'broker.receive')
+            exporter.export(trace, agent=data.get('to'), action=data.get('action'), outcome=outcome(response))
+        if traced and trace:
+            response['trace'] = breakdown(trace)
+        await respond(send, response, status_code(response))
+
+    except Exception as ex:
+        log(f'General error [6074] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+        await respond(send, {'isError': True})
+
+    finally:
+        if socket_id:
+            broker_registry.done(socket_id)
+
+
+async def api_socket_batch(scope: dict, receive, send) -> None:
+    '''Same route as "/api/socket/batch" of "index.py": the task is pushed to the agents listed in "to", or matching
+    the "selector", at most "concurrency" at a time, and one NDJSON line is written per agent as its response arrives.
+    '''
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+    socket_id = None
+    streaming = False
+
+    try:
+        data = json.loads(await read_body(receive))
+
+        # The client may ask for a shorter deadline, within the limit of the broker
+        timeout = request_timeout(headers.get('request-timeout'), BROKER_REQUEST_TIMEOUT)
+        if timeout is None:
+            await respond(send, {'isError': True, 'message': 'Request-Timeout must be a positive number of seconds'}, 400)
+            return
+
+        token = headers['authorization'].replace('Bearer ', '')
+
+        response = await acquire(token)
+        if response['isError']:
+            await respond(send, response)
+            return
+        socket_id = data['from'] = response['socketId']
+        tenant = response['tenant']
+
+        destinations = data.pop('to', None)
+        selector = data.pop('selector', None)
+        if selector is not None:
+            # Agents of the same organization only, a selector without a tenant would match every agent of the server
+            if tenant is None:
+                await respond(send, {'isError': True, 'message': 'The tenant of the token is unknown, list the agents in "to"'}, 400)
+                return
+            response = await broker_pool.select(data['from'], tenant, selector.get('tags', []), BROKER_REQUEST_TIMEOUT)
+            if response['isError']:
+                await respond(send, response)
+                return
+            destinations = response['sockets']
+
+        # Each agent gets the task once
+        if not isinstance(destinations, list) or not destinations:
+            await respond(send, {'isError': True, 'message': 'No destination agents'}, 400)
+            return
+        destinations = list(dict.fromkeys(destinations))
+        if len(destinations) > BROKER_BATCH_MAX:
+            await respond(send, {'isError': True, 'message': f'At most {BROKER_BATCH_MAX} destination agents per batch'}, 413)
+            return
+
+        concurrency = max(min(int(data.pop('concurrency', BROKER_BATCH_CONCURRENCY)), BROKER_BATCH_CONCURRENCY), 1)
+        streaming = True
+
+    except Exception as ex:
+        log(f'General error [4852] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+        await respond(send, {'isError': True})
+        return
+
+    finally:
+        # Once streaming, the lease is handed back at the end of the batch
+        if socket_id and not streaming:
+            broker_registry.done(socket_id)
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/x-ndjson')]})
+    responses = broker_pool.fan_out(data, destinations, concurrency, timeout)
+    failed = 0
+    try:
+        async for destination, response in responses:
+            if response.get('isError') or (isinstance(response.get('data'), dict) and response['data'].get('isError')):
+                failed += 1
+            line = {'agent': destination, 'response': response}
+            await send({'type': 'http.response.body', 'body': (json.dumps(line) + '\n').encode('utf-8'), 'more_body': True})
+        summary = {'isError': failed > 0, 'total': len(destinations), 'failed': failed}
+        await send({'type': 'http.response.body', 'body': (json.dumps(summary) + '\n').encode('utf-8')})
+
+    except Exception as ex:
+        log(f'General error [9561] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+    finally:
+        # Cancels the requests still running if the client went away before the end
+        await responses.aclose()
+        broker_registry.done(socket_id)
+
+
+async def acquire(token: str) -> dict:
+    '''The socketId leased for the token. The REST API is only called on a miss, in a thread.
+    The socketId is handed back with "broker_registry.done()" once the request is over.'''
+    response = broker_registry.leased(token)
+    if response is not None:
+        return response
+    return await loop.run_in_executor(None, broker_registry.acquire, token)
+
+
+def status_code(response: dict) -> int:
+    '''HTTP status of an agent response, as returned by "index.py".'''
+    data = response.get('data') if isinstance(response.get('data'), dict) else {}
+
+    # The agent did not answer in time, or the task missed its deadline on the agent
+    if response.get('timeout') or data.get('timeout'):
+        return 504
+
+    # The agent rejected the task as its queue is full, or is reconnecting to the server
+    if data.get('busy') or data.get('reconnecting'):
+        return 503
+    return 200
+
+
+async def read_body(receive) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_FRAME_SIZE:
+            raise ValueError('Request body too large')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def respond(send, response: dict, status: int = 200) -> None:
+    body = json.dumps(response).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def respond_text(send, text: str) -> None:
+    '''Metrics in the Prometheus text format.'''
+    body = text.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/plain; version=0.0.4'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def stream(send, message: dict, timeout: float) -> None:
+    '''Write one JSON line per chunk of output, then the final response. The status code is sent before the task ends,
+    errors are reported in the final line.'''
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/x-ndjson')]})
+    responses = broker_pool.stream_message(message, timeout)
+    try:
+        async for response in responses:
+            if response.get('action') == 'response-chunk':
+                line = {'sequence': response.get('sequence'), 'data': response.get('data')}
+            else:
+                line = response
+            await send({'type': 'http.response.body', 'body': (json.dumps(line) + '\n').encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    except Exception as ex:
+        log(f'General error [1937] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+    finally:
+        # Cancels the task on the agent if the client went away before the end
+        await responses.aclose()
+
+
+def main():
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=resolve_flask_port(), log_level='info' if os.environ.get('ENV') == 'dev' else 'warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+import os
+import time
+import uuid
+import zlib
+import asyncio
+from utils.frame_reader import FrameReader, RECV_SIZE
+from utils.broker_pool import BROKER_BATCH_CONCURRENCY
+from utils.security import SSL, get_context
+from utils.message_codec import encode_frame, decode_frame, handshake_offer, request_budget
+from utils.metrics import metrics
+from utils.chalk import log
+
+class AsyncBrokerConnection:
+    '''The asyncio counterpart of "BrokerConnection", used by the ASGI app.
+
+    A single stream to the socket server multiplexes every request of the event loop. Each request awaits a
+    future, or reads a queue when it is streamed, which the reader task resolves by "correlationId".
+    Writes await "drain()", so requests are held back while the server reads slower than they are sent.
+    '''
+    # Constants
+    HEADER_LENGTH = ''
+    IP = ''
+    PORT = ''
+
+    # Variables
+    socket_id = ''
+    connected = False
+    pending = {}
+    codec = 'json'
+    compression = None
+
+
+    def __init__(self, socket_id: str, header_length: int, ip: str, port: int) -> None:
+        self.socket_id = socket_id
+        self.HEADER_LENGTH = header_length
+        self.IP = ip
+        self.PORT = port
+        self.pending = {}
+        self.writer = None
+        self.reader_task = None
+        # Created on the event loop of the first request
+        self.connect_lock = None
+        self.drain_lock = None
+
+
+    async def connect(self) -> dict:
+        '''Connect and authenticate the broker connection with the socket server.'''
+        try:
+            reader, writer = await asyncio.open_connection(self.IP, self.PORT, ssl=get_context('client'))
+
+            response = SSL().validate_cert(writer.get_extra_info('peercert'))
+            if response['isError']:
+                writer.close()
+                return {'isError': True, 'message': response['message']}
+
+            # The server keeps persistent connections open after a response
+            self.codec = 'json'
+            self.compression = None
+            writer.write(encode_frame({
+                'action': 'handshake',
+                'from': self.socket_id,
+                'to': 'server',
+                'type': 'broker',
+                'persistent': True,
+                **handshake_offer()
+            }))
+
+            self.writer = writer
+            self.connected = True
+            self.reader_task = asyncio.ensure_future(self._read_loop(reader, writer))
+
+            log(f'Socket: Broker connection {self.socket_id} connected', 'success')
+            return {'isError': False}
+
+        except Exception as ex:
+            log(f'General error [5306] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            return {'isError': True, 'message': 'Failed to create socket'}
+
+
+    async def send_message(self, message: dict, expect_response: bool = True) -> asyncio.Future:
+        '''Send a request frame and return a future, resolved with the matching response.
+        Messages sent without "expect_response" resolve the future as soon as they are sent.'''
+        future = asyncio.get_running_loop().create_future()
+        response = await self._send(message, future if expect_response else None)
+        if response['isError'] or not expect_response:
+            future.set_result(response)
+        return future
+
+
+    async def stream_message(self, message: dict) -> asyncio.Queue:
+        '''Send a request frame and return a queue, fed with the "response-chunk" frames of the request
+        and then its final response. A failure is put in the queue as a message without an "action".'''
+        chunks = asyncio.Queue()
+        response = await self._send(message, chunks)
+        if response['isError']:
+            chunks.put_nowait(response)
+        return chunks
+
+
+    async def _send(self, message: dict, waiter) -> dict:
+        '''Write the frame, and register the future or queue waiting for its response.'''
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+            self.drain_lock = asyncio.Lock()
+
+        if not self.connected:
+            async with self.connect_lock:
+                if not self.connected:
+                    response = await self.connect()
+                    if response['isError']:
+                        return response
+
+        writer = self.writer
+        correlation_id = None
+        # The connection picks the correlation id: ids sent by the callers would collide between the
+        # socket IDs sharing the connection, and route one caller's response to another
+        if waiter is not None:
+            correlation_id = message['correlationId'] = uuid.uuid4().hex
+            self.pending[correlation_id] = waiter
+        try:
+            writer.write(encode_frame(message, self.codec, self.compression))
+
+            # Back-pressure: wait until the transport has written enough of the backlog
+            async with self.drain_lock:
+                await writer.drain()
+            return {'isError': False}
+
+        except Exception as ex:
+            log(f'General error [2649] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            self.pending.pop(correlation_id, None)
+            self._close(writer)
+            return {'isError': True, 'message': 'Broker socket error'}
+
+
+    def abandon(self, correlation_id: str) -> None:
+        '''Stop waiting for the response of a request, it will be dropped if it arrives.'''
+        self.pending.pop(correlation_id, None)
+
+
+    async def _read_loop(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Resolve the pending futures. Loop until the server closes the connection.'''
+        frames = FrameReader(self.HEADER_LENGTH)
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    log('Socket: Connection closed by the server', 'danger')
+                    break
+
+                frames.feed(data)
+                for frame in frames.frames():
+                    self._handle_message(decode_frame(frame))
+
+        except asyncio.CancelledError:
+            pass
+
+        except Exception as ex:
+            log(f'General error [7718] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+        finally:
+            self._close(writer)
+
+
+    def _handle_message(self, data: dict) -> None:
+        # If the broker receives an informational message, log the message to the console
+        if data['action'] == 'inform':
+            log(f'Server: {data["text"]}', data['level'])
+
+            # The handshake reply carries the negotiated codec & compression
+            if data.get('codec'):
+                self.codec, self.compression = data['codec'], data.get('compression')
+
+        # Heartbeat of the server
+        if data['action'] == 'ping':
+            self.writer.write(encode_frame({'action': 'pong', 'from': data['to'], 'to': 'server'}, self.codec, self.compression))
+
+        if data['action'] in ('response', 'response-chunk'):
+            final = data['action'] == 'response'
+            if final:
+                waiter = self.pending.pop(data.get('correlationId'), None)
+            else:
+                waiter = self.pending.get(data.get('correlationId'))
+            if waiter is None:
+                log(f'Socket: Dropping {data["action"]} with unknown correlation id: {data.get("correlationId")}', 'warning')
+                return
+
+            # Streamed requests get every chunk, the others only their final response
+            if isinstance(waiter, asyncio.Queue):
+                waiter.put_nowait(data)
+            elif final and not waiter.done():
+                waiter.set_result(data)
+
+
+    def _close(self, writer: asyncio.StreamWriter) -> None:
+        '''Fail every in-flight request of the connection, so that no caller waits forever.'''
+        if writer is not self.writer:
+            return
+        self.connected = False
+        self.writer = None
+        pending, self.pending = self.pending, {}
+        for waiter in pending.values():
+            if isinstance(waiter, asyncio.Queue):
+                waiter.put_nowait({'isError': True, 'message': 'Broker socket error'})
+            elif not waiter.done():
+                waiter.set_result({'isError': True, 'message': 'Broker socket error'})
+        writer.close()
+
+
+    def close(self) -> None:
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self._close(self.writer)
+
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+
+    def __repr__(self) -> str:
+        return f'AsyncBrokerConnection("{self.socket_id}", {self.HEADER_LENGTH}, "{self.IP}", {self.PORT})'
+
+
+class AsyncBrokerPool:
+    '''A fixed-size pool of asyncio broker connections, shared by every request of the ASGI app.'''
+    # Variables
+    connections = []
+
+
+    def __init__(self, size: int, header_length: int, ip: str, port: int) -> None:
+        self.connections = [
+            AsyncBrokerConnection(f'broker-{uuid.uuid4().hex}', header_length, ip, port) for _ in range(max(size, 1))
+        ]
+        metrics.gauge('broker_requests_pending', 'Requests sent by the broker and awaiting their response', function=lambda: sum(len(connection) for connection in self.connections))
+
+
+    def _connection(self, socket_id: str) -> AsyncBrokerConnection:
+        '''The server routes responses by broker socket ID, so an ID always uses the same connection.'''
+        return self.connections[zlib.crc32(socket_id.encode('utf-8')) % len(self.connections)]
+
+
+    async def send_message(self, message: dict, timeout: float = None) -> dict:
+        '''Send the message over the connection of its broker socket ID and await the matching response.
+
+        With a timeout, the request carries it as its time budget. Once it runs out, the request is cancelled on the agent
+        and an error with "timeout" is returned.
+        '''
+        connection = self._connection(message['from'])
+        if timeout is not None:
+            message['budget'] = request_budget(timeout)
+            deadline = time.monotonic() + timeout
+        future = await connection.send_message(message)
+        try:
+            return await asyncio.wait_for(future, None if timeout is None else max(deadline - time.monotonic(), 0))
+
+        except asyncio.TimeoutError:
+            await self._cancel(connection, message)
+            log(f'Socket: Request {message["correlationId"]} timed out after {timeout}s', 'warning')
+            return {'isError': True, 'timeout': True, 'message': 'Request timed out'}
+
+
+    async def stream_message(self, message: dict, timeout: float = None):
+        '''Send the message as a streamed request, and yield its "response-chunk" messages as they arrive,
+        then the final response. The last message yielded has no "response-chunk" action.
+
+        The timeout covers the whole stream. Once it passes, or if the caller stops iterating early,
+        the request is cancelled on the agent.
+        '''
+        connection = self._connection(message['from'])
+        message['stream'] = True
+        if timeout is not None:
+            message['budget'] = request_budget(timeout)
+            deadline = time.monotonic() + timeout
+        chunks = await connection.stream_message(message)
+        finished = False
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(chunks.get(), None if timeout is None else max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    log(f'Socket: Streamed request {message["correlationId"]} timed out after {timeout}s', 'warning')
+                    finished = True
+                    await self._cancel(connection, message)
+                    yield {'isError': True, 'timeout': True, 'message': 'Request timed out'}
+                    return
+
+                finished = data.get('action') != 'response-chunk'
+                yield data
+                if finished:
+                    return
+
+        finally:
+            if not finished:
+                await self._cancel(connection, message)
+
+
+    async def select(self, socket_id: str, tenant: str, tags: list, timeout: float = None) -> dict:
+        '''Ask the server for the socket ID's of the agents of the tenant having every tag.'''
+        connection = self._connection(socket_id)
+        message = {'action': 'select', 'from': socket_id, 'to': 'server', 'data': {'tenant': tenant, 'tags': tags}}
+        future = await connection.send_message(message)
+        try:
+            response = await asyncio.wait_for(future, timeout)
+            return response.get('data', response)
+
+        except asyncio.TimeoutError:
+            connection.abandon(message['correlationId'])
+            return {'isError': True, 'timeout': True, 'message': 'Selection timed out'}
+
+
+    async def fan_out(self, message: dict, destinations: list, concurrency: int = BROKER_BATCH_CONCURRENCY, timeout: float = None):
+        '''Send the message to every destination agent, and yield (destination, response) as the responses arrive.
+
+        Every request goes over the connection of the broker socket ID, at most "concurrency" at a time, and the
+        server forwards each of them as soon as it arrives. The timeout covers the whole batch: once it passes,
+        the requests still running are cancelled and the ones not sent yet are not sent at all.
+        '''
+        connection = self._connection(message['from'])
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        waiting = iter(destinations)
+        running = {} # future -> request
+        try:
+            while True:
+                while len(running) < concurrency:
+                    destination = next(waiting, None)
+                    if destination is None:
+                        break
+                    request = {**message, 'to': destination}
+                    request.pop('correlationId', None)
+                    if timeout is not None:
+                        request['budget'] = request_budget(deadline - time.monotonic())
+                    running[await connection.send_message(request)] = request
+                if not running:
+                    return
+
+                done, _ = await asyncio.wait(
+                    list(running), timeout=None if timeout is None else max(deadline - time.monotonic(), 0),
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                for future in done:
+                    yield running.pop(future)['to'], future.result()
+
+            log(f'Socket: Batch timed out after {timeout}s, {len(running)} requests cancelled', 'warning')
+            timed_out = [request['to'] for request in running.values()] + list(waiting)
+            for request in running.values():
+                await self._cancel(connection, request)
+            running = {}
+            for destination in timed_out:
+                yield destination, {'isError': True, 'timeout': True, 'message': 'Request timed out'}
+
+        finally:
+            # The caller stopped early
+            for request in running.values():
+                await self._cancel(connection, request)
+
+
+    async def _cancel(self, connection: AsyncBrokerConnection, message: dict) -> None:
+        '''Stop waiting for the response of the request, and tell the agent to drop it.'''
+        correlation_id = message.get('correlationId')
+        if correlation_id is None:
+            return
+        connection.abandon(correlation_id)
+        await connection.send_message(
+            {'action': 'cancel', 'from': message['from'], 'to': message['to'], 'correlationId': correlation_id},
+            expect_response=False
+        )
+
+
+    async def stats(self, socket_id: str, destination: str = 'server', timeout: float = None) -> dict:
+        '''Ask the server (or an agent, by its socket ID) for its metrics.'''
+        return await self.send_message({'action': 'stats', 'from': socket_id, 'to': destination}, timeout)
+
+
+    async def release(self, socket_id: str) -> None:
+        '''Tell the server to forget the route of a broker socket ID that will not be used anymore.'''
+        connection = self._connection(socket_id)
+        if connection.connected:
+            await connection.send_message({'action': 'deregister', 'from': socket_id, 'to': 'server'}, expect_response=False)
+
+
+    def close(self) -> None:
+        for connection in self.connections:
+            connection.close()
+
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+
+    def __repr__(self) -> str:
+        return f'AsyncBrokerPool({len(self.connections)})'
+
+
+    def __str__(self) -> str:
+        return 'Pool of persistent asyncio broker connections to the socket server'
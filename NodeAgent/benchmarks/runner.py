@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+
+# Constants
+BENCHMARK_SAMPLES = int(os.environ.get('BENCHMARK_SAMPLES', 15))
+BENCHMARK_SAMPLE_TIME = float(os.environ.get('BENCHMARK_SAMPLE_TIME', 0.05))
+BENCHMARK_THRESHOLD = float(os.environ.get('BENCHMARK_THRESHOLD', 0.25))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+class Benchmark:
+    '''A function timed in a loop. "setup" runs once before the samples and returns the arguments of the function,
+    "teardown" gets them back once the samples are taken.'''
+    # Variables
+    name = ''
+
+
+    def __init__(self, name: str, function, setup=None, teardown=None) -> None:
+        self.name = name
+        self.function = function
+        self.setup = setup
+        self.teardown = teardown
+
+
+    def _sample(self, arguments: tuple, loops: int) -> float:
+        function = self.function
+        start = time.perf_counter()
+        for _ in range(loops):
+            function(*arguments)
+        return time.perf_counter() - start
+
+
+    def run(self, samples: int = BENCHMARK_SAMPLES, sample_time: float = BENCHMARK_SAMPLE_TIME) -> dict:
+        '''Time the function, pyperf style: calibrate the number of loops so a sample lasts "sample_time" seconds,
+        warm up once, then take "samples" samples. Times are in seconds per call.'''
+        arguments = self.setup() if self.setup else ()
+        try:
+            loops = 1
+            while True:
+                elapsed = self._sample(arguments, loops)
+                if elapsed >= sample_time or loops >= 1 << 24:
+                    break
+                loops *= 2 if elapsed == 0 else max(min(int(sample_time / elapsed * 1.2), 10), 2)
+
+            self._sample(arguments, loops)
+            timings = [self._sample(arguments, loops) / loops for _ in range(samples)]
+
+        finally:
+            if self.teardown:
+                self.teardown(*arguments)
+
+        return {
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings),
+            'stdev': statistics.stdev(timings) if len(timings) > 1 else 0,
+            'min': min(timings),
+            'loops': loops,
+            'samples': samples
+        }
+
+
+    def __repr__(self) -> str:
+        return f'Benchmark("{self.name}")'
+
+
+def run_benchmarks(benchmarks: list, pattern: str = None, samples: int = BENCHMARK_SAMPLES, sample_time: float = BENCHMARK_SAMPLE_TIME) -> dict:
+    results = {}
+    for benchmark in benchmarks:
+        if pattern and pattern not in benchmark.name:
+            continue
+        results[benchmark.name] = benchmark.run(samples, sample_time)
+        print(f'{benchmark.name:<45} {format_time(results[benchmark.name]["median"]):>10} +- {format_time(results[benchmark.name]["stdev"])}', flush=True)
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'benchmarks': results
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float = BENCHMARK_THRESHOLD) -> list:
+    '''Benchmarks whose median is more than "threshold" (0.25: 25%) slower than in the baseline.
+    Benchmarks missing from either side are skipped.'''
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        reference = baseline.get('benchmarks', {}).get(name)
+        if not reference or not reference['median']:
+            continue
+        ratio = result['median'] / reference['median']
+        status = 'slower' if ratio > 1 + threshold else 'faster' if ratio < 1 / (1 + threshold) else 'same'
+        print(f'{name:<45} {format_time(reference["median"]):>10} -> {format_time(result["median"]):>10} {ratio:6.2f}x {status}')
+        if status == 'slower':
+            regressions.append({'name': name, 'baseline': reference['median'], 'median': result['median'], 'ratio': ratio})
+    return regressions
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def main() -> None:
+    '''Run the suite, write the results as JSON, and compare them with the baseline:
+
+        python3 -m benchmarks.runner --save-baseline     # on the reference commit
+        python3 -m benchmarks.runner                     # exits with 1 if a benchmark regressed
+
+    Baselines only compare runs on the same machine & Python, they are not meant to be committed.
+    '''
+    parser = argparse.ArgumentParser(description='Micro benchmarks of the framing, codec, TLS & routing hot paths')
+    parser.add_argument('pattern', nargs='?', help='only run the benchmarks whose name contains the pattern')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='JSON results to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=BENCHMARK_THRESHOLD, help='slowdown failing the run, 0.25 for 25%%')
+    parser.add_argument('--samples', type=int, default=BENCHMARK_SAMPLES)
+    parser.add_argument('--sample-time', type=float, default=BENCHMARK_SAMPLE_TIME)
+    args = parser.parse_args()
+
+    from benchmarks.suite import BENCHMARKS
+    results = run_benchmarks(BENCHMARKS, args.pattern, args.samples, args.sample_time)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline first')
+        return
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    print()
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f'{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
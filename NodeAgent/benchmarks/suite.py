@@ -0,0 +1,165 @@
+import ssl
+import json
+import socket
+import uuid
+from threading import Thread, Semaphore
+from types import SimpleNamespace
+from benchmarks.runner import Benchmark
+from utils.encode_message import encode_message
+from utils.receive_message import receive_message
+from utils.message_codec import encode_frame, decode_frame
+from utils.frame_reader import FrameReader
+from utils.security import SSL, CERT_FILES, get_context, _build_context
+from utils.cache import Cache
+
+# Constants
+HEADER_LENGTH = 10
+PAYLOAD_SIZES = {'small': 0, '64kb': 64 * 1024, '1mb': 1024 * 1024, '4mb': 4 * 1024 * 1024}
+REGISTRY_SIZE = 10000
+
+def task_message(size: int) -> dict:
+    '''A request as sent by the broker, with a device configuration of about "size" bytes.'''
+    line = 'interface GigabitEthernet0/1\n description uplink\n ip address 10.0.0.1 255.255.255.0\n!\n'
+    return {
+        'action': 'request',
+        'from': uuid.uuid4().hex,
+        'to': uuid.uuid4().hex,
+        'token': 'x' * 200,
+        'correlationId': uuid.uuid4().hex,
+        'data': {
+            'host': '10.0.0.1',
+            'vendor': 'cisco_ios',
+            'commands': ['show version', 'show running-config'],
+            'config': line * (size // len(line))
+        }
+    }
+
+
+def socket_pair(tls: bool) -> tuple:
+    '''Connected (sender, receiver) sockets, wrapped with the bundled certificates when "tls" is set.'''
+    sender, receiver = socket.socketpair()
+    if not tls:
+        return sender, receiver
+
+    receiver = get_context('server').wrap_socket(receiver, server_side=True, do_handshake_on_connect=False)
+    handshake = Thread(target=receiver.do_handshake)
+    handshake.start()
+    sender = get_context('client').wrap_socket(sender)
+    handshake.join()
+    return sender, receiver
+
+
+class Sender:
+    '''Sends the frame once per "release()", from its own thread, as frames larger than the socket buffers
+    cannot be sent before they are received.'''
+    def __init__(self, client_socket, data: bytes) -> None:
+        self.client_socket = client_socket
+        self.data = data
+        self.trigger = Semaphore(0)
+        self.stopped = False
+        self.thread = Thread(target=self._send, daemon=True)
+        self.thread.start()
+
+
+    def _send(self) -> None:
+        while True:
+            self.trigger.acquire()
+            if self.stopped:
+                return
+            self.client_socket.sendall(self.data)
+
+
+    def release(self) -> None:
+        self.trigger.release()
+
+
+    def close(self) -> None:
+        self.stopped = True
+        self.trigger.release()
+        self.thread.join()
+        self.client_socket.close()
+
+
+def send_receive(sender: Sender, receiver) -> None:
+    sender.release()
+    if not receive_message(receiver, HEADER_LENGTH):
+        raise RuntimeError('Nothing received')
+
+
+def receive_benchmark(name: str, size: int, tls: bool) -> Benchmark:
+    def setup() -> tuple:
+        sender, receiver = socket_pair(tls)
+        return Sender(sender, encode_message(json.dumps(task_message(size)), HEADER_LENGTH)), receiver
+
+    def teardown(sender: Sender, receiver) -> None:
+        sender.close()
+        receiver.close()
+    return Benchmark(name, send_receive, setup, teardown)
+
+
+def read_frame(reader: FrameReader, data: bytes) -> None:
+    reader.feed(data)
+    for frame in reader.frames():
+        decode_frame(frame)
+
+
+def route_frame(reader: FrameReader, cache: Cache, data: bytes) -> None:
+    '''The path of a request through the relay: parse the header of the frame, then look its destination up.'''
+    reader.feed(data)
+    for frame in reader.frames():
+        if cache.get_socket(frame.route['to'])['isError']:
+            raise RuntimeError('Destination not found')
+
+
+def registry() -> Cache:
+    '''A socket registry holding REGISTRY_SIZE agents, without snapshots.'''
+    cache = Cache('')
+    for index in range(REGISTRY_SIZE):
+        connection = SimpleNamespace(client_address=('10.0.0.1', 1024 + index), client_socket=SimpleNamespace(fileno=lambda: -1))
+        cache.save_socket(f'{index:032x}', connection, 'agent', 'tenant', ('site:paris',))
+    return cache
+
+
+def peer_cert() -> dict:
+    '''The decoded client certificate, as returned by "getpeercert()" on the server.'''
+    return ssl._ssl._test_decode_cert(CERT_FILES['client'][1])
+
+
+def _benchmarks() -> list:
+    benchmarks = []
+
+    # Legacy framing
+    for label in ('small', '64kb'):
+        message = json.dumps(task_message(PAYLOAD_SIZES[label]))
+        benchmarks.append(Benchmark(f'encode_message[{label}]', encode_message, lambda message=message: (message, HEADER_LENGTH)))
+    for label in ('small', '64kb', '1mb'):
+        for tls in (False, True):
+            benchmarks.append(receive_benchmark(f'receive_message[{label}{",tls" if tls else ""}]', PAYLOAD_SIZES[label], tls))
+
+    # Payload codec, from a small request to a multi-MB configuration
+    for label, size in PAYLOAD_SIZES.items():
+        message = task_message(size)
+        encoded = json.dumps(message)
+        benchmarks.append(Benchmark(f'json_dumps[{label}]', json.dumps, lambda message=message: (message,)))
+        benchmarks.append(Benchmark(f'json_loads[{label}]', json.loads, lambda encoded=encoded: (encoded,)))
+        benchmarks.append(Benchmark(f'encode_frame[{label}]', encode_frame, lambda message=message: (message,)))
+        benchmarks.append(Benchmark(f'encode_frame[{label},zlib]', encode_frame, lambda message=message: (message, 'json', 'zlib')))
+        benchmarks.append(Benchmark(f'read_frame[{label}]', read_frame, lambda message=message: (FrameReader(HEADER_LENGTH), encode_frame(message))))
+
+    # TLS
+    benchmarks.append(Benchmark('SSL.create_context', lambda handler: handler.create_context(), lambda: (SSL(),)))
+    benchmarks.append(Benchmark('ssl_build_context[server]', _build_context, lambda: ('server',)))
+    benchmarks.append(Benchmark('SSL.validate_cert', lambda handler, cert: handler.validate_cert(cert), lambda: (SSL(), peer_cert())))
+
+    # Routing on the relay
+    def route_setup() -> tuple:
+        cache = registry()
+        message = task_message(PAYLOAD_SIZES['small'])
+        message['to'] = f'{REGISTRY_SIZE // 2:032x}'
+        return FrameReader(HEADER_LENGTH), cache, encode_frame(message)
+    benchmarks.append(Benchmark(f'cache_get_socket[{REGISTRY_SIZE}]', lambda cache, socket_id: cache.get_socket(socket_id), lambda: (registry(), f'{REGISTRY_SIZE // 2:032x}')))
+    benchmarks.append(Benchmark(f'route_frame[{REGISTRY_SIZE}]', route_frame, route_setup))
+    return benchmarks
+
+
+BENCHMARKS = _benchmarks()
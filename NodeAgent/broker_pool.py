@@ -0,0 +1,456 @@
+import os
+import socket
+import select
+import uuid
+import zlib
+import math
+import time
+import queue
+from threading import Thread, Condition
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
+from utils.frame_reader import FrameReader
+from utils.write_buffer import WriteBuffer
+from utils.security import SSL
+from utils.message_codec import encode_frame, decode_frame, handshake_offer, request_budget
+from utils.metrics import metrics
+from utils.chalk import log
+
+# Constants
+BROKER_BATCH_CONCURRENCY = int(os.environ.get('BROKER_BATCH_CONCURRENCY', 64))
+BROKER_BATCH_MAX = int(os.environ.get('BROKER_BATCH_MAX', 10000))
+
+# Metrics
+REQUEST_SECONDS = metrics.histogram('broker_request_seconds', 'Time from a request sent by the broker to its response', ('outcome',))
+
+def outcome(response: dict) -> str:
+    '''Label of an agent response in the metrics: "ok", "error", "timeout" or "busy".'''
+    data = response.get('data') if isinstance(response.get('data'), dict) else {}
+    if response.get('timeout') or data.get('timeout'):
+        return 'timeout'
+    if data.get('busy') or data.get('reconnecting'):
+        return 'busy'
+    return 'error' if response.get('isError') or data.get('isError') else 'ok'
+
+
+def request_timeout(header: str, limit: float) -> float:
+    '''Seconds asked for by the "Request-Timeout" header, clamped to (0, limit]: the limit without the header.
+    None when the header is not a positive number of seconds.'''
+    if header is None:
+        return limit
+    try:
+        timeout = float(header)
+    except ValueError:
+        return None
+    if not math.isfinite(timeout) or timeout <= 0:
+        return None
+    return min(timeout, limit)
+
+
+class BrokerConnection:
+    '''A long-lived broker connection to the socket server.
+
+    The connection performs a single TLS handshake and a single "handshake" message, and then
+    multiplexes many requests over the same socket. Every request carries a "correlationId",
+    which the agent echoes back in its response, so the I/O thread can resolve the matching future.
+
+    Only the I/O thread of the connection touches the socket. Request threads queue their frames in
+    the write buffer and wake it up, and wait while the buffer is above its high watermark.
+    '''
+    # Constants
+    HEADER_LENGTH = ''
+    IP = ''
+    PORT = ''
+
+    # Variables
+    socket_id = ''
+    client_socket = None
+    connected = False
+    pending = {}
+    codec = 'json'
+    compression = None
+
+
+    def __init__(self, socket_id: str, header_length: int, ip: str, port: int) -> None:
+        self.socket_id = socket_id
+        self.HEADER_LENGTH = header_length
+        self.IP = ip
+        self.PORT = port
+        self.pending = {}
+        self.condition = Condition()
+        self.writer = WriteBuffer()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+
+    def connect(self) -> dict:
+        '''Connect and authenticate the broker connection with the socket server.'''
+        try:
+            ssl_handler = SSL()
+            response = ssl_handler.ssl_connect((self.IP, self.PORT))
+            if response['isError']:
+                return {'isError': True, 'message': response['message']}
+            client_socket = response['socket']
+
+            response = ssl_handler.validate_cert(client_socket.getpeercert())
+            if response['isError']:
+                client_socket.close()
+                return {'isError': True, 'message': response['message']}
+            client_socket.setblocking(False)
+
+            # The server keeps persistent connections open after a response
+            self.codec = 'json'
+            self.compression = None
+            self.writer = WriteBuffer()
+            self.writer.append(encode_frame({
+                'action': 'handshake',
+                'from': self.socket_id,
+                'to': 'server',
+                'type': 'broker',
+                'persistent': True,
+                **handshake_offer()
+            }))
+
+            self.client_socket = client_socket
+            self.connected = True
+            Thread(target=self._io_loop, args=[client_socket], daemon=True).start()
+
+            log(f'Socket: Broker connection {self.socket_id} connected', 'success')
+            return {'isError': False}
+
+        except Exception as ex:
+            log(f'General error [6231] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            return {'isError': True, 'message': 'Failed to create socket'}
+
+
+    def send_message(self, message: dict, expect_response: bool = True) -> Future:
+        '''Enqueue a request frame and return a future, resolved with the matching response.
+        Messages sent without "expect_response" resolve the future as soon as they are queued.'''
+        future = Future()
+        response = self._enqueue(message, future if expect_response else None)
+        if response['isError'] or not expect_response:
+            future.set_result(response)
+        return future
+
+
+    def stream_message(self, message: dict) -> queue.Queue:
+        '''Enqueue a request frame and return a queue, fed with the "response-chunk" frames of the request
+        and then its final response. A failure is put in the queue as a message without an "action".'''
+        chunks = queue.Queue()
+        response = self._enqueue(message, chunks)
+        if response['isError']:
+            chunks.put(response)
+        return chunks
+
+
+    def _enqueue(self, message: dict, waiter) -> dict:
+        '''Queue the frame for the I/O thread, and register the future or queue waiting for its response.'''
+        with self.condition:
+            if not self.connected:
+                response = self.connect()
+                if response['isError']:
+                    return {'isError': True, 'message': response['message']}
+
+            # Back-pressure: wait until the I/O thread has written enough of the backlog
+            while self.connected and self.writer.above_high_watermark():
+                self.condition.wait(1)
+            if not self.connected:
+                return {'isError': True, 'message': 'Broker socket error'}
+
+            # The connection picks the correlation id: ids sent by the callers would collide between the
+            # socket IDs sharing the connection, and route one caller's response to another
+            if waiter is not None:
+                message['correlationId'] = uuid.uuid4().hex
+                self.pending[message['correlationId']] = waiter
+            self.writer.append(encode_frame(message, self.codec, self.compression))
+
+        self._wake_up()
+        return {'isError': False}
+
+
+    def abandon(self, correlation_id: str) -> None:
+        '''Stop waiting for the response of a request, it will be dropped if it arrives.'''
+        with self.condition:
+            self.pending.pop(correlation_id, None)
+
+
+    def _wake_up(self) -> None:
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError: # a wake up is already pending
+            pass
+
+
+    def _io_loop(self, client_socket: socket.socket) -> None:
+        '''Write the queued frames and resolve the pending futures. Loop until the server closes the connection.'''
+        reader = FrameReader(self.HEADER_LENGTH)
+        try:
+            while True:
+                writers = [client_socket] if self.writer else []
+                readers, _, _ = select.select([client_socket, self.wakeup_reader], writers, [], 1)
+
+                if self.wakeup_reader in readers:
+                    try:
+                        while self.wakeup_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+
+                with self.condition:
+                    self.writer.flush(client_socket)
+                    if self.writer.below_low_watermark():
+                        self.condition.notify_all()
+
+                if client_socket in readers:
+                    connected = reader.fill(client_socket)
+                    for frame in reader.frames():
+                        self._handle_message(decode_frame(frame))
+
+                    if not connected:
+                        log('Socket: Connection closed by the server', 'danger')
+                        break
+
+        except Exception as ex:
+            log(f'General error [8105] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+        finally:
+            self._close(client_socket)
+
+
+    def _handle_message(self, data: dict) -> None:
+        # If the broker receives an informational message, log the message to the console
+        if data['action'] == 'inform':
+            log(f'Server: {data["text"]}', data['level'])
+
+            # The handshake reply carries the negotiated codec & compression
+            if data.get('codec'):
+                self.codec, self.compression = data['codec'], data.get('compression')
+
+        # Heartbeat of the server, the pong is written on the next turn of the I/O loop
+        if data['action'] == 'ping':
+            with self.condition:
+                self.writer.append(encode_frame({'action': 'pong', 'from': data['to'], 'to': 'server'}, self.codec, self.compression))
+
+        if data['action'] in ('response', 'response-chunk'):
+            final = data['action'] == 'response'
+            with self.condition:
+                if final:
+                    waiter = self.pending.pop(data.get('correlationId'), None)
+                else:
+                    waiter = self.pending.get(data.get('correlationId'))
+            if waiter is None:
+                log(f'Socket: Dropping {data["action"]} with unknown correlation id: {data.get("correlationId")}', 'warning')
+                return
+
+            # Streamed requests get every chunk, the others only their final response
+            if isinstance(waiter, queue.Queue):
+                waiter.put(data)
+            elif final:
+                waiter.set_result(data)
+
+
+    def _close(self, client_socket: socket.socket) -> None:
+        '''Fail every in-flight request of the connection, so that no caller waits forever.'''
+        with self.condition:
+            if client_socket is not self.client_socket:
+                return
+            self.connected = False
+            self.client_socket = None
+            self.writer.clear()
+            pending, self.pending = self.pending, {}
+            self.condition.notify_all()
+        for waiter in pending.values():
+            if isinstance(waiter, queue.Queue):
+                waiter.put({'isError': True, 'message': 'Broker socket error'})
+            else:
+                waiter.set_result({'isError': True, 'message': 'Broker socket error'})
+        try:
+            client_socket.close()
+        except Exception:
+            pass
+
+
+    def close(self) -> None:
+        if self.client_socket:
+            self._close(self.client_socket)
+
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+
+    def __repr__(self) -> str:
+        return f'BrokerConnection("{self.socket_id}", {self.HEADER_LENGTH}, "{self.IP}", {self.PORT})'
+
+
+class BrokerPool:
+    '''A fixed-size pool of broker connections, shared by every request thread of the Flask app.'''
+    # Variables
+    connections = []
+
+
+    def __init__(self, size: int, header_length: int, ip: str, port: int) -> None:
+        self.connections = [
+            BrokerConnection(f'broker-{uuid.uuid4().hex}', header_length, ip, port) for _ in range(max(size, 1))
+        ]
+        metrics.gauge('broker_requests_pending', 'Requests sent by the broker and awaiting their response', function=lambda: sum(len(connection) for connection in self.connections))
+
+
+    def _connection(self, socket_id: str) -> BrokerConnection:
+        '''The server routes responses by broker socket ID, so an ID always uses the same connection.'''
+        return self.connections[zlib.crc32(socket_id.encode('utf-8')) % len(self.connections)]
+
+
+    def send_message(self, message: dict, timeout: float = None) -> dict:
+        '''Send the message over the connection of its broker socket ID and wait for the matching response.
+
+        With a timeout, the request carries it as its time budget. Once it runs out, the request is cancelled on the agent
+        and an error with "timeout" is returned.
+        '''
+        connection = self._connection(message['from'])
+        if timeout is not None:
+            message['budget'] = request_budget(timeout)
+        future = connection.send_message(message)
+        try:
+            return future.result(timeout)
+
+        except FutureTimeoutError:
+            self._cancel(connection, message)
+            log(f'Socket: Request {message["correlationId"]} timed out after {timeout}s', 'warning')
+            return {'isError': True, 'timeout': True, 'message': 'Request timed out'}
+
+
+    def stream_message(self, message: dict, timeout: float = None):
+        '''Send the message as a streamed request, and yield its "response-chunk" messages as they arrive,
+        then the final response. The last message yielded has no "response-chunk" action.
+
+        The timeout covers the whole stream. Once it passes, or if the caller stops iterating early,
+        the request is cancelled on the agent.
+        '''
+        connection = self._connection(message['from'])
+        message['stream'] = True
+        if timeout is not None:
+            message['budget'] = request_budget(timeout)
+            deadline = time.monotonic() + timeout
+        chunks = connection.stream_message(message)
+        finished = False
+        try:
+            while True:
+                try:
+                    data = chunks.get(timeout=None if timeout is None else max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    log(f'Socket: Streamed request {message["correlationId"]} timed out after {timeout}s', 'warning')
+                    finished = True
+                    self._cancel(connection, message)
+                    yield {'isError': True, 'timeout': True, 'message': 'Request timed out'}
+                    return
+
+                finished = data.get('action') != 'response-chunk'
+                yield data
+                if finished:
+                    return
+
+        finally:
+            if not finished:
+                self._cancel(connection, message)
+
+
+    def select(self, socket_id: str, tenant: str, tags: list, timeout: float = None) -> dict:
+        '''Ask the server for the socket ID's of the agents of the tenant having every tag.'''
+        connection = self._connection(socket_id)
+        message = {'action': 'select', 'from': socket_id, 'to': 'server', 'data': {'tenant': tenant, 'tags': tags}}
+        future = connection.send_message(message)
+        try:
+            response = future.result(timeout)
+            return response.get('data', response)
+
+        except FutureTimeoutError:
+            connection.abandon(message['correlationId'])
+            return {'isError': True, 'timeout': True, 'message': 'Selection timed out'}
+
+
+    def fan_out(self, message: dict, destinations: list, concurrency: int = BROKER_BATCH_CONCURRENCY, timeout: float = None):
+        '''Send the message to every destination agent, and yield (destination, response) as the responses arrive.
+
+        Every request goes over the connection of the broker socket ID, at most "concurrency" at a time, and the
+        server forwards each of them as soon as it arrives. The timeout covers the whole batch: once it passes,
+        the requests still running are cancelled and the ones not sent yet are not sent at all.
+        '''
+        connection = self._connection(message['from'])
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        waiting = iter(destinations)
+        running = {} # future -> request
+        try:
+            while True:
+                while len(running) < concurrency:
+                    destination = next(waiting, None)
+                    if destination is None:
+                        break
+                    request = {**message, 'to': destination}
+                    request.pop('correlationId', None)
+                    if timeout is not None:
+                        request['budget'] = request_budget(deadline - time.monotonic())
+                    running[connection.send_message(request)] = request
+                if not running:
+                    return
+
+                done, _ = wait(list(running), None if timeout is None else max(deadline - time.monotonic(), 0), FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    yield running.pop(future)['to'], future.result()
+
+            log(f'Socket: Batch timed out after {timeout}s, {len(running)} requests cancelled', 'warning')
+            timed_out = [request['to'] for request in running.values()] + list(waiting)
+            for request in running.values():
+                self._cancel(connection, request)
+            running = {}
+            for destination in timed_out:
+                yield destination, {'isError': True, 'timeout': True, 'message': 'Request timed out'}
+
+        finally:
+            # The caller stopped early
+            for request in running.values():
+                self._cancel(connection, request)
+
+
+    def _cancel(self, connection: BrokerConnection, message: dict) -> None:
+        '''Stop waiting for the response of the request, and tell the agent to drop it.'''
+        correlation_id = message.get('correlationId')
+        if correlation_id is None:
+            return
+        connection.abandon(correlation_id)
+        connection.send_message(
+            {'action': 'cancel', 'from': message['from'], 'to': message['to'], 'correlationId': correlation_id},
+            expect_response=False
+        )
+
+
+    def stats(self, socket_id: str, destination: str = 'server', timeout: float = None) -> dict:
+        '''Ask the server (or an agent, by its socket ID) for its metrics.'''
+        return self.send_message({'action': 'stats', 'from': socket_id, 'to': destination}, timeout)
+
+
+    def release(self, socket_id: str) -> None:
+        '''Tell the server to forget the route of a broker socket ID that will not be used anymore.'''
+        connection = self._connection(socket_id)
+        if connection.connected:
+            connection.send_message({'action': 'deregister', 'from': socket_id, 'to': 'server'}, expect_response=False)
+
+
+    def close(self) -> None:
+        for connection in self.connections:
+            connection.close()
+
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+
+    def __repr__(self) -> str:
+        return f'BrokerPool({len(self.connections)})'
+
+
+    def __str__(self) -> str:
+        return 'Pool of persistent broker connections to the socket server'
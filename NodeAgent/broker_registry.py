@@ -0,0 +1,196 @@
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock, Thread, Timer
+from utils.register_socket import register_socket, deregister_socket, socket_tenant
+from utils.metrics import metrics
+from utils.chalk import log
+
+# Constants
+BROKER_REGISTRY_SIZE = int(os.environ.get('BROKER_REGISTRY_SIZE', 256))
+BROKER_LEASE_TTL = float(os.environ.get('BROKER_LEASE_TTL', 3600))
+BROKER_LEASE_GRACE = float(os.environ.get('BROKER_LEASE_GRACE', os.environ.get('BROKER_REQUEST_TIMEOUT', 120)))
+
+# Metrics
+LEASES = metrics.counter('broker_lease_lookups_total', 'Lookups of the broker socket ID of a token, "hit" or "miss"', ('result',))
+REGISTRATION_SECONDS = metrics.histogram('broker_registration_seconds', 'Time to register a broker socket ID with the REST API')
+
+class BrokerRegistry:
+    '''Leases of broker socket IDs, one per token, reused across requests.
+
+    The first request of a token registers a broker socket with the REST API, the following ones reuse it
+    until the lease expires ("ttl" seconds). At most "size" leases are kept, the least recently used one is
+    released first. Released leases are deregistered in the background, so the request path only ever waits
+    for the REST API on a miss.
+
+    Every socket ID returned by "leased()" or "acquire()" is handed back with "done()" once its request is over.
+    A lease which expires, is evicted or invalidated while requests still use it is retired: it is only released
+    once the last of them is done, or after "grace" seconds, so their responses still find the socket on the server.
+    '''
+    # Constants
+    SIZE = 0
+    TTL = 0
+    GRACE = 0
+
+    # Variables
+    leases = None
+
+
+    def __init__(self, size: int = BROKER_REGISTRY_SIZE, ttl: float = BROKER_LEASE_TTL, on_release=None, grace: float = BROKER_LEASE_GRACE) -> None:
+        self.SIZE = max(size, 1)
+        self.TTL = ttl
+        self.GRACE = grace
+        self.on_release = on_release # called with the socket ID of every released lease
+        self.lock = Lock()
+        self.leases = OrderedDict() # token -> (socket ID, expiry, tenant)
+        self.pending = {}           # token -> future of the registration in progress
+        self.users = {}             # socket ID -> number of requests using it
+        self.retired = {}           # socket ID -> token, of the leases released once their requests are done
+
+
+    def leased(self, token: str) -> dict:
+        '''Return the lease of the token as "acquire()" does, or None. Never waits for the REST API.'''
+        with self.lock:
+            lease = self.leases.get(token)
+            if lease and lease[1] > time.monotonic():
+                self.leases.move_to_end(token)
+                self.users[lease[0]] = self.users.get(lease[0], 0) + 1
+                return {'isError': False, 'socketId': lease[0], 'tenant': lease[2]}
+        return None
+
+
+    def acquire(self, token: str) -> dict:
+        '''Return the broker socket ID leased for the token, registering a new one if needed.
+        The "tenant" of the lease is the one the agents of the same account announce, see "socket_tenant()".'''
+        with self.lock:
+            lease = self.leases.get(token)
+            if lease and lease[1] > time.monotonic():
+                self.leases.move_to_end(token)
+                self.users[lease[0]] = self.users.get(lease[0], 0) + 1
+                LEASES.inc(1, ('hit',))
+                return {'isError': False, 'socketId': lease[0], 'tenant': lease[2]}
+            LEASES.inc(1, ('miss',))
+
+            # Only one registration per token, concurrent requests wait for it
+            future = self.pending.get(token)
+            owner = future is None
+            if owner:
+                future = self.pending[token] = Future()
+            expired = self.leases.pop(token, None) if owner else None
+
+        if not owner:
+            result = future.result()
+            if not result['isError']:
+                with self.lock:
+                    self.users[result['socketId']] = self.users.get(result['socketId'], 0) + 1
+            return result
+
+        if expired:
+            self._retire(token, expired[0])
+
+        try:
+            with REGISTRATION_SECONDS.time():
+                response = register_socket(token, socket_type='broker')
+            if response['isError']:
+                result = response
+            else:
+                result = {'isError': False, 'socketId': response['data']['socket']['_id'], 'tenant': socket_tenant(response)}
+
+        except Exception as ex:
+            log(f'General error [6550] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            result = {'isError': True, 'message': 'Failed to register the socket'}
+
+        evicted = []
+        with self.lock:
+            del self.pending[token]
+            if not result['isError']:
+                self.leases[token] = (result['socketId'], time.monotonic() + self.TTL, result['tenant'])
+                self.users[result['socketId']] = self.users.get(result['socketId'], 0) + 1
+                while len(self.leases) > self.SIZE:
+                    evicted.append(self.leases.popitem(last=False))
+        future.set_result(result)
+
+        for evicted_token, (socket_id, _, _) in evicted:
+            self._retire(evicted_token, socket_id)
+        return result
+
+
+    def done(self, socket_id: str) -> None:
+        '''A request using the socket ID is over. The last one releases the lease, if it was retired meanwhile.'''
+        with self.lock:
+            users = self.users.get(socket_id, 0) - 1
+            if users > 0:
+                self.users[socket_id] = users
+                return
+            self.users.pop(socket_id, None)
+            token = self.retired.pop(socket_id, None)
+        if token is not None:
+            self._release(token, socket_id)
+
+
+    def invalidate(self, token: str) -> None:
+        '''Forget the lease of the token, the next request registers a new one.'''
+        with self.lock:
+            lease = self.leases.pop(token, None)
+        if lease:
+            self._retire(token, lease[0])
+
+
+    def _retire(self, token: str, socket_id: str) -> None:
+        '''Release the lease once the requests using it are done, at most "grace" seconds from now.'''
+        with self.lock:
+            if self.users.get(socket_id):
+                self.retired[socket_id] = token
+                timer = Timer(self.GRACE, self._expire, args=[socket_id])
+                timer.daemon = True
+                timer.start()
+                return
+        self._release(token, socket_id)
+
+
+    def _expire(self, socket_id: str) -> None:
+        with self.lock:
+            token = self.retired.pop(socket_id, None)
+            if token is not None:
+                self.users.pop(socket_id, None)
+        if token is not None:
+            log(f'Broker socket {socket_id} released with requests still running', 'warning')
+            self._release(token, socket_id)
+
+
+    def _release(self, token: str, socket_id: str) -> None:
+        Thread(target=self._deregister, args=[token, socket_id], daemon=True).start()
+
+
+    def _deregister(self, token: str, socket_id: str) -> None:
+        try:
+            if self.on_release:
+                self.on_release(socket_id)
+            deregister_socket(token, socket_id)
+
+        except Exception as ex:
+            log(f'General error [3862] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+
+    def close(self) -> None:
+        '''Deregister every lease, on shutdown.'''
+        with self.lock:
+            leases, self.leases = self.leases, OrderedDict()
+            retired, self.retired = self.retired, {}
+        for token, (socket_id, _, _) in leases.items():
+            deregister_socket(token, socket_id)
+        for socket_id, token in retired.items():
+            deregister_socket(token, socket_id)
+
+
+    def __len__(self) -> int:
+        return len(self.leases)
+
+
+    def __repr__(self) -> str:
+        return f'BrokerRegistry({self.SIZE}, {self.TTL})'
+
+
+    def __str__(self) -> str:
+        return 'Leases of broker socket IDs, per token'
@@ -1,93 +1,241 @@
 import os
-import sqlite3
-import socket
-from utils.security import SSL
+import json
+import time
+from threading import Thread, Event
 from utils.chalk import log
 
-db_path = os.path.dirname(os.path.abspath(__file__)) + '/socket_mapping.db'
+# Constants
+SOCKET_REGISTRY_SNAPSHOT = os.environ.get('SOCKET_REGISTRY_SNAPSHOT', '')
+SOCKET_REGISTRY_SNAPSHOT_INTERVAL = float(os.environ.get('SOCKET_REGISTRY_SNAPSHOT_INTERVAL', 5))
+SOCKET_REGISTRY_KNOWN_TTL = float(os.environ.get('SOCKET_REGISTRY_KNOWN_TTL', 3600))
+
+class ConnectionRecord:
+    '''Routing metadata of a socket ID. "connection" is the server connection the socket ID is routed to.'''
+    __slots__ = ('socket_id', 'connection', 'fd', 'peer', 'socket_type', 'tenant', 'tags', 'last_seen', 'in_flight')
+
+
+    def __init__(self, socket_id: str, connection, fd: int, peer: str, socket_type: str, tenant: str, tags: tuple = ()) -> None:
+        self.socket_id = socket_id
+        self.connection = connection
+        self.fd = fd
+        self.peer = peer
+        self.socket_type = socket_type
+        self.tenant = tenant
+        self.tags = tags
+        self.last_seen = time.time()
+        self.in_flight = 0
+
+
+    def to_dict(self) -> dict:
+        '''The metadata kept in snapshots, everything but the live connection.'''
+        return {
+            'socketId': self.socket_id,
+            'fd': self.fd,
+            'peer': self.peer,
+            'type': self.socket_type,
+            'tenant': self.tenant,
+            'tags': list(self.tags),
+            'lastSeen': self.last_seen,
+            'inFlight': self.in_flight
+        }
+
+
+    def __repr__(self) -> str:
+        return f'ConnectionRecord("{self.socket_id}", "{self.socket_type}", "{self.peer}")'
+
 
 class Cache:
-    conn = None
-    cursor = None
+    '''In-memory registry of the socket ID's routed by the server.
 
+    Records are indexed by socket ID, and by tenant, socket type & tag, every lookup is O(1).
+    The registry is owned by the event loop of the server, and is not thread safe, apart from the snapshots.
 
-    def create_db(self) -> dict:
-        try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-
-            self.conn = conn
-            self.cursor = cursor
-            
-            cursor.execute('''CREATE TABLE sockets (
-                id text,
-                fd integer
-            )''')
-            conn.commit()
-            return {'isError': False}
+    When a snapshot path is set (SOCKET_REGISTRY_SNAPSHOT), the metadata of the records is written behind
+    every SOCKET_REGISTRY_SNAPSHOT_INTERVAL seconds, in a background thread. After a restart, the previous
+    snapshot tells which socket ID's are expected to reconnect ("known").
+    '''
+    # Constants
+    SNAPSHOT_PATH = ''
 
-        except Exception as ex:
-            log(f'General error [842] [{os.path.basename(__file__)}]: {str(ex)}', level='warning')
-            return {'isError': True, 'message': 'Failed to create database'}
+    # Variables
+    records = {}
+    known = {}
+
+
+    def __init__(self, snapshot_path: str = SOCKET_REGISTRY_SNAPSHOT) -> None:
+        self.SNAPSHOT_PATH = snapshot_path
+        self.records = {}    # socket ID -> ConnectionRecord
+        self.by_tenant = {}  # tenant -> {socket ID's}
+        self.by_type = {}    # socket type -> {socket ID's}
+        self.by_tag = {}     # tag -> {socket ID's}
+        self.known = {}      # socket ID -> metadata of the previous snapshot, until the socket ID reconnects
+        self.dirty = False
+        self.stopped = Event()
 
 
-    def save_socket(self, id: str, client_socket: socket.socket) -> dict:
+    def _index(self, index: dict, key: str, socket_id: str) -> None:
+        if key:
+            index.setdefault(key, set()).add(socket_id)
+
+
+    def _unindex(self, index: dict, key: str, socket_id: str) -> None:
+        socket_ids = index.get(key)
+        if socket_ids:
+            socket_ids.discard(socket_id)
+            if not socket_ids:
+                del index[key]
+
+
+    def save_socket(self, socket_id: str, connection, socket_type: str = None, tenant: str = None, tags: tuple = ()) -> dict:
+        '''Route the socket ID to the connection, replacing its previous route.'''
         try:
-            self.cursor.execute(f"INSERT INTO sockets VALUES ('{id}', {client_socket.fileno()})")
-            self.conn.commit()
-            return {'isError': False}
+            tags = tuple(tags)
+            record = self.records.get(socket_id)
+            if record is not None:
+                if record.connection is connection and record.socket_type == socket_type and record.tenant == tenant and record.tags == tags:
+                    record.last_seen = time.time()
+                    return {'isError': False, 'record': record}
+                self.remove_socket(socket_id)
+
+            peer = connection.client_address
+            record = ConnectionRecord(
+                socket_id, connection, connection.client_socket.fileno(), f'{peer[0]}:{peer[1]}', socket_type, tenant, tags
+            )
+            self.records[socket_id] = record
+            self._index(self.by_tenant, tenant, socket_id)
+            self._index(self.by_type, socket_type, socket_id)
+            for tag in tags:
+                self._index(self.by_tag, tag, socket_id)
+            self.known.pop(socket_id, None)
+            self.dirty = True
+            return {'isError': False, 'record': record}
 
         except Exception as ex:
             log(f'General error [1316] [{os.path.basename(__file__)}]: {str(ex)}', level='danger')
             return {'isError': True, 'message': 'Failed to save to cache'}
 
 
-    def get_socket(self, id: str) -> dict:
-        try:
-            self.cursor.execute(f"SELECT * FROM sockets WHERE id='{id}'")
-            data = self.cursor.fetchone()
-            if data == None:
-                return {'isError': True, 'message': 'Item does not exist'}
-            self.conn.commit()
+    def get_socket(self, socket_id: str) -> dict:
+        record = self.records.get(socket_id)
+        if record is None:
+            return {'isError': True, 'message': 'Item does not exist', 'known': socket_id in self.known}
+        return {'isError': False, 'socket': record.connection, 'record': record}
 
-            fd = int(data[1])
 
-            # Recreate socket + wrap with SSL
-            naked_socket = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
-            ssl_handler = SSL()
-            # client_socket = ssl_handler.create_context()['context'].wrap_socket(naked_socket)
-            client_socket = ssl_handler.ssl_wrap_socket(naked_socket)['socket']
-            return {'isError': False, 'socket': client_socket}
+    def remove_socket(self, socket_id: str, connection=None) -> dict:
+        '''Forget the route of the socket ID. With a connection, only if the socket ID is still routed to it.'''
+        record = self.records.get(socket_id)
+        if record is None or (connection is not None and record.connection is not connection):
+            return {'isError': True, 'message': 'Item does not exist'}
 
-        except Exception as ex:
-            log(f'General error [1695] [{os.path.basename(__file__)}]: {str(ex)}', level='danger')
-            return {'isError': True, 'message': 'Failed to fetch from cache'}
+        del self.records[socket_id]
+        self._unindex(self.by_tenant, record.tenant, socket_id)
+        self._unindex(self.by_type, record.socket_type, socket_id)
+        for tag in record.tags:
+            self._unindex(self.by_tag, tag, socket_id)
+        self.dirty = True
+        return {'isError': False, 'record': record}
+
+
+    def touch(self, socket_id: str) -> None:
+        record = self.records.get(socket_id)
+        if record is not None:
+            record.last_seen = time.time()
 
 
-    def remove_socket(self, id: str) -> dict:
+    def begin_request(self, socket_id: str) -> None:
+        '''A request was forwarded to the socket ID.'''
+        record = self.records.get(socket_id)
+        if record is not None:
+            record.in_flight += 1
+
+
+    def end_request(self, socket_id: str) -> None:
+        '''The socket ID answered one of its requests.'''
+        record = self.records.get(socket_id)
+        if record is not None and record.in_flight:
+            record.in_flight -= 1
+
+
+    def find(self, tenant: str = None, socket_type: str = None, tags: list = None) -> list:
+        '''Socket ID's of the tenant and/or socket type, with every one of the tags.'''
+        matches = []
+        if tenant is not None:
+            matches.append(self.by_tenant.get(tenant, set()))
+        if socket_type is not None:
+            matches.append(self.by_type.get(socket_type, set()))
+        for tag in tags or ():
+            matches.append(self.by_tag.get(tag, set()))
+        if not matches:
+            return list(self.records)
+        return list(set.intersection(*sorted(matches, key=len)))
+
+
+    def load_snapshot(self) -> dict:
+        '''Load the metadata written before the last shutdown, for a warm restart.'''
+        if not self.SNAPSHOT_PATH or not os.path.exists(self.SNAPSHOT_PATH):
+            return {'isError': False, 'count': 0}
         try:
-            self.cursor.execute(f"DELETE * FROM sockets WHERE id='{id}'")
-            self.conn.commit()
-            return {'isError': False}
+            with open(self.SNAPSHOT_PATH, 'r') as snapshot:
+                records = json.load(snapshot)['records']
+            # Socket ID's not seen for a while are not coming back
+            expiry = time.time() - SOCKET_REGISTRY_KNOWN_TTL
+            self.known = {
+                record['socketId']: record for record in records
+                if record['lastSeen'] > expiry and record['socketId'] not in self.records
+            }
+            log(f'Registry: Loaded {len(self.known)} socket ID\'s from the snapshot', 'notification')
+            return {'isError': False, 'count': len(self.known)}
 
         except Exception as ex:
-            log(f'General error [3031] [{os.path.basename(__file__)}]: {str(ex)}', level='danger')
-            return {'isError': True, 'message': 'Failed to remove from cache'}
+            log(f'General error [5304] [{os.path.basename(__file__)}]: {str(ex)}', level='warning')
+            return {'isError': True, 'message': 'Failed to load the snapshot'}
 
 
-    def close_db(self) -> dict:
+    def write_snapshot(self) -> dict:
+        '''Write the metadata of every record, atomically.'''
         try:
-            self.conn.close()
+            self.dirty = False
+            records = [record.to_dict() for record in list(self.records.values())]
+            records += list(self.known.values())
+
+            temporary_path = f'{self.SNAPSHOT_PATH}.tmp'
+            with open(temporary_path, 'w') as snapshot:
+                json.dump({'time': time.time(), 'records': records}, snapshot)
+            os.replace(temporary_path, self.SNAPSHOT_PATH)
             return {'isError': False}
 
         except Exception as ex:
-            log(f'General error [4317] [{os.path.basename(__file__)}]: {str(ex)}', level='danger')
-            return {'isError': True, 'message': 'Failed to close database'}
+            log(f'General error [3031] [{os.path.basename(__file__)}]: {str(ex)}', level='danger')
+            return {'isError': True, 'message': 'Failed to write the snapshot'}
+
+
+    def _write_behind(self) -> None:
+        while not self.stopped.wait(SOCKET_REGISTRY_SNAPSHOT_INTERVAL):
+            if self.dirty:
+                self.write_snapshot()
+
+
+    def start_snapshots(self) -> None:
+        '''Write the snapshot in the background, whenever the registry changed.'''
+        if self.SNAPSHOT_PATH:
+            Thread(target=self._write_behind, daemon=True).start()
+
+
+    def close(self) -> dict:
+        self.stopped.set()
+        if self.SNAPSHOT_PATH:
+            return self.write_snapshot()
+        return {'isError': False}
+
+
+    def __len__(self) -> int:
+        return len(self.records)
 
 
     def __repr__(self) -> str:
-        return 'Cache()'
+        return f'Cache("{self.SNAPSHOT_PATH}")'
 
 
     def __str__(self) -> str:
-        return 'Database handler for SQLite3 operations'
+        return 'In-memory registry of the routed socket ID\'s'
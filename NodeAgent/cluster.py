@@ -0,0 +1,204 @@
+import os
+import time
+import uuid
+import queue
+import sqlite3
+from threading import Thread, Event
+from utils.chalk import log
+
+# Constants
+CLUSTER_DIRECTORY = os.environ.get('CLUSTER_DIRECTORY', '')
+CLUSTER_NODE_ID = os.environ.get('CLUSTER_NODE_ID', '') or uuid.uuid4().hex
+CLUSTER_ADVERTISE_HOST = os.environ.get('CLUSTER_ADVERTISE_HOST', '127.0.0.1')
+CLUSTER_HEARTBEAT = float(os.environ.get('CLUSTER_HEARTBEAT', 2))
+CLUSTER_NODE_TTL = float(os.environ.get('CLUSTER_NODE_TTL', 10))
+CLUSTER_LOOKUP_TTL = float(os.environ.get('CLUSTER_LOOKUP_TTL', 2))
+CLUSTER_MISS_TTL = float(os.environ.get('CLUSTER_MISS_TTL', 0.5))
+CLUSTER_LINK_RETRY = float(os.environ.get('CLUSTER_LINK_RETRY', 2))
+
+class Directory:
+    '''Routing directory shared by the relay nodes of a cluster, stored in a SQLite file.
+
+    Every node publishes the agent socket ID's attached to it, and a heartbeat. A node looks up the owner of a
+    socket ID it does not hold itself, and forwards the frame to that node over an inter-node link.
+    Nodes without a heartbeat for "CLUSTER_NODE_TTL" seconds are ignored, their socket ID's are stale.
+    Lookups are cached for "CLUSTER_LOOKUP_TTL" seconds, and failed ones for "CLUSTER_MISS_TTL" seconds, so the event
+    loop rarely touches the file. Nodes the link to failed are skipped for "CLUSTER_LINK_RETRY" seconds.
+    Published & withdrawn socket ID's are written by a background thread, along with the heartbeats.
+    '''
+    # Constants
+    PATH = ''
+    NODE_ID = ''
+    HOST = ''
+    PORT = 0
+
+    # Variables
+    conn = None
+
+
+    def __init__(self, path: str, node_id: str, host: str, port: int) -> None:
+        self.PATH = path
+        self.NODE_ID = node_id
+        self.HOST = host
+        self.PORT = port
+        self.lookups = {} # socket ID -> (node ID, host, port, expiry)
+        self.misses = {}  # socket ID -> expiry of its failed lookup
+        self.down = {}    # node ID -> time.monotonic() the link to it may be retried at
+        self.changes = queue.SimpleQueue() # ('publish' | 'withdraw', socket ID), for the background thread
+        self.writer = None
+        self.stopped = Event()
+        self.conn = self._connect()
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS nodes (
+                node_id TEXT PRIMARY KEY,
+                host TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                heartbeat REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS owners (
+                socket_id TEXT PRIMARY KEY,
+                node_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS owners_node_id ON owners (node_id);
+        ''')
+
+        # Forget the socket ID's of a previous run of the node
+        with self.conn:
+            self.conn.execute('DELETE FROM owners WHERE node_id = ?', (node_id,))
+        self._heartbeat(self.conn)
+
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.PATH, timeout=1, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+
+    def _heartbeat(self, conn: sqlite3.Connection) -> None:
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO nodes (node_id, host, port, heartbeat) VALUES (?, ?, ?, ?)',
+                (self.NODE_ID, self.HOST, self.PORT, time.time())
+            )
+
+
+    def _apply(self, conn: sqlite3.Connection, changes: list) -> None:
+        '''Write the published & withdrawn socket ID's in one transaction, in the order they happened.'''
+        with conn:
+            for action, socket_id in changes:
+                if action == 'publish':
+                    conn.execute('INSERT OR REPLACE INTO owners (socket_id, node_id) VALUES (?, ?)', (socket_id, self.NODE_ID))
+                else:
+                    conn.execute('DELETE FROM owners WHERE socket_id = ? AND node_id = ?', (socket_id, self.NODE_ID))
+
+
+    def _writes(self) -> None:
+        '''Background thread: the heartbeats, and the changes queued by the event loop.'''
+        conn = self._connect()
+        next_heartbeat = time.monotonic() + CLUSTER_HEARTBEAT
+        while not self.stopped.is_set():
+            changes = []
+            try:
+                change = self.changes.get(timeout=max(next_heartbeat - time.monotonic(), 0))
+                while change is not None:
+                    changes.append(change)
+                    change = self.changes.get_nowait()
+            except queue.Empty:
+                pass
+
+            try:
+                if changes:
+                    self._apply(conn, changes)
+                if time.monotonic() >= next_heartbeat:
+                    self._heartbeat(conn)
+                    next_heartbeat = time.monotonic() + CLUSTER_HEARTBEAT
+
+            except Exception as ex:
+                log(f'General error [7290] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+        conn.close()
+
+
+    def start(self) -> None:
+        self.writer = Thread(target=self._writes, daemon=True)
+        self.writer.start()
+        log(f'Cluster: Node {self.NODE_ID} joined the directory {self.PATH}', 'notification')
+
+
+    def publish(self, socket_id: str) -> dict:
+        '''Announce that the socket ID is attached to this node, without waiting for the write.'''
+        self.changes.put(('publish', socket_id))
+        return {'isError': False}
+
+
+    def withdraw(self, socket_id: str) -> dict:
+        '''The socket ID left this node, without waiting for the write. Nothing happens if another node owns it by now.'''
+        self.changes.put(('withdraw', socket_id))
+        return {'isError': False}
+
+
+    def lookup(self, socket_id: str) -> dict:
+        '''Find the live node owning the socket ID, other than this one.'''
+        now = time.monotonic()
+        cached = self.lookups.get(socket_id)
+        if cached and cached[3] > now:
+            return {'isError': False, 'nodeId': cached[0], 'host': cached[1], 'port': cached[2]}
+        if self.misses.get(socket_id, 0) > now:
+            return {'isError': True, 'message': 'Socket is not attached to any node'}
+
+        try:
+            row = self.conn.execute(
+                '''SELECT nodes.node_id, nodes.host, nodes.port FROM owners
+                JOIN nodes ON nodes.node_id = owners.node_id
+                WHERE owners.socket_id = ? AND nodes.node_id != ? AND nodes.heartbeat > ?''',
+                (socket_id, self.NODE_ID, time.time() - CLUSTER_NODE_TTL)
+            ).fetchone()
+            if row is None or self.down.get(row[0], 0) > now:
+                self.lookups.pop(socket_id, None)
+                if len(self.misses) > 65536:
+                    self.misses.clear()
+                self.misses[socket_id] = now + CLUSTER_MISS_TTL
+                return {'isError': True, 'message': 'Socket is not attached to any node'}
+
+            self.misses.pop(socket_id, None)
+            if len(self.lookups) > 65536:
+                self.lookups.clear()
+            self.lookups[socket_id] = (*row, now + CLUSTER_LOOKUP_TTL)
+            return {'isError': False, 'nodeId': row[0], 'host': row[1], 'port': row[2]}
+
+        except Exception as ex:
+            log(f'General error [3558] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            return {'isError': True, 'message': 'Failed to look up the socket'}
+
+
+    def forget(self, node_id: str, failed: bool = False) -> None:
+        '''Drop the cached lookups pointing to a node, when the link to it closed. A link that "failed" before it
+        was established is not opened again for "CLUSTER_LINK_RETRY" seconds.'''
+        if failed:
+            self.down[node_id] = time.monotonic() + CLUSTER_LINK_RETRY
+        for socket_id in [socket_id for socket_id, cached in self.lookups.items() if cached[0] == node_id]:
+            del self.lookups[socket_id]
+
+
+    def close(self) -> None:
+        '''Leave the cluster: withdraw every socket ID of the node.'''
+        self.stopped.set()
+        self.changes.put(None)
+        if self.writer is not None:
+            self.writer.join(CLUSTER_HEARTBEAT)
+        try:
+            with self.conn:
+                self.conn.execute('DELETE FROM owners WHERE node_id = ?', (self.NODE_ID,))
+                self.conn.execute('DELETE FROM nodes WHERE node_id = ?', (self.NODE_ID,))
+            self.conn.close()
+
+        except Exception as ex:
+            log(f'General error [6129] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+
+    def __repr__(self) -> str:
+        return f'Directory("{self.PATH}", "{self.NODE_ID}", "{self.HOST}", {self.PORT})'
+
+
+    def __str__(self) -> str:
+        return 'Routing directory shared by the relay nodes of a cluster'
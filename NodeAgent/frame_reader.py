@@ -0,0 +1,210 @@
+import os
+import ssl
+from utils.message_codec import \
+    MAGIC, VERSION, HEADER, HEADER_SIZE, ROUTE_LENGTH, FLAG_ROUTED, MAX_FRAME_SIZE, ALLOW_LEGACY_FRAMING, \
+    encode_route, decode_route
+
+# Constants
+RECV_SIZE = 65536
+SOCKET_READ_BUDGET = int(os.environ.get('SOCKET_READ_BUDGET', 256 * 1024))
+
+class Frame:
+    '''A received frame. "payload" and "raw" (header included) are memoryview slices of the reader buffer.
+    "route" holds the routing fields of the header, or None when the frame carries none.'''
+    __slots__ = ('binary', 'flags', 'codec', 'route', 'payload', 'raw')
+
+
+    def __init__(self, binary: bool, flags: int, codec: int, route: dict, payload: memoryview, raw: memoryview) -> None:
+        self.binary = binary
+        self.flags = flags
+        self.codec = codec
+        self.route = route
+        self.payload = payload
+        self.raw = raw
+
+
+    def detach(self):
+        '''A copy of the frame that stays valid once the reader buffer is reused, for frames kept in a queue.'''
+        raw = memoryview(bytes(self.raw))
+        return Frame(self.binary, self.flags, self.codec, self.route, raw[len(raw) - len(self.payload):], raw)
+
+
+    def reroute(self, route: dict):
+        '''A copy of the frame with other routing fields, and the same payload. Only for binary frames with a route.'''
+        encoded = encode_route(route)
+        raw = memoryview(b''.join((
+            HEADER.pack(MAGIC, VERSION, self.flags, self.codec, len(self.payload)), ROUTE_LENGTH.pack(len(encoded)), encoded, self.payload
+        )))
+        return Frame(self.binary, self.flags, self.codec, route, raw[len(raw) - len(self.payload):], raw)
+
+
+    def __len__(self) -> int:
+        return len(self.payload)
+
+
+class FrameReader:
+    '''Incremental decoder for {MESSAGE_HEADER}{MESSAGE} frames, one per socket.
+
+    Both header formats are accepted, detected frame by frame:
+     - Binary: {MAGIC}{VERSION}{FLAGS}{CODEC}{LENGTH}, see utils.message_codec
+     - Legacy: the message length in ASCII, padded to "header_length" (unless SOCKET_LEGACY_FRAMING is disabled)
+
+    Bytes are received with "recv_into()" straight into a reusable buffer, so partial headers
+    and partial bodies are kept until the rest arrives, whatever the TLS record boundaries are.
+    Frames are returned as memoryview slices of the buffer, and are only valid until the next frame is read.
+
+    Usage:
+     - Blocking sockets: "read_frame()" returns the next frame, or None when the peer closed the connection
+     - Non-blocking sockets: "fill()" receives what is available, then "frames()" yields the complete frames
+     - Asyncio streams: "feed()" appends the bytes read, then "frames()" yields the complete frames
+    '''
+    # Constants
+    HEADER_LENGTH = ''
+    ALLOW_LEGACY = True
+
+
+    def __init__(self, header_length: int, buffer_size: int = RECV_SIZE, allow_legacy: bool = ALLOW_LEGACY_FRAMING) -> None:
+        self.HEADER_LENGTH = header_length
+        self.ALLOW_LEGACY = allow_legacy
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first byte not yet returned as a frame
+        self.end = 0   # end of the received bytes
+
+
+    def _reserve(self, size: int) -> None:
+        '''Make room for "size" more bytes after the received data.'''
+        if len(self.buffer) - self.end >= size:
+            return
+
+        pending = self.end - self.start
+        if len(self.buffer) >= pending + size:
+            # Move the unread bytes to the front of the buffer
+            self.view[:pending] = self.view[self.start:self.end]
+        else:
+            # Grow into a new buffer, as frames may still reference the old one
+            buffer = bytearray(max(len(self.buffer) * 2, pending + size))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
+
+
+    def recv_into(self, client_socket) -> int:
+        '''Receive the next chunk of bytes. Returns 0 when the peer closed the connection.'''
+        self._reserve(RECV_SIZE)
+        received = client_socket.recv_into(self.view[self.end:], len(self.buffer) - self.end)
+        self.end += received
+        return received
+
+
+    def feed(self, data: bytes) -> None:
+        '''Append bytes received by other means, e.g. from an asyncio stream.'''
+        self._reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+
+    def fill(self, client_socket, budget: int = SOCKET_READ_BUDGET) -> bool:
+        '''Receive what is available on a non-blocking socket, up to about "budget" bytes, so a fast peer cannot hold
+        the event loop: the selector reports the rest on its next turn. Bytes already decrypted by the TLS layer
+        are always received, the selector would not report them. Returns False when the peer closed the connection.'''
+        received = 0
+        try:
+            while received < budget or (isinstance(client_socket, ssl.SSLSocket) and client_socket.pending()):
+                chunk = self.recv_into(client_socket)
+                if not chunk:
+                    return False
+                received += chunk
+            return True
+
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+            return True
+
+
+    def _parse_header(self) -> tuple:
+        '''Parse the header of the next frame: (binary, flags, codec, header size, payload length).
+        Returns None when the header is still incomplete.'''
+        available = self.end - self.start
+        if available < 2:
+            return None
+
+        if self.view[self.start:self.start + 2] == MAGIC:
+            if available < HEADER_SIZE:
+                return None
+            _, version, flags, codec, message_length = HEADER.unpack_from(self.buffer, self.start)
+            if version > VERSION:
+                raise ValueError(f'Unsupported frame version: {version}')
+            header_size = HEADER_SIZE
+            if flags & FLAG_ROUTED:
+                if available < HEADER_SIZE + ROUTE_LENGTH.size:
+                    return None
+                header_size += ROUTE_LENGTH.size + ROUTE_LENGTH.unpack_from(self.buffer, self.start + HEADER_SIZE)[0]
+            header = (True, flags, codec, header_size, message_length)
+        else:
+            if not self.ALLOW_LEGACY:
+                raise ValueError('Legacy frame header is not accepted')
+            if available < self.HEADER_LENGTH:
+                return None
+            message_length = int(bytes(self.view[self.start:self.start + self.HEADER_LENGTH]))
+            header = (False, 0, 0, self.HEADER_LENGTH, message_length)
+
+        if message_length < 0 or message_length > MAX_FRAME_SIZE:
+            raise ValueError(f'Invalid frame length: {message_length}')
+        return header
+
+
+    def next_frame(self) -> Frame:
+        '''Return the next complete frame from the buffer, or None if it has not fully arrived yet.'''
+        header = self._parse_header()
+        if header is None:
+            return None
+        binary, flags, codec, header_size, message_length = header
+        frame_length = header_size + message_length
+
+        if self.end - self.start < frame_length:
+            # Make sure the whole frame fits, so it can be received without another copy
+            self._reserve(frame_length - (self.end - self.start))
+            return None
+
+        raw = self.view[self.start:self.start + frame_length]
+        self.start += frame_length
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        route = None
+        if flags & FLAG_ROUTED:
+            route = decode_route(raw[HEADER_SIZE + ROUTE_LENGTH.size:header_size])
+        return Frame(binary, flags, codec, route, raw[header_size:], raw)
+
+
+    def frames(self):
+        '''Yield every complete frame in the buffer.'''
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+
+    def read_frame(self, client_socket) -> Frame:
+        '''Block until a whole frame is received. Returns None when the peer closed the connection.'''
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if not self.recv_into(client_socket):
+                return None
+
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+
+    def __repr__(self) -> str:
+        return f'FrameReader({self.HEADER_LENGTH})'
+
+
+    def __str__(self) -> str:
+        return 'Incremental frame decoder for socket messages'
@@ -0,0 +1,137 @@
+import os
+import time
+import random
+import requests
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ConnectTimeoutError
+from utils.metrics import metrics
+from utils.chalk import log
+
+# Constants
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.2))
+HTTP_BACKOFF_MAX = float(os.environ.get('HTTP_BACKOFF_MAX', 5))
+RETRY_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+def not_sent(ex: Exception) -> bool:
+    '''The request failed before it was sent: the connection to the backend could not be established.'''
+    if isinstance(ex, requests.ConnectTimeout):
+        return True
+    reason = ex.args[0] if ex.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class HttpClient:
+    '''Pooled HTTP client for the backend REST API, shared by the whole process.
+
+    - Connections are kept alive and reused, at most "pool_size" per host
+    - Every request has a connect and a read timeout, so a hung backend cannot block the caller forever
+    - Failed requests are retried with a jittered exponential backoff. Requests that are not idempotent
+      (POST) are only retried when the backend did not process them: connections that could not be
+      established (refused, timed out) and 503. A connection lost once the request is sent is not retried
+    '''
+    # Constants
+    POOL_SIZE = 0
+    TIMEOUT = None
+    RETRIES = 0
+
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, timeout: tuple = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), retries: int = HTTP_RETRIES) -> None:
+        self.POOL_SIZE = pool_size
+        self.TIMEOUT = timeout
+        self.RETRIES = retries
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.lock = Lock()
+        self.counters = {'requests': 0, 'retries': 0, 'errors': 0}
+
+
+    def _backoff(self, attempt: int) -> float:
+        '''Full jitter: a random delay up to the exponential backoff of the attempt.'''
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * 2 ** attempt))
+
+
+    def _count(self, counter: str) -> None:
+        with self.lock:
+            self.counters[counter] += 1
+
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        '''Send the request over a pooled connection, retrying it on transient failures.
+        Raises the last error when every attempt failed.'''
+        method = method.upper()
+        idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.TIMEOUT)
+
+        attempt = 0
+        while True:
+            self._count('requests')
+            try:
+                response = self.session.request(method, url, **kwargs)
+                retry = response.status_code in RETRY_STATUSES and (idempotent or response.status_code == 503)
+                if not retry or attempt >= self.RETRIES:
+                    return response
+                reason = f'status {response.status_code}'
+                response.close()
+
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                retry = idempotent or not_sent(ex)
+                if not retry or attempt >= self.RETRIES:
+                    self._count('errors')
+                    raise
+                reason = type(ex).__name__
+
+            delay = self._backoff(attempt)
+            attempt += 1
+            self._count('retries')
+            log(f'HTTP: {method} {url} failed ({reason}), retrying in {delay:.2f}s [{attempt}/{self.RETRIES}]', 'warning')
+            time.sleep(delay)
+
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
+
+
+    def stats(self) -> dict:
+        '''Request and connection counters. "reused" is the number of requests sent over an already open connection.'''
+        connections = 0
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+
+        with self.lock:
+            stats = dict(self.counters)
+        stats['connections'] = connections
+        stats['reused'] = max(stats['requests'] - stats['errors'] - connections, 0)
+        return stats
+
+
+    def close(self) -> None:
+        self.session.close()
+
+
+    def __repr__(self) -> str:
+        return f'HttpClient({self.POOL_SIZE}, {self.TIMEOUT}, {self.RETRIES})'
+
+
+    def __str__(self) -> str:
+        return 'Pooled HTTP client for the backend REST API'
+
+
+# Shared by every caller of the process, so connections are reused across calls
+http_client = HttpClient()
+metrics.gauge('http_client_requests', 'Requests to the REST API: sent, retried, failed, connections opened & requests over a reused connection', ('stat',), lambda: {(name,): value for name, value in http_client.stats().items()})
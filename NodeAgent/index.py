@@ -1,14 +1,15 @@
 
 import os
-import socket
-import errno
 import json
+import time
+import atexit
 from dotenv import load_dotenv
-from flask import Flask, request
-from utils.register_socket import register_socket, deregister_socket
+from flask import Flask, Response, request
+from utils.broker_pool import BrokerPool, BROKER_BATCH_CONCURRENCY, BROKER_BATCH_MAX, REQUEST_SECONDS, outcome, request_timeout
+from utils.broker_registry import BrokerRegistry
+from utils.metrics import metrics
+from utils.tracing import start_trace, sampled, add_hop, breakdown, exporter
 from utils.chalk import log
-from utils.security import SSL
-from utils.encode_message import encode_message
 from utils.resolve_env import resolve_socket_server, resolve_socket_port, resolve_socket_header_length, resolve_flask_port
 
 load_dotenv()
@@ -17,6 +18,13 @@ app = Flask(__name__)
 HEADER_LENGTH = resolve_socket_header_length()
 IP = resolve_socket_server()
 PORT = resolve_socket_port()
+BROKER_POOL_SIZE = int(os.environ.get('BROKER_POOL_SIZE', 4))
+BROKER_REQUEST_TIMEOUT = float(os.environ.get('BROKER_REQUEST_TIMEOUT', 120))
+
+broker_pool = BrokerPool(BROKER_POOL_SIZE, HEADER_LENGTH, IP, PORT)
+broker_registry = BrokerRegistry(on_release=broker_pool.release)
+atexit.register(broker_pool.close)
+atexit.register(broker_registry.close)
 
 @app.route('/api/socket', methods=['POST'])
 def api_socket():
@@ -29,133 +37,231 @@ def api_socket():
      - Agent socket: performs the task
 
     The route (REST API) will use the "send_message()" method of the broker, to execute the following:
-     - Broker socket establishes a temporary session with the socket server
+     - Broker socket is taken from a pool of persistent sessions with the socket server
      - Broker then sends the data over to it with destination socket (agent) ID supplied by the user
      - Server looks into its caching database to find the correct socket (agent) based on the destination socket ID
      - Server forwards the message to the destination socket (agent)
      - Data will be returned to the broker by reversing the destination & source socket ID's
     
     Once the broker socket receives the message from the agent and sends it to the route (REST API response):
-     - Broker socket will be shut down
-     - The route (REST API) will deregister the broker sokcet
+     - Broker socket stays open, to be reused by the next request
+     - The broker socket ID stays registered, to be reused by the next request with the same token
+     - Broker socket ID's are deregistered when their lease expires or is evicted, once the requests using them are done, and on shutdown
+
+    Clients sending "Accept: application/x-ndjson" get the output of the task as it is produced:
+     - Every "response-chunk" of the agent is written as one JSON line, followed by the final response
+     - The status code is sent before the task ends, errors are reported in the final line
+
+    The "Idempotency-Key" header lets retries share the result of the first attempt on the agent. Messages may also
+    set "cache": true for read-only tasks, sharing the result of identical payloads, or "bypass" / "invalidate".
+
+    Clients sending "Trace: true" get the latency breakdown of the request in the "trace" field of the response:
+    the time it crossed the broker, the server, the agent and the task, see utils.tracing. Traced and sampled
+    (TRACE_SAMPLE_RATE) requests are also exported to TRACE_FILE, if set.
     '''
     data = request.json
 
     headers = request.headers
+    socket_id = None
 
     try:
+        # The client may ask for a shorter deadline, within the limit of the broker
+        timeout = request_timeout(headers.get('Request-Timeout'), BROKER_REQUEST_TIMEOUT)
+        if timeout is None:
+            return {'isError': True, 'message': 'Request-Timeout must be a positive number of seconds'}, 400
+
         token = headers['Authorization'].replace('Bearer ', '')
 
-        # Register the socket
-        response = register_socket(token, socket_type='broker')
+        # Get the socketId leased for the token, the REST API is only called on a miss
+        response = broker_registry.acquire(token)
         if response['isError']:
             return response
 
-        # Get the socketId and append to the socket message
-        socket_id = response['data']['socket']['_id']
-        data['from'] = socket_id
+        # Append the socketId to the socket message
+        socket_id = data['from'] = response['socketId']
+
+        # Retries with the same key get the result of the first attempt from the agent
+        if headers.get('Idempotency-Key'):
+            data['idempotencyKey'] = headers['Idempotency-Key']
         
         # Send the data to the agent with the broker
-        response = send_message(data)
+        data.pop('trace', None)
+        if 'application/x-ndjson' in headers.get('Accept', ''):
+            # The lease is handed back once the output is streamed
+            streamed, socket_id = socket_id, None
+            return Response(released(stream_message(data, timeout), streamed), mimetype='application/x-ndjson')
 
-        # Deregister the socket
-        deregister_socket(token, socket_id)
-        
+        traced = headers.get('Trace', '').lower() in ('1', 'true', 'yes')
+        if traced or sampled():
+            data['trace'] = start_trace()
+        response = send_message(data, timeout)
+
+        trace = response.pop('trace', None)
+        if traced and trace:
+            response['trace'] = breakdown(trace)
+
+        # The agent did not answer in time, or the task missed its deadline on the agent
+        if response.get('timeout') or (isinstance(response.get('data'), dict) and response['data'].get('timeout')):
+            return response, 504
+
+        # The agent rejected the task as its queue is full, or is reconnecting to the server
+        if isinstance(response.get('data'), dict) and (response['data'].get('busy') or response['data'].get('reconnecting')):
+            return response, 503
         return response
 
     except Exception as ex:
         log(f'General error [195] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
         return {'isError': True}
 
+    finally:
+        if socket_id:
+            broker_registry.done(socket_id)
+
+
+@app.route('/api/socket/batch', methods=['POST'])
+def api_socket_batch():
+    '''Push one task to many agents in a single call. The JSON payload is the message of "/api/socket", with either:
+     - "to": the list of destination socket (agent) ID's
+     - "selector": {"tags": [...]}, every agent of the organization owning the token having all the tags, as known by the server
+    and optionally "concurrency", the number of agents running the task at once (at most BROKER_BATCH_CONCURRENCY).
+
+    The message is sent to every agent over a single broker connection, and the server forwards each copy as soon
+    as it arrives. The response is NDJSON: one line per agent as its response arrives, {"agent": ..., "response": ...},
+    then a summary line. The "Request-Timeout" header covers the whole batch.
+    '''
+    data = request.json
+
+    headers = request.headers
+    socket_id = None
 
-def create_socket(socket_id: str) -> dict:
     try:
-        # Get SSL Context
-        ssl_handler = SSL()
-        response = ssl_handler.create_context()
-        if response['isError']:
-            return {'isError': True, 'message': response['message']}
-        context = response['context']
-        naked_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket = context.wrap_socket(naked_socket)
+        # The client may ask for a shorter deadline, within the limit of the broker
+        timeout = request_timeout(headers.get('Request-Timeout'), BROKER_REQUEST_TIMEOUT)
+        if timeout is None:
+            return {'isError': True, 'message': 'Request-Timeout must be a positive number of seconds'}, 400
 
-        client_socket.connect((IP, PORT))
+        token = headers['Authorization'].replace('Bearer ', '')
 
-        response = ssl_handler.validate_cert(client_socket.getpeercert())
+        # Get the socketId leased for the token, the REST API is only called on a miss
+        response = broker_registry.acquire(token)
         if response['isError']:
-            return {'isError': True, 'message': response['message']}
-
-        client_socket.send(encode_message(json.dumps({
-            'action': 'handshake',
-            'from': socket_id,
-            'to': 'server'
-        })))
-        return {'isError': False, 'socket': client_socket}
-    
+            return response
+        socket_id = data['from'] = response['socketId']
+        tenant = response['tenant']
+
+        destinations = data.pop('to', None)
+        selector = data.pop('selector', None)
+        if selector is not None:
+            # Agents of the same organization only, a selector without a tenant would match every agent of the server
+            if tenant is None:
+                return {'isError': True, 'message': 'The tenant of the token is unknown, list the agents in "to"'}, 400
+            response = broker_pool.select(data['from'], tenant, selector.get('tags', []), BROKER_REQUEST_TIMEOUT)
+            if response['isError']:
+                return response
+            destinations = response['sockets']
+
+        # Each agent gets the task once
+        if not isinstance(destinations, list) or not destinations:
+            return {'isError': True, 'message': 'No destination agents'}, 400
+        destinations = list(dict.fromkeys(destinations))
+        if len(destinations) > BROKER_BATCH_MAX:
+            return {'isError': True, 'message': f'At most {BROKER_BATCH_MAX} destination agents per batch'}, 413
+
+        concurrency = max(min(int(data.pop('concurrency', BROKER_BATCH_CONCURRENCY)), BROKER_BATCH_CONCURRENCY), 1)
+        # The lease is handed back once the responses are streamed
+        streamed, socket_id = socket_id, None
+        return Response(released(fan_out(data, destinations, concurrency, timeout), streamed), mimetype='application/x-ndjson')
+
+    except Exception as ex:
+        log(f'General error [3390] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+        return {'isError': True}
+
+    finally:
+        if socket_id:
+            broker_registry.done(socket_id)
+
+
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+    '''Metrics of the broker in the Prometheus text format: request latencies by outcome, pending requests,
+    lease lookups and registrations. The metrics of the server are returned by its "stats" action.
+    '''
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def released(lines, socket_id: str):
+    '''Stream the lines, then hand the lease of the broker socket ID back to the registry.'''
+    try:
+        yield from lines
+    finally:
+        broker_registry.done(socket_id)
+
+
+def fan_out(message: dict, destinations: list, concurrency: int, timeout: float):
+    '''Yield one JSON line per agent as its response arrives, then {"isError", "total", "failed"}.
+    If the client disconnects, the generator is closed, which cancels the requests still running.
+    '''
+    failed = 0
+    try:
+        log(f'Socket: Sending to {len(destinations)} agents')
+        for destination, response in broker_pool.fan_out(message, destinations, concurrency, timeout):
+            if response.get('isError') or (isinstance(response.get('data'), dict) and response['data'].get('isError')):
+                failed += 1
+            yield json.dumps({'agent': destination, 'response': response}) + '\n'
+        yield json.dumps({'isError': failed > 0, 'total': len(destinations), 'failed': failed}) + '\n'
+
     except Exception as ex:
-        log(f'General error [7379] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
-        return {'isError': True, 'message': 'Failed to create socket'}
+        log(f'General error [2584] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+        yield json.dumps({'isError': True, 'message': 'Broker socket error'}) + '\n'
 
 
-def send_message(message: dict) -> dict:
+def send_message(message: dict, timeout: float = BROKER_REQUEST_TIMEOUT) -> dict:
     '''On the event of running a config:
      - The function will receive a message
-     - Temporary socket will be created
+     - The message will be enqueued on a pooled broker connection with a new correlation id and a deadline
      - The message will be sent to the agent via the server-broker connection
-     - Once the message is received, it will be returned
-     - Finally the socket will close (end of while loop)
+     - Once the matching response is received, it will be returned
+     - If the deadline passes first, the request is cancelled and a "timeout" error is returned
+    Traced messages (with a "trace" field) get the hops of the broker, and are exported once answered.
     '''
     try:
-        # Create the socket
-        response = create_socket(socket_id=message['from'])
-        if response['isError']:
-            return response
-        
-        # Get the socket
-        client_socket = response['socket']
-
-        # Make sure message exists
-        if message:
-            log('Socket: Sending to agent')
-            client_socket.send(encode_message(json.dumps(message)))
-
-        while True:
-            # Receive messages. Loop until error
-            try:
-                while True:
-                    # Data will be received in the format: {MESSAGE_HEADER}{MESSAGE}
-                    message_header = client_socket.recv(HEADER_LENGTH)
-                    if not len(message_header):
-                        log('Socket: Connection closed by the server', 'danger')
-                        return {'isError': True, 'message': 'Broker socket error'}
-                    message_length = int(message_header.decode('utf-8').strip())
-                    message = json.loads(client_socket.recv(message_length).decode('utf-8'))
-
-                    # If the agent receives an informational message, log the message to the console
-                    if message['action'] == 'inform':
-                        log(f'Server: {message["text"]}', message['level'])
-
-                    if message['action'] == 'response':
-                        log('Socket: Received config response', 'success')
-                        log('Socket: Connection terminated by the server', 'warning')
-                        return message
-
-            except IOError as ex:
-                # No more messages to be received. OS level
-                if ex.errno != errno.EAGAIN and ex.errno != errno.EWOULDBLOCK:
-                    log(f'Read error [8541] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
-                    return {'isError': True, 'message': 'Broker socket read error'}
-                continue
-
-            except Exception as ex:
-                log(f'General error [2215] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
-                return {'isError': True, 'message': 'Broker socket error'}
-    
+        log('Socket: Sending to agent')
+        if message.get('trace'):
+            message['trace'] = add_hop(message['trace'], 'broker.send')
+        started = time.monotonic()
+        response = broker_pool.send_message(message, timeout)
+        REQUEST_SECONDS.observe(time.monotonic() - started, (outcome(response),))
+
+        # Requests that timed out only have the hops of the request
+        if message.get('trace'):
+            response['trace'] = add_hop(response.get('trace') or message['trace'], 'broker.receive')
+            exporter.export(response['trace'], agent=message.get('to'), action=message.get('action'), outcome=outcome(response))
+        if response.get('action') == 'response':
+            log('Socket: Received config response', 'success')
+        return response
+
     except Exception as ex:
         log(f'General error [4119] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
         return {'isError': True, 'message': 'Broker socket error'}
 
 
+def stream_message(message: dict, timeout: float = BROKER_REQUEST_TIMEOUT):
+    '''Streamed variant of "send_message()": yields one JSON line per chunk of output, then the final response.
+    If the client disconnects, the generator is closed, which cancels the task on the agent.
+    '''
+    try:
+        log('Socket: Streaming from agent')
+        for response in broker_pool.stream_message(message, timeout):
+            if response.get('action') == 'response-chunk':
+                yield json.dumps({'sequence': response.get('sequence'), 'data': response.get('data')}) + '\n'
+            else:
+                yield json.dumps(response) + '\n'
+
+    except Exception as ex:
+        log(f'General error [8531] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+        yield json.dumps({'isError': True, 'message': 'Broker socket error'}) + '\n'
+
+
 def main():
     app.run(
         host='0.0.0.0',
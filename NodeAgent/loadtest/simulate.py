@@ -0,0 +1,428 @@
+import os
+import sys
+import json
+import time
+import socket
+import random
+import asyncio
+import argparse
+import resource
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event
+from utils.async_broker import AsyncBrokerPool
+from utils.broker_pool import outcome
+from utils.broker_registry import BrokerRegistry
+from utils.frame_reader import FrameReader, RECV_SIZE
+from utils.message_codec import encode_frame, decode_frame, handshake_offer
+from utils.security import authenticate, get_context
+from utils.register_socket import register_socket, socket_tenant
+from utils.resolve_env import resolve_socket_server, resolve_socket_port, resolve_socket_header_length
+from loadtest.stub_api import StubAPI, STUB_API_HOST, STUB_API_PORT
+
+# Constants
+HEADER_LENGTH = resolve_socket_header_length()
+IP = resolve_socket_server()
+PORT = resolve_socket_port()
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+def raise_file_limit() -> None:
+    '''Every simulated agent holds a socket, allow as many as the hard limit.'''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def percentile(values: list, fraction: float) -> float:
+    '''Percentile of sorted values, e.g. 0.999 for the p999.'''
+    if not values:
+        return 0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class SimulatedAgent:
+    '''An agent speaking the protocol of "agent.py" (TLS, handshake, binary frames), with an echo task handler
+    answering every request after "latency" seconds (+/- "jitter") with "payload" bytes of output.'''
+    # Variables
+    socket_id = ''
+    codec = 'json'
+    compression = None
+
+
+    def __init__(self, socket_id: str, tenant: str, latency: float, jitter: float, payload: int) -> None:
+        self.socket_id = socket_id
+        self.tenant = tenant
+        self.latency = latency
+        self.jitter = jitter
+        self.output = 'x' * payload
+        self.writer = None
+        self.tasks = set()
+
+
+    async def run(self, connected: asyncio.Future) -> None:
+        '''Connect, then answer requests until the server closes the connection.
+        "connected" is resolved once the handshake is accepted, or failed.'''
+        try:
+            reader, self.writer = await asyncio.open_connection(IP, PORT, ssl=get_context('client'))
+            self.writer.write(encode_frame({
+                'action': 'handshake',
+                'from': self.socket_id,
+                'to': 'server',
+                'type': 'agent',
+                'tenant': self.tenant,
+                **handshake_offer()
+            }))
+
+            frames = FrameReader(HEADER_LENGTH)
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                frames.feed(data)
+                for frame in frames.frames():
+                    self._handle_message(decode_frame(frame), connected)
+
+        except Exception as ex:
+            if not connected.done():
+                connected.set_exception(ex)
+
+        finally:
+            if not connected.done():
+                connected.set_exception(ConnectionError('Connection closed by the server'))
+            if self.writer is not None:
+                self.writer.close()
+
+
+    def _handle_message(self, message: dict, connected: asyncio.Future) -> None:
+        if message['action'] == 'inform':
+            if message.get('codec'):
+                self.codec, self.compression = message['codec'], message.get('compression')
+            if not connected.done():
+                connected.set_result(True)
+
+        elif message['action'] == 'ping':
+            self.writer.write(encode_frame({'action': 'pong', 'from': message['to'], 'to': 'server'}, self.codec, self.compression))
+
+        elif message['action'] == 'request':
+            task = asyncio.ensure_future(self._respond(message))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+
+    async def _respond(self, message: dict) -> None:
+        delay = max(self.latency + random.uniform(-self.jitter, self.jitter), 0)
+        if delay:
+            await asyncio.sleep(delay)
+        self.writer.write(encode_frame({
+            'action': 'response',
+            'from': message['to'],
+            'to': message['from'],
+            'token': message.get('token'),
+            'correlationId': message.get('correlationId'),
+            'data': {'isError': False, 'output': self.output}
+        }, self.codec, self.compression))
+
+
+    def __repr__(self) -> str:
+        return f'SimulatedAgent("{self.socket_id}")'
+
+
+async def _run_agents(registrations: list, options: dict, results, stop) -> None:
+    '''Connect the registered agents, (socket ID, tenant) pairs, and report which ones got in.'''
+    loop = asyncio.get_running_loop()
+    handshakes = asyncio.Semaphore(options['connect_concurrency'])
+    agents = [SimulatedAgent(socket_id, tenant, options['latency'], options['jitter'], options['payload']) for socket_id, tenant in registrations]
+    runs = []
+
+    async def connect(agent: SimulatedAgent) -> bool:
+        async with handshakes:
+            connected = loop.create_future()
+            runs.append(asyncio.ensure_future(agent.run(connected)))
+            try:
+                return await asyncio.wait_for(connected, 30)
+            except Exception:
+                return False
+
+    started = time.monotonic()
+    connected = await asyncio.gather(*[connect(agent) for agent in agents])
+    results.put({
+        'socketIds': [agent.socket_id for agent, ok in zip(agents, connected) if ok],
+        'failed': connected.count(False),
+        'seconds': time.monotonic() - started
+    })
+
+    # Serve the requests until the test ends
+    await loop.run_in_executor(None, stop.wait)
+    for run in runs:
+        run.cancel()
+
+
+def agent_process(count: int, options: dict, results, stop) -> None:
+    '''Authenticate & register "count" agents with the REST API, like "agent.py" does, then connect them.'''
+    raise_file_limit()
+    response = authenticate('load@nodeagent.test', 'load')
+    token = response['data']['token'] if not response['isError'] else 'load'
+    with ThreadPoolExecutor(16) as executor:
+        registrations = list(executor.map(lambda _: register_socket(token, socket_type='agent'), range(count)))
+    registrations = [(response['data']['socket']['_id'], socket_tenant(response)) for response in registrations if not response['isError']]
+    asyncio.run(_run_agents(registrations, options, results, stop))
+
+
+class RelayMonitor:
+    '''CPU time and resident memory of the relay process and its workers, read from /proc (Linux).'''
+    # Variables
+    pid = 0
+    max_rss = 0
+
+
+    def __init__(self, pid: int, interval: float = 0.5) -> None:
+        self.pid = pid
+        self.interval = interval
+        self.max_rss = 0
+        self.stopped = Event()
+
+
+    def _pids(self) -> list:
+        try:
+            with open(f'/proc/{self.pid}/task/{self.pid}/children') as file:
+                return [self.pid, *map(int, file.read().split())]
+        except OSError:
+            return [self.pid]
+
+
+    def cpu_seconds(self) -> float:
+        total = 0
+        for pid in self._pids():
+            try:
+                with open(f'/proc/{pid}/stat') as file:
+                    fields = file.read().rsplit(')', 1)[1].split()
+                total += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS # utime & stime
+            except OSError:
+                continue
+        return total
+
+
+    def rss(self) -> int:
+        '''Resident memory, in bytes.'''
+        total = 0
+        for pid in self._pids():
+            try:
+                with open(f'/proc/{pid}/status') as file:
+                    for line in file:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                continue
+        return total
+
+
+    def _sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.max_rss = max(self.max_rss, self.rss())
+
+
+    def start(self) -> None:
+        Thread(target=self._sample, daemon=True).start()
+
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+    def __repr__(self) -> str:
+        return f'RelayMonitor({self.pid})'
+
+
+async def run_stage(pool: AsyncBrokerPool, brokers: list, agent_ids: list, duration: float, timeout: float) -> dict:
+    '''"brokers" (socket ID, token) send requests back to back to random agents for "duration" seconds.'''
+    latencies = []
+    outcomes = {}
+    deadline = time.monotonic() + duration
+
+    async def broker(socket_id: str, token: str) -> None:
+        while time.monotonic() < deadline:
+            message = {'action': 'request', 'from': socket_id, 'to': random.choice(agent_ids), 'token': token, 'data': {'command': 'echo'}}
+            started = time.perf_counter()
+            response = await pool.send_message(message, timeout)
+            latencies.append(time.perf_counter() - started)
+            label = outcome(response)
+            outcomes[label] = outcomes.get(label, 0) + 1
+
+    started = time.monotonic()
+    await asyncio.gather(*[broker(socket_id, token) for socket_id, token in brokers])
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        'brokers': len(brokers),
+        'requests': len(latencies),
+        'outcomes': outcomes,
+        'throughput': round(outcomes.get('ok', 0) / elapsed, 1),
+        'p50': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99': round(percentile(latencies, 0.99) * 1000, 2),
+        'p999': round(percentile(latencies, 0.999) * 1000, 2),
+        'max': round(latencies[-1] * 1000, 2) if latencies else 0
+    }
+
+
+async def run_brokers(options: dict, agent_ids: list, monitor: RelayMonitor) -> list:
+    pool = AsyncBrokerPool(options['pool_size'], HEADER_LENGTH, IP, PORT)
+    registry = BrokerRegistry(size=max(options['stages']) + 1)
+    loop = asyncio.get_running_loop()
+    stages = []
+    try:
+        for count in options['stages']:
+            brokers = []
+            for index in range(count):
+                token = f'load-broker-{index}'
+                response = await loop.run_in_executor(None, registry.acquire, token)
+                if not response['isError']:
+                    brokers.append((response['socketId'], token))
+
+            cpu = monitor.cpu_seconds() if monitor else 0
+            started = time.monotonic()
+            stage = await run_stage(pool, brokers, agent_ids, options['duration'], options['timeout'])
+            if monitor:
+                stage['relayCpu'] = round((monitor.cpu_seconds() - cpu) / (time.monotonic() - started) * 100, 1)
+                stage['relayRss'] = monitor.rss()
+            stages.append(stage)
+            print_stage(stage)
+
+    finally:
+        pool.close()
+        await loop.run_in_executor(None, registry.close)
+    return stages
+
+
+def spawn_relay(log_path: str = None) -> subprocess.Popen:
+    '''Start "server.py" with the environment of the test, and wait until it listens.'''
+    output = open(log_path, 'w') if log_path else subprocess.DEVNULL
+    relay = subprocess.Popen([sys.executable, SERVER_PATH], cwd=os.path.dirname(SERVER_PATH), stdout=output, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if relay.poll() is not None:
+            raise RuntimeError('The relay exited on startup')
+        try:
+            socket.create_connection((IP, PORT), 1).close()
+            return relay
+        except OSError:
+            time.sleep(0.2)
+    relay.kill()
+    raise RuntimeError('The relay did not start listening')
+
+
+def print_stage(stage: dict) -> None:
+    line = (
+        f'brokers {stage["brokers"]:>6}  requests {stage["requests"]:>8}  {stage["throughput"]:>9} req/s  '
+        f'p50 {stage["p50"]:>8} ms  p99 {stage["p99"]:>8} ms  p999 {stage["p999"]:>8} ms  {stage["outcomes"]}'
+    )
+    if 'relayCpu' in stage:
+        line += f'  relay cpu {stage["relayCpu"]}%  rss {stage["relayRss"] / 1048576:.1f} MB'
+    print(line, flush=True)
+
+
+def main() -> None:
+    '''Load test of a relay: connect N simulated agents, then send requests from M brokers, and report the throughput,
+    latencies, and the CPU & memory of the relay.
+
+        python3 -m loadtest.simulate --spawn-relay --agents 5000 --brokers 16,64,256 --duration 20 --latency 5
+
+    Brokers send their requests back to back, so each stage of --brokers is one level of concurrency: the throughput
+    stops growing, and the latencies climb, once the relay is saturated. A stub of the REST API is started on
+    STUB_API_HOST:STUB_API_PORT, unless --no-stub is given.
+    '''
+    parser = argparse.ArgumentParser(description='Simulated agents & brokers against a relay')
+    parser.add_argument('--agents', type=int, default=1000, help='number of simulated agents')
+    parser.add_argument('--agent-processes', type=int, default=1, help='processes running the simulated agents')
+    parser.add_argument('--brokers', default='16,64', help='concurrent brokers, one stage per comma separated count')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per stage')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds of the simulated tasks')
+    parser.add_argument('--jitter', type=float, default=0, help='+/- milliseconds of the simulated tasks')
+    parser.add_argument('--payload', type=int, default=256, help='bytes of output per task')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds before a request times out')
+    parser.add_argument('--pool-size', type=int, default=4, help='broker connections')
+    parser.add_argument('--connect-concurrency', type=int, default=200, help='agent TLS handshakes at once')
+    parser.add_argument('--spawn-relay', action='store_true', help='start server.py, instead of using a running relay')
+    parser.add_argument('--relay-pid', type=int, help='PID of the running relay, for its CPU & memory')
+    parser.add_argument('--relay-log', help='output of the spawned relay')
+    parser.add_argument('--no-stub', action='store_true', help='use the REST API configured, instead of a local stub')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args()
+
+    raise_file_limit()
+    options = {
+        'latency': args.latency / 1000,
+        'jitter': args.jitter / 1000,
+        'payload': args.payload,
+        'timeout': args.timeout,
+        'pool_size': args.pool_size,
+        'connect_concurrency': args.connect_concurrency,
+        'duration': args.duration,
+        'stages': [int(count) for count in args.brokers.split(',') if count.strip()]
+    }
+
+    stub = None
+    if not args.no_stub:
+        stub = StubAPI(STUB_API_HOST, STUB_API_PORT)
+        stub.start()
+
+    relay = spawn_relay(args.relay_log) if args.spawn_relay else None
+    pid = relay.pid if relay else args.relay_pid
+    monitor = RelayMonitor(pid) if pid else None
+    if monitor:
+        monitor.start()
+
+    # Agents run in their own processes, so the brokers are not slowed down by them
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    stop = context.Event()
+    processes = []
+    for index in range(args.agent_processes):
+        count = args.agents // args.agent_processes + (1 if index < args.agents % args.agent_processes else 0)
+        process = context.Process(target=agent_process, args=(count, options, results, stop), daemon=True)
+        process.start()
+        processes.append(process)
+
+    report = {'agents': args.agents, 'connected': 0, 'failed': 0, 'connectSeconds': 0}
+    agent_ids = []
+    try:
+        for _ in processes:
+            connected = results.get()
+            agent_ids += connected['socketIds']
+            report['failed'] += connected['failed']
+            report['connectSeconds'] = round(max(report['connectSeconds'], connected['seconds']), 2)
+        report['connected'] = len(agent_ids)
+        if monitor:
+            report['relayRssConnected'] = monitor.rss()
+        print(
+            f'agents {report["connected"]} connected, {report["failed"]} failed, in {report["connectSeconds"]}s'
+            + (f', relay rss {report["relayRssConnected"] / 1048576:.1f} MB' if monitor else ''), flush=True
+        )
+        if not agent_ids:
+            raise RuntimeError('No agent connected')
+
+        report['stages'] = asyncio.run(run_brokers(options, agent_ids, monitor))
+
+    finally:
+        stop.set()
+        for process in processes:
+            process.join(5)
+        if monitor:
+            monitor.stop()
+            report['relayMaxRss'] = monitor.max_rss
+        if relay:
+            relay.terminate()
+            relay.wait(10)
+        if stub:
+            report['api'] = stub.stats()
+            stub.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import os
+import json
+import uuid
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Constants
+STUB_API_HOST = os.environ.get('STUB_API_HOST', '127.0.0.1')
+STUB_API_PORT = int(os.environ.get('STUB_API_PORT', 5000))
+STUB_API_ORG = os.environ.get('STUB_API_ORG', 'load-org')
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''The endpoints of the REST API used by "authenticate()", "register_socket()" and "deregister_socket()".'''
+    protocol_version = 'HTTP/1.1'
+
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+    def _respond(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/api/org/token':
+            self.server.count('authenticate')
+            self._respond(200, {'message': 'Authenticated', 'token': f'load-{uuid.uuid4().hex}'})
+        elif self.path == '/api/socket':
+            self.server.count('register')
+            self._respond(201, {'message': 'Socket registered', 'socket': {'_id': uuid.uuid4().hex, 'org': STUB_API_ORG}})
+        else:
+            self._respond(404, {'message': 'Not found'})
+
+
+    def do_DELETE(self) -> None:
+        if self.path.startswith('/api/socket/'):
+            self.server.count('deregister')
+            self._respond(200, {'message': 'Socket deregistered'})
+        else:
+            self._respond(404, {'message': 'Not found'})
+
+
+    def do_GET(self) -> None:
+        self._respond(200, self.server.stats())
+
+
+class StubAPI(ThreadingHTTPServer):
+    '''Local replacement of the REST API for load tests: every token is valid, and every registration gets a new
+    socket ID of the same organization (STUB_API_ORG). Point the Express API URL of the agents and brokers at it
+    (http://localhost:5000 outside production).'''
+    daemon_threads = True
+
+
+    def __init__(self, host: str = STUB_API_HOST, port: int = STUB_API_PORT) -> None:
+        super().__init__((host, port), StubHandler)
+        self.lock = Lock()
+        self.counts = {'authenticate': 0, 'register': 0, 'deregister': 0}
+
+
+    def count(self, endpoint: str) -> None:
+        with self.lock:
+            self.counts[endpoint] += 1
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counts)
+
+
+    def start(self) -> None:
+        '''Serve from a background thread.'''
+        Thread(target=self.serve_forever, daemon=True).start()
+
+
+    def __repr__(self) -> str:
+        return f'StubAPI("{self.server_address[0]}", {self.server_address[1]})'
+
+
+    def __str__(self) -> str:
+        return 'Stub of the REST API, for load tests'
+
+
+def main() -> None:
+    stub = StubAPI()
+    print(f'Stub API listening on {stub.server_address[0]}:{stub.server_address[1]}')
+    stub.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+import os
+import json
+import zlib
+import math
+import time
+import struct
+
+# Optional codecs and compressors, only offered during the handshake when installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Constants
+MAGIC = b'NA'
+VERSION = 1
+HEADER = struct.Struct('!2sBBBI') # magic, version, flags, codec id, payload length
+HEADER_SIZE = HEADER.size
+ROUTE_LENGTH = struct.Struct('!H')
+ROUTE_FIELD = struct.Struct('!BH') # field id, value length
+MAX_FRAME_SIZE = int(os.environ.get('SOCKET_MAX_FRAME_SIZE', 64 * 1024 * 1024))
+COMPRESSION_THRESHOLD = int(os.environ.get('SOCKET_COMPRESSION_THRESHOLD', 16384))
+ALLOW_LEGACY_FRAMING = os.environ.get('SOCKET_LEGACY_FRAMING', 'true').lower() in ('1', 'true', 'yes')
+
+# Flags
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+COMPRESSION_MASK = 0x03
+FLAG_ROUTED = 0x04
+
+# Routing fields, carried in the frame header so the server never has to decode the payload.
+# New fields are only ever appended, peers skip the field IDs they do not know.
+# "budget" is the time (seconds) the requestor still waits for the response when the frame is sent. Every hop turns it
+# into a deadline of its own clock on arrival, so the clocks of the hosts do not have to agree. "deadline" is no longer sent.
+ROUTE_FIELDS = ('action', 'from', 'to', 'correlationId', 'deadline', 'priority', 'trace', 'budget')
+ROUTE_FIELD_IDS = {field: field_id for field_id, field in enumerate(ROUTE_FIELDS, start=1)}
+
+
+def _json_dumps(message: dict) -> bytes:
+    return json.dumps(message).encode('utf-8')
+
+
+def _json_loads(payload) -> dict:
+    return json.loads(str(payload, 'utf-8'))
+
+
+def _zlib_decompress(payload) -> bytes:
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError('Decompressed frame is too large')
+    return data
+
+
+# Codecs: name -> (codec id, dumps, loads)
+CODECS = {'json': (1, _json_dumps, _json_loads)}
+if msgpack:
+    CODECS['msgpack'] = (2, lambda message: msgpack.packb(message, use_bin_type=True), lambda payload: msgpack.unpackb(payload, raw=False))
+if cbor2:
+    CODECS['cbor'] = (3, cbor2.dumps, lambda payload: cbor2.loads(bytes(payload)))
+CODEC_LOADERS = {codec_id: loads for codec_id, _, loads in CODECS.values()}
+CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+
+# Compressors: name -> (flag, compress, decompress)
+COMPRESSORS = {'zlib': (FLAG_ZLIB, lambda payload: zlib.compress(payload, 1), _zlib_decompress)}
+if zstandard:
+    COMPRESSORS['zstd'] = (
+        FLAG_ZSTD,
+        lambda payload: zstandard.ZstdCompressor(level=1).compress(payload),
+        lambda payload: zstandard.ZstdDecompressor().decompress(payload, max_output_size=MAX_FRAME_SIZE)
+    )
+DECOMPRESSORS = {flag: decompress for flag, _, decompress in COMPRESSORS.values()}
+COMPRESSION_NAMES = {flag: name for name, (flag, _, _) in COMPRESSORS.items()}
+
+
+def request_budget(seconds: float) -> str:
+    '''The "budget" routing field of a request that may wait "seconds" for its response.'''
+    return f'{max(seconds, 0):.3f}'
+
+
+def budget_deadline(budget, received: float = None) -> float:
+    '''The time.monotonic() deadline of a request from its "budget" routing field, counted from "received" (now by default).
+    None when there is no valid budget.'''
+    try:
+        seconds = float(budget)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(seconds):
+        return None
+    return (time.monotonic() if received is None else received) + max(seconds, 0)
+
+
+def request_key(message: dict) -> tuple:
+    '''Key of a request on its destination, (source socket ID, correlation id): every requestor picks its own
+    correlation ids, they are only unique along with its socket ID. None when the request has no correlation id.'''
+    correlation_id = message.get('correlationId')
+    return (message.get('from'), correlation_id) if correlation_id else None
+
+
+def supported_codecs() -> list:
+    '''Installed codecs, in order of preference.'''
+    return [codec for codec in ('msgpack', 'cbor', 'json') if codec in CODECS]
+
+
+def supported_compression() -> list:
+    '''Installed compressors, in order of preference.'''
+    return [compression for compression in ('zstd', 'zlib') if compression in COMPRESSORS]
+
+
+def handshake_offer() -> dict:
+    '''Fields appended to a "handshake" message, offering the binary framing to the server, and announcing that pings are answered.'''
+    return {
+        'framing': 'binary',
+        'codecs': supported_codecs(),
+        'compression': supported_compression(),
+        'heartbeat': True
+    }
+
+
+def negotiate(handshake: dict) -> tuple:
+    '''Pick the codec & compression for a connection, from the offer in its "handshake" message.'''
+    codec = next((codec for codec in handshake.get('codecs', []) if codec in CODECS), 'json')
+    compression = next((compression for compression in handshake.get('compression', []) if compression in COMPRESSORS), None)
+    return codec, compression
+
+
+def encode_route(route: dict) -> bytes:
+    '''Encode the routing fields as {FIELD_ID}{VALUE_LENGTH}{VALUE} items.'''
+    items = []
+    for field, value in route.items():
+        value = value.encode('utf-8')
+        items.append(ROUTE_FIELD.pack(ROUTE_FIELD_IDS[field], len(value)))
+        items.append(value)
+    return b''.join(items)
+
+
+def decode_route(data: memoryview) -> dict:
+    '''Decode the routing fields of a frame header.'''
+    route = {}
+    offset = 0
+    while offset < len(data):
+        field_id, value_length = ROUTE_FIELD.unpack_from(data, offset)
+        offset += ROUTE_FIELD.size
+        if 0 < field_id <= len(ROUTE_FIELDS):
+            route[ROUTE_FIELDS[field_id - 1]] = str(data[offset:offset + value_length], 'utf-8')
+        offset += value_length
+    return route
+
+
+def encode_frame(message: dict, codec: str = 'json', compression: str = None) -> bytes:
+    '''The function will make the message packet ready for sending across the channel, with a binary header.
+
+    Final message example:
+     - {MAGIC}{VERSION}{FLAGS}{CODEC}{LENGTH}{ROUTE_LENGTH}{ROUTE}{PAYLOAD}
+     - b'NA\\x01\\x04\\x01\\x00\\x00\\x00\\x0e\\x00\\x1d\\x01\\x00\\x07request...{"data": ...}'
+
+    The routing fields (action, from, to, correlationId, priority, trace, budget) are moved from the payload to the header.
+    Payloads above the compression threshold are compressed, if a compressor was negotiated.
+    '''
+    route = {field: message[field] for field in ROUTE_FIELDS if isinstance(message.get(field), str)}
+    codec_id, dumps, _ = CODECS[codec]
+    payload = dumps({key: value for key, value in message.items() if key not in route})
+    flags = FLAG_ROUTED
+    if compression and len(payload) >= COMPRESSION_THRESHOLD:
+        flag, compress, _ = COMPRESSORS[compression]
+        payload = compress(payload)
+        flags |= flag
+    route = encode_route(route)
+    return b''.join((HEADER.pack(MAGIC, VERSION, flags, codec_id, len(payload)), ROUTE_LENGTH.pack(len(route)), route, payload))
+
+
+def decode_frame(frame) -> dict:
+    '''Decode a frame received by a "FrameReader" (utils.frame_reader) into a message.'''
+    if not frame.binary:
+        return json.loads(str(frame.payload, 'utf-8'))
+
+    payload = frame.payload
+    compression = frame.flags & COMPRESSION_MASK
+    if compression:
+        payload = DECOMPRESSORS[compression](payload)
+    message = CODEC_LOADERS[frame.codec](payload)
+    if frame.route:
+        message.update(frame.route)
+    return message
@@ -0,0 +1,237 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+
+# Constants
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Metric:
+    '''Base of the metrics: a value per combination of label values, updated under a lock held for a few instructions.'''
+    # Constants
+    TYPE = ''
+
+    # Variables
+    name = ''
+    help = ''
+    label_names = ()
+
+
+    def __init__(self, name: str, help: str, label_names: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = Lock()
+        self.values = {} # label values -> value
+
+
+    def samples(self) -> list:
+        '''(suffix, label values, value) of every sample, for the export.'''
+        with self.lock:
+            return [('', labels, value) for labels, value in self.values.items()]
+
+
+    def snapshot(self) -> dict:
+        return {
+            'type': self.TYPE,
+            'help': self.help,
+            'values': [
+                {'labels': dict(zip(self.label_names, labels)), 'value': value}
+                for _, labels, value in self.samples()
+            ]
+        }
+
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}("{self.name}")'
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    '''A value set by the code, or read from "function" at export time, e.g. the length of a queue.'''
+    TYPE = 'gauge'
+
+
+    def __init__(self, name: str, help: str, label_names: tuple = (), function=None) -> None:
+        super().__init__(name, help, label_names)
+        self.function = function
+
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+    def dec(self, amount: float = 1, labels: tuple = ()) -> None:
+        self.inc(-amount, labels)
+
+
+    def samples(self) -> list:
+        if self.function is None:
+            return super().samples()
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        # Functions of labelled gauges return {label values: value}
+        if isinstance(value, dict):
+            return [('', labels, sample) for labels, sample in value.items()]
+        return [('', (), value)]
+
+
+class Histogram(Metric):
+    '''Observations counted in fixed buckets, with their sum and count, e.g. latencies in seconds.'''
+    TYPE = 'histogram'
+
+
+    def __init__(self, name: str, help: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0] # bucket counts, +Inf, sum
+            counts[index] += 1
+            counts[-1] += value
+
+
+    def time(self, labels: tuple = ()):
+        '''Observe the duration of a "with" block.'''
+        return Timer(self, labels)
+
+
+    def samples(self) -> list:
+        with self.lock:
+            values = {labels: list(counts) for labels, counts in self.values.items()}
+
+        samples = []
+        for labels, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append(('_bucket', labels + (str(bound),), cumulative))
+            samples.append(('_sum', labels, counts[-1]))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            values = {labels: list(counts) for labels, counts in self.values.items()}
+        return {
+            'type': self.TYPE,
+            'help': self.help,
+            'buckets': list(self.buckets),
+            'values': [
+                {'labels': dict(zip(self.label_names, labels)), 'counts': counts[:-1], 'sum': counts[-1], 'count': sum(counts[:-1])}
+                for labels, counts in values.items()
+            ]
+        }
+
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+
+    def __init__(self, histogram: Histogram, labels: tuple) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class Registry:
+    '''The metrics of the process, exported in the Prometheus text format, or as a dict for the "stats" actions.'''
+    # Variables
+    metrics = {}
+
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.metrics = {} # name -> Metric
+
+
+    def _register(self, metric: Metric) -> Metric:
+        with self.lock:
+            # Modules imported twice, or several servers in a process, share their metrics
+            return self.metrics.setdefault(metric.name, metric)
+
+
+    def counter(self, name: str, help: str, label_names: tuple = ()) -> Counter:
+        return self._register(Counter(name, help, label_names))
+
+
+    def gauge(self, name: str, help: str, label_names: tuple = (), function=None) -> Gauge:
+        gauge = self._register(Gauge(name, help, label_names, function))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+
+    def histogram(self, name: str, help: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, label_names, buckets))
+
+
+    def render(self) -> str:
+        '''Prometheus text exposition format.'''
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            label_names = metric.label_names + (('le',) if metric.TYPE == 'histogram' else ())
+            for suffix, labels, value in metric.samples():
+                names = label_names if suffix == '_bucket' else metric.label_names
+                rendered = ','.join(f'{name}="{_escape(label)}"' for name, label in zip(names, labels))
+                lines.append(f'{metric.name}{suffix}{{{rendered}}} {value}' if rendered else f'{metric.name}{suffix} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+    def __len__(self) -> int:
+        return len(self.metrics)
+
+
+    def __repr__(self) -> str:
+        return 'Registry()'
+
+
+    def __str__(self) -> str:
+        return 'Metrics of the process'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# The registry of the process
+metrics = Registry()
@@ -1,10 +1,24 @@
 import os
 from utils.chalk import log
 
+def _recv_exactly(client_socket, length: int) -> bytearray:
+    '''Receive exactly "length" bytes, across as many TLS records as needed. Returns None if the socket closed.'''
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
+        chunk = client_socket.recv_into(view[received:], length - received)
+        if not chunk:
+            return None
+        received += chunk
+    return data
+
+
 def receive_message(client_socket, header_length: int) -> dict:
-    '''Receive messages.
+    '''Receive messages from a blocking socket.
 
     Data will be received in the format: {MESSAGE_HEADER}{MESSAGE}
+    Long-lived sockets, and non-blocking sockets, should keep a "FrameReader" (utils.frame_reader) instead.
 
     Will return False if:
     - Script error
@@ -13,23 +27,27 @@ def receive_message(client_socket, header_length: int) -> dict:
     Otherwise a dictionary object will be returned as such:
     {
         "header": message_header,
-        "payload": client_socket.recv(message_length)
+        "payload": message
     }
     '''
     try:
-        message_header = client_socket.recv(header_length)
+        message_header = _recv_exactly(client_socket, header_length)
 
         # If we didn't receive a message. Or socket closed the connection
-        if not len(message_header):
+        if not message_header:
+            return False
+
+        message_length = int(message_header)
+        payload = _recv_exactly(client_socket, message_length)
+        if payload is None:
             return False
 
-        message_length = int(message_header.decode('utf-8').strip())
         message = {
-            'header': message_header,
-            'payload': client_socket.recv(message_length).decode('utf-8')
+            'header': bytes(message_header),
+            'payload': payload.decode('utf-8')
         }
         return message
 
     except Exception as ex:
         log(f'General error [3310] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
-        return False
\ No newline at end of file
+        return False
@@ -1,5 +1,5 @@
 import os
-import requests
+from utils.http_client import http_client
 from utils.chalk import log
 from utils.resolve_env import resolve_express_api
 
@@ -17,7 +17,7 @@ def register_socket(token: str, socket_type: str) -> dict:
         body = {
             'type': socket_type
         }
-        response = requests.post(url=f'{HOST}{ENDPOINT}', headers=headers, json=body)
+        response = http_client.post(url=f'{HOST}{ENDPOINT}', headers=headers, json=body)
         return {
             'isError': False if response.status_code == 201 else True,
             'message': response.json()['message'],
@@ -29,6 +29,17 @@ def register_socket(token: str, socket_type: str) -> dict:
         return {'isError': True, 'message': 'Failed to register the socket'}
 
 
+def socket_tenant(response: dict) -> str:
+    '''The tenant of a registered socket: the organization owning it, as recorded by the REST API.
+    Agents and brokers of the same account get the same tenant, whatever session token they registered with.
+    None if the REST API did not return it.'''
+    socket = response['data']['socket']
+    tenant = socket.get('org') or socket.get('organization')
+    if isinstance(tenant, dict):
+        tenant = tenant.get('_id')
+    return str(tenant) if tenant else None
+
+
 def deregister_socket(token: str, socket_id: str) -> dict:
     '''Delete the socketId from the database.''' 
     ENDPOINT=f'/api/socket/{socket_id}'
@@ -40,7 +51,7 @@ def deregister_socket(token: str, socket_id: str) -> dict:
             'Accept': 'application/json',
             'Authorization': f'Bearer {token}'
         }
-        response = requests.delete(url=f'{HOST}{ENDPOINT}', headers=headers)
+        response = http_client.delete(url=f'{HOST}{ENDPOINT}', headers=headers)
         return {
             'isError': False if response.status_code == 200 else True,
             'message': response.json()['message'],
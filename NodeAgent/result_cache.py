@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from utils.security import token_digest
+from utils.message_codec import request_key
+
+# Constants
+AGENT_RESULT_CACHE_SIZE = int(os.environ.get('AGENT_RESULT_CACHE_SIZE', 1024))
+AGENT_RESULT_CACHE_TTL = float(os.environ.get('AGENT_RESULT_CACHE_TTL', 10))
+
+def cache_key(message: dict) -> str:
+    '''Key of the result of a request, or None when the result must not be shared:
+     - "idempotencyKey": a key supplied by the caller, scoped to its token
+     - "cache": true, for read-only tasks: a hash of the canonical "data" payload, shared by every caller
+    Requests with "cache": "bypass", and streamed requests, always run on their own.
+    '''
+    if message.get('cache') == 'bypass' or message.get('stream'):
+        return None
+    if message.get('idempotencyKey'):
+        return f'key:{token_digest(message.get("token", ""))}:{message["idempotencyKey"]}'
+    if message.get('cache'):
+        payload = json.dumps(message.get('data'), sort_keys=True, separators=(',', ':'), default=str)
+        return f'data:{hashlib.sha256(payload.encode("utf-8")).hexdigest()}'
+    return None
+
+
+class Execution:
+    '''A task run on behalf of every request with the same key. "request_key" is the one it was submitted with,
+    "context" its TaskContext, whose deadline is pushed back to the latest deadline of the requests awaiting it.'''
+    __slots__ = ('key', 'request_key', 'members', 'context')
+
+
+    def __init__(self, key: str, request_key: tuple, message: dict) -> None:
+        self.key = key
+        self.request_key = request_key
+        self.members = [message] # requests awaiting the result
+        self.context = None
+
+
+    def __repr__(self) -> str:
+        return f'Execution("{self.key}", {self.request_key}, {len(self.members)})'
+
+
+class ResultCache:
+    '''Results of the tasks of the agent, by key, for "ttl" seconds. At most "size" results are kept,
+    the least recently used one is dropped first. Only successful results are kept.
+
+    Identical requests received while the task runs join its execution ("coalesced"), instead of running
+    it again, and all get its result. A request with "cache": "invalidate" drops the result first.
+    The cache is shared by the event loop, which joins the requests, and the task workers, which complete them.
+    '''
+    # Constants
+    SIZE = 0
+    TTL = 0
+
+    # Variables
+    entries = None
+    running = None
+
+
+    def __init__(self, size: int = AGENT_RESULT_CACHE_SIZE, ttl: float = AGENT_RESULT_CACHE_TTL) -> None:
+        self.SIZE = max(size, 1)
+        self.TTL = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict() # key -> (result, expiry)
+        self.running = {}            # key -> Execution in progress
+        self.members = {}            # (source socket ID, correlation id) -> Execution it joined
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+
+    def join(self, key: str, message: dict, deadline: float = None) -> dict:
+        '''Look up the result of the request:
+         - "result": the cached result
+         - "coalesced": the request joined the execution in progress, it gets the result once it ends
+         - "execution": the request runs the task, which has to be completed with "complete()"
+        '''
+        member_key = request_key(message)
+        with self.lock:
+            if message.get('cache') == 'invalidate':
+                self.entries.pop(key, None)
+
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return {'isError': False, 'result': entry[0]}
+                del self.entries[key]
+
+            execution = self.running.get(key)
+            if execution is not None:
+                execution.members.append(message)
+                context = execution.context
+                if context is not None and context.deadline is not None:
+                    context.deadline = None if deadline is None else max(context.deadline, deadline)
+                if member_key:
+                    self.members[member_key] = execution
+                self.coalesced += 1
+                return {'isError': False, 'coalesced': True}
+
+            execution = self.running[key] = Execution(key, member_key, message)
+            if member_key:
+                self.members[member_key] = execution
+            self.misses += 1
+            return {'isError': False, 'execution': execution}
+
+
+    def leave(self, member_key: tuple) -> dict:
+        '''A request, by its "request_key()", stopped waiting. Once no request awaits an execution, it is detached so
+        that it can be cancelled: "cancel" then holds the request key it was submitted with.'''
+        with self.lock:
+            execution = self.members.pop(member_key, None)
+            if execution is None:
+                return {'isError': True, 'message': 'Request is not awaiting a shared execution'}
+
+            execution.members = [member for member in execution.members if request_key(member) != member_key]
+            if execution.members:
+                return {'isError': False, 'cancel': None}
+            if self.running.get(execution.key) is execution:
+                del self.running[execution.key]
+            return {'isError': False, 'cancel': execution.request_key}
+
+
+    def complete(self, execution: Execution, result: dict) -> list:
+        '''End the execution and keep its result if it succeeded. Returns the requests awaiting the result.'''
+        with self.lock:
+            if self.running.get(execution.key) is execution:
+                del self.running[execution.key]
+            for member in execution.members:
+                self.members.pop(request_key(member), None)
+
+            if isinstance(result, dict) and not result.get('isError') and not result.get('streamed'):
+                self.entries[execution.key] = (result, time.monotonic() + self.TTL)
+                self.entries.move_to_end(execution.key)
+                while len(self.entries) > self.SIZE:
+                    self.entries.popitem(last=False)
+            return execution.members
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'running': len(self.running),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced
+            }
+
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+    def __repr__(self) -> str:
+        return f'ResultCache({self.SIZE}, {self.TTL})'
+
+
+    def __str__(self) -> str:
+        return 'Results of the tasks of the agent, shared by identical requests'
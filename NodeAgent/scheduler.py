@@ -0,0 +1,168 @@
+import os
+import heapq
+
+# Constants
+SERVER_AGENT_WINDOW = int(os.environ.get('SERVER_AGENT_WINDOW', 32))
+SERVER_AGENT_QUEUE = int(os.environ.get('SERVER_AGENT_QUEUE', 1024))
+SERVER_PRIORITY_WEIGHTS = os.environ.get('SERVER_PRIORITY_WEIGHTS', 'interactive:8,bulk:1')
+DEFAULT_PRIORITY = 'interactive'
+
+def parse_weights(weights: str) -> dict:
+    '''"interactive:8,bulk:1" -> {'interactive': 8.0, 'bulk': 1.0}'''
+    parsed = {}
+    for item in weights.split(','):
+        if ':' in item:
+            priority, weight = item.split(':', 1)
+            parsed[priority.strip()] = max(float(weight), 0.01)
+    return parsed or {DEFAULT_PRIORITY: 1.0}
+
+
+class AgentQueue:
+    '''Requests to one agent: the ones sent and not answered yet ("in_flight"), and the ones waiting for room.
+
+    Waiting requests are ordered by weighted fair queueing. A flow is a priority class and a source (broker
+    socket ID, i.e. a token), and each request of a flow gets a virtual finish time 1 / weight after the previous
+    one of the flow. The request finishing first is sent first: sources are interleaved, and interactive requests
+    overtake bulk ones without starving them.
+    '''
+    __slots__ = ('in_flight', 'heap', 'finish', 'queued', 'virtual_time', 'sequence')
+
+
+    def __init__(self) -> None:
+        self.in_flight = set()
+        self.heap = []         # (virtual finish time, sequence, request key, frame)
+        self.finish = {}       # flow -> virtual finish time of its last request
+        self.queued = {}       # request key -> flow, of the waiting requests
+        self.virtual_time = 0  # virtual finish time of the last request sent
+        self.sequence = 0      # first come, first served among equal finish times
+
+
+    def push(self, flow: tuple, weight: float, key: tuple, frame) -> None:
+        finish = max(self.virtual_time, self.finish.get(flow, 0)) + 1 / weight
+        self.finish[flow] = finish
+        self.sequence += 1
+        heapq.heappush(self.heap, (finish, self.sequence, key, frame))
+        self.queued[key] = flow
+
+
+    def pop(self) -> tuple:
+        '''The next request to send, (request key, frame), or None. Requests removed from "queued" are skipped.'''
+        while self.heap:
+            finish, _, key, frame = heapq.heappop(self.heap)
+            if self.queued.pop(key, None) is None:
+                continue
+            self.virtual_time = finish
+            if not self.queued:
+                self.reset()
+            return key, frame
+        return None
+
+
+    def reset(self) -> None:
+        '''Nothing is waiting anymore, every flow starts afresh.'''
+        self.heap = []
+        self.finish = {}
+        self.virtual_time = 0
+
+
+    def __len__(self) -> int:
+        return len(self.queued)
+
+
+class Scheduler:
+    '''Admission of the requests to the agents attached to the server.
+
+    At most "window" requests per agent are in flight, the following ones wait in the queue of the agent
+    (at most "queue_size", the requestor is answered "busy" beyond that). Every response, cancel or expiry
+    of a request releases its slot, and the next waiting requests are returned to be sent.
+    The message field "priority" selects the class of a request, "interactive" (default) or "bulk".
+    A window of 0 disables the scheduler, every request is sent straight away.
+    '''
+    # Constants
+    WINDOW = 0
+    QUEUE_SIZE = 0
+
+    # Variables
+    agents = {}
+
+
+    def __init__(self, window: int = SERVER_AGENT_WINDOW, queue_size: int = SERVER_AGENT_QUEUE, weights: str = SERVER_PRIORITY_WEIGHTS) -> None:
+        self.WINDOW = window
+        self.QUEUE_SIZE = queue_size
+        self.weights = parse_weights(weights)
+        self.agents = {} # agent connection -> AgentQueue
+
+
+    def submit(self, destination, key: tuple, priority: str, source: str, frame) -> str:
+        '''Admit a request to the agent: "send" it now, or it was "queued", or the queue is "full".
+        Queued frames are copied, as the frames of a reader are only valid until its next read.'''
+        if not self.WINDOW:
+            return 'send'
+
+        agent = self.agents.get(destination)
+        if agent is None:
+            agent = self.agents[destination] = AgentQueue()
+        if len(agent.in_flight) < self.WINDOW and not agent.queued:
+            agent.in_flight.add(key)
+            return 'send'
+        if len(agent.queued) >= self.QUEUE_SIZE:
+            return 'full'
+
+        priority = priority if priority in self.weights else DEFAULT_PRIORITY
+        agent.push((priority, source), self.weights.get(priority, 1), key, frame.detach())
+        return 'queued'
+
+
+    def release(self, destination, key: tuple) -> list:
+        '''The request was answered, cancelled or expired. Returns the (request key, frame) to send in its place.'''
+        agent = self.agents.get(destination)
+        if agent is None:
+            return []
+
+        # A waiting request leaves the queue, without freeing any room
+        if agent.queued.pop(key, None) is not None:
+            if not agent.queued:
+                agent.reset()
+            if not agent.in_flight and not agent.queued:
+                del self.agents[destination]
+            return []
+        if key not in agent.in_flight:
+            return []
+        agent.in_flight.discard(key)
+
+        ready = []
+        while len(agent.in_flight) < self.WINDOW:
+            item = agent.pop()
+            if item is None:
+                break
+            agent.in_flight.add(item[0])
+            ready.append(item)
+
+        if not agent.in_flight and not agent.queued:
+            del self.agents[destination]
+        return ready
+
+
+    def forget(self, destination) -> None:
+        '''The agent disconnected, its requests are failed by the server.'''
+        self.agents.pop(destination, None)
+
+
+    def stats(self) -> dict:
+        return {
+            'agents': len(self.agents),
+            'inFlight': sum(len(agent.in_flight) for agent in self.agents.values()),
+            'queued': sum(len(agent.queued) for agent in self.agents.values())
+        }
+
+
+    def __len__(self) -> int:
+        return len(self.agents)
+
+
+    def __repr__(self) -> str:
+        return f'Scheduler({self.WINDOW}, {self.QUEUE_SIZE})'
+
+
+    def __str__(self) -> str:
+        return 'Per-agent request windows, with weighted fair queueing'
@@ -1,10 +1,29 @@
 import os
 import time
 import ssl
-import requests
+import errno
+import socket
+import hashlib
+from threading import Lock
+from utils.http_client import http_client
 from utils.chalk import log
 from utils.resolve_env import resolve_express_api
 
+# Constants
+CERTS_PATH = os.path.dirname(os.path.abspath(__file__)).replace('utils', 'certs')
+CERT_FILES = {
+    'server': (f'{CERTS_PATH}/ca/ca-cert.pem', f'{CERTS_PATH}/server/server-cert.pem', f'{CERTS_PATH}/server/server-key.pem'),
+    'client': (f'{CERTS_PATH}/ca/ca-cert.pem', f'{CERTS_PATH}/client/client-cert.pem', f'{CERTS_PATH}/client/client-key.pem')
+}
+CERT_CHECK_INTERVAL = float(os.environ.get('SSL_CERT_CHECK_INTERVAL', 5))
+
+# Process-wide contexts: side -> (certificate mtimes, last check, context)
+_contexts = {}
+# TLS sessions of the client context, kept for resumption: (context id, address) -> session
+_sessions = {}
+_lock = Lock()
+
+
 def authenticate(email: str, password: str) -> dict: 
     '''Function for authenticating the JWT Bearer Token with the backend HTTP REST API. 
         - Default URL: https://nodeconfig.com if running in production, or else http://localhost:5000.
@@ -27,7 +46,7 @@ def authenticate(email: str, password: str) -> dict:
             'username': 'nodeconfig-authenticator'
         }
         log(f'Socket: Making request to {HOST}{ENDPOINT}', 'warning')
-        response = requests.post(url=f'{HOST}{ENDPOINT}', headers=headers, json=body)
+        response = http_client.post(url=f'{HOST}{ENDPOINT}', headers=headers, json=body)
 
         # If org does not exist, then the authentication failed
         log('Socket: Request successful', 'success')
@@ -42,20 +61,62 @@ def authenticate(email: str, password: str) -> dict:
         return {'isError': True, 'message': 'Agent Error', 'error': ex}
 
 
+def token_digest(token: str) -> str:
+    '''Identify the tenant of a token, without handing the token itself to the socket server.'''
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
+
+def _build_context(side: str) -> ssl.SSLContext:
+    ca_file, cert_file, key_file = CERT_FILES[side]
+    if side == 'server':
+        context                     = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    else:
+        context                     = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname      = False
+    context.verify_mode             = ssl.CERT_REQUIRED
+    # TLS 1.2, as before. Its sessions can be resumed as soon as the handshake is done
+    context.minimum_version         = ssl.TLSVersion.TLSv1_2
+    context.maximum_version         = ssl.TLSVersion.TLSv1_2
+
+    context.load_verify_locations(ca_file)
+    context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+    return context
+
+
+def get_context(side: str) -> ssl.SSLContext:
+    '''The shared SSL context of the process, for the "server" or the "client" side.
+    The PEM files are loaded once, and loaded again when one of them changes on disk.'''
+    now = time.monotonic()
+    cached = _contexts.get(side)
+    if cached and now - cached[1] < CERT_CHECK_INTERVAL:
+        return cached[2]
+
+    with _lock:
+        cached = _contexts.get(side)
+        mtimes = tuple(os.stat(path).st_mtime_ns for path in CERT_FILES[side])
+        if cached and cached[0] == mtimes:
+            _contexts[side] = (mtimes, now, cached[2])
+            return cached[2]
+
+        context = _build_context(side)
+        if cached:
+            log(f'Socket: Reloaded the {side} certificates', 'warning')
+            # Sessions can only be resumed with the context that created them
+            for key in [key for key in _sessions if key[0] == id(cached[2])]:
+                del _sessions[key]
+        _contexts[side] = (mtimes, now, context)
+        return context
+
+
 class SSL:
-    def ssl_wrap_socket(self, naked_socket) -> dict:
-        '''Wrap socket with SSL.'''
+    def ssl_wrap_socket(self, naked_socket, do_handshake_on_connect: bool = True) -> dict:
+        '''Wrap socket with SSL. Non-blocking sockets should set "do_handshake_on_connect" to False, and call "do_handshake()" when ready.'''
         try:
-            # Wrap the socket with SSL
-            certs_path = os.path.dirname(os.path.abspath(__file__)).replace('utils', 'certs')
-            client_socket = ssl.wrap_socket(
+            # Wrap the socket with the shared server context
+            client_socket = get_context('server').wrap_socket(
                 naked_socket,
-                ca_certs=f'{certs_path}/ca/ca-cert.pem',
-                certfile=f'{certs_path}/server/server-cert.pem',
-                keyfile=f'{certs_path}/server/server-key.pem',
                 server_side=True,
-                cert_reqs=ssl.CERT_REQUIRED,
-                ssl_version=ssl.PROTOCOL_TLSv1_2
+                do_handshake_on_connect=do_handshake_on_connect
             )
             return {'isError': False, 'socket': client_socket}
 
@@ -69,25 +130,61 @@ class SSL:
 
 
     def create_context(self) -> dict:
-        '''Create an SSL context with the client certificate and private key.'''
+        '''Return the shared SSL context with the client certificate and private key.'''
         try:
-            # Create SSL Context
-            context                         = ssl.SSLContext()
-            context.verify_mode             = ssl.CERT_REQUIRED
-            
-            certs_path = os.path.dirname(os.path.abspath(__file__)).replace('utils', 'certs')
-            context.load_verify_locations(f'{certs_path}/ca/ca-cert.pem')
-            context.load_cert_chain(
-                certfile=f'{certs_path}/client/client-cert.pem',
-                keyfile=f'{certs_path}/client/client-key.pem'
-            )
-            return {'isError': False, 'context': context}
+            return {'isError': False, 'context': get_context('client')}
 
         except Exception as ex:
             log(f'General error [9129] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
             return {'isError': True, 'message': 'SSL context creation failed'}
 
 
+    def ssl_connect(self, address: tuple) -> dict:
+        '''Connect an SSL client socket to the address, resuming the last TLS session with it when possible.'''
+        try:
+            context = get_context('client')
+            key = (id(context), address)
+            naked_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket = context.wrap_socket(naked_socket, session=_sessions.get(key))
+            client_socket.connect(address)
+
+            if client_socket.session_reused:
+                log('Socket: TLS session resumed', 'notification')
+            _sessions[key] = client_socket.session
+            return {'isError': False, 'socket': client_socket}
+
+        except Exception as ex:
+            log(f'General error [4417] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            return {'isError': True, 'message': 'SSL connection failed'}
+
+
+    def ssl_connect_nonblocking(self, address: tuple) -> dict:
+        '''Start connecting a non-blocking SSL client socket to the address, for an event loop: once the socket is
+        writable, check "SO_ERROR", call "do_handshake()" until it succeeds, then "save_session()".'''
+        try:
+            context = get_context('client')
+            naked_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            naked_socket.setblocking(False)
+            client_socket = context.wrap_socket(naked_socket, do_handshake_on_connect=False, session=_sessions.get((id(context), address)))
+            error = client_socket.connect_ex(address)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                client_socket.close()
+                log(f'Socket: Could not connect to {address[0]}:{address[1]}: {os.strerror(error)}', 'danger')
+                return {'isError': True, 'message': 'SSL connection failed'}
+            return {'isError': False, 'socket': client_socket}
+
+        except Exception as ex:
+            log(f'General error [8143] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            return {'isError': True, 'message': 'SSL connection failed'}
+
+
+    def save_session(self, client_socket: ssl.SSLSocket, address: tuple) -> None:
+        '''Keep the TLS session of a client socket connected with "ssl_connect_nonblocking()", to resume it next time.'''
+        if client_socket.session_reused:
+            log('Socket: TLS session resumed', 'notification')
+        _sessions[(id(client_socket.context), address)] = client_socket.session
+
+
     def validate_cert(self, cert: dict) -> dict:
         '''Validates peer SSL/TLS certificate:
             - Checks if certificate exists
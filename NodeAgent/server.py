@@ -1,10 +1,22 @@
 import sys
 import os
+import signal
 import socket
-import select
+import selectors
+import ssl
 import json
-from utils.receive_message import receive_message
-from utils.cache import Cache
+import time
+import heapq
+from utils.cache import Cache, SOCKET_REGISTRY_SNAPSHOT
+from utils.scheduler import Scheduler
+from utils.timer_wheel import TimerWheel
+from utils.metrics import metrics
+from utils.tracing import add_hop
+from utils.cluster import Directory, CLUSTER_DIRECTORY, CLUSTER_NODE_ID, CLUSTER_ADVERTISE_HOST
+from utils.frame_reader import FrameReader, Frame
+from utils.write_buffer import WriteBuffer
+from utils.message_codec import \
+    encode_frame, decode_frame, negotiate, handshake_offer, budget_deadline, request_budget, CODECS, COMPRESSORS, CODEC_NAMES, COMPRESSION_NAMES, COMPRESSION_MASK
 from utils.security import SSL
 from utils.encode_message import encode_message
 from utils.chalk import log
@@ -14,6 +26,80 @@ from utils.resolve_env import resolve_socket_port, resolve_socket_header_length
 HEADER_LENGTH = resolve_socket_header_length()
 IP = '0.0.0.0'
 PORT = resolve_socket_port()
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 1))
+REQUEST_DEADLINE_GRACE = float(os.environ.get('REQUEST_DEADLINE_GRACE', 1))
+SERVER_PING_INTERVAL = float(os.environ.get('SERVER_PING_INTERVAL', 30))
+SERVER_PONG_TIMEOUT = float(os.environ.get('SERVER_PONG_TIMEOUT', 10))
+SERVER_HANDSHAKE_TIMEOUT = float(os.environ.get('SERVER_HANDSHAKE_TIMEOUT', 10))
+SERVER_KEEPALIVE_IDLE = int(os.environ.get('SERVER_KEEPALIVE_IDLE', 60))
+CLUSTER_CONNECT_TIMEOUT = float(os.environ.get('CLUSTER_CONNECT_TIMEOUT', 2))
+
+# Metrics
+CONNECTIONS_ACCEPTED = metrics.counter('relay_connections_accepted_total', 'Connections accepted by the relay')
+TLS_HANDSHAKE_SECONDS = metrics.histogram('relay_tls_handshake_seconds', 'Time from the accept of a connection to its validated TLS handshake')
+MESSAGES_RECEIVED = metrics.counter('relay_messages_received_total', 'Messages received by the relay', ('action',))
+BYTES_RECEIVED = metrics.counter('relay_received_bytes_total', 'Bytes of the messages received by the relay')
+BYTES_SENT = metrics.counter('relay_sent_bytes_total', 'Bytes written by the relay')
+REQUEST_SECONDS = metrics.histogram('relay_request_seconds', 'Time from a request received by the relay to its response, failure or cancel', ('outcome',))
+REQUESTS_REJECTED = metrics.counter('relay_requests_rejected_total', 'Requests the relay answered itself', ('reason',))
+CONNECTIONS_TIMED_OUT = metrics.counter('relay_connections_timed_out_total', 'Connections closed by the relay for not completing their TLS handshake, or not answering a ping', ('reason',))
+
+class Connection:
+    '''State of a single client connection, owned by the event loop.'''
+    # Variables
+    client_socket = None
+    client_address = None
+    handshaking = True
+    connecting = False # outbound link waiting for its TCP connect, before its TLS handshake
+    closed = False
+    paused = 0
+    persistent = False
+    node = False   # inter-node link of a cluster
+    worker = False # link to another worker process of the same node
+    socket_id = ''
+    binary = True
+    codec = 'json'
+    compression = None
+    accepted = 0
+    last_seen = 0   # time.monotonic() of the last data received
+    pinged = None   # time.monotonic() of the ping awaiting an answer
+    heartbeat = False # the client answers pings
+
+
+    def __init__(self, client_socket: ssl.SSLSocket, client_address: tuple, header_length: int) -> None:
+        self.client_socket = client_socket
+        self.client_address = client_address
+        self.accepted = time.monotonic()
+        self.last_seen = self.accepted
+        self.socket_ids = set()
+        self.codecs = {'json'}
+        self.compressions = set()
+        self.reader = FrameReader(header_length)
+        self.writer = WriteBuffer()
+        self.blocked = set() # connections paused until this one drains its outbound buffer
+        self.in_flight = set() # keys of the requests sent or received by the connection, see InFlight
+
+
+    def __repr__(self) -> str:
+        return f'Connection({self.client_address[0]}:{self.client_address[1]}, "{self.socket_id}")'
+
+
+class InFlight:
+    '''A request forwarded by the server, until it is answered, cancelled or expired.
+    Requests are keyed by (source socket ID, correlation id), as every requestor picks its own correlation ids.'''
+    __slots__ = ('key', 'correlation_id', 'source_id', 'source', 'destination_id', 'destination', 'deadline', 'started')
+
+
+    def __init__(self, correlation_id: str, source_id: str, source: Connection, destination_id: str, destination: Connection, deadline: float) -> None:
+        self.key = (source_id, correlation_id)
+        self.correlation_id = correlation_id
+        self.source_id = source_id
+        self.source = source
+        self.destination_id = destination_id
+        self.destination = destination
+        self.deadline = deadline
+        self.started = time.monotonic()
+
 
 class Server:
     # Constants
@@ -23,31 +109,64 @@ class Server:
 
     # Variables
     cache = None
+    cluster = None
     server_socket = None
-    sockets_list = []
-    socket_mapping = {}
+    selector = None
+    links = {}
+    worker_id = None
+    worker_links = {}
+    worker_routes = {}
+    worker_agents = {}
+    requests = {}
+    deadlines = []
 
 
-    def __init__(self, header_length: int, ip: str, port: int) -> None:
+    def __init__(self, header_length: int, ip: str, port: int, worker_id: int = None, worker_links: dict = None) -> None:
         '''The __init__ constructor will:
             - Create a socket (socket server)
-            - Append the server socket to the "sockets_list" (self.sockets_list) list
+            - Register the server socket with the event loop selector (self.selector)
+
+        Worker processes ("worker_id") share the listening port, and reach each other with "worker_links":
+        the other worker ID -> the Unix domain socket connected to it.
         '''
         try:
             self.HEADER_LENGTH = header_length
             self.IP = ip
             self.PORT = port
+            self.worker_id = worker_id
+            self.worker_links = {}  # worker ID -> link to the worker
+            self.worker_routes = {} # socket ID -> link to the worker holding it
+            self.worker_agents = {} # socket ID -> (tenant, tags) of the agents held by the other workers
+            self.requests = {}      # (source socket ID, correlation id) -> InFlight
+            self.deadlines = []     # heap of (deadline, correlation id), of the requests received from clients
 
-            # Create the caching database
-            cache = Cache()
-            cache.create_db()
+            # Create the socket registry, warm from the last snapshot if there is one
+            snapshot_path = SOCKET_REGISTRY_SNAPSHOT
+            if snapshot_path and worker_id is not None:
+                snapshot_path = f'{snapshot_path}.{worker_id}'
+            cache = Cache(snapshot_path)
+            cache.load_snapshot()
+            cache.start_snapshots()
             self.cache = cache
+            self.scheduler = Scheduler()
+            self.timers = TimerWheel() # connection -> its handshake or heartbeat timer
+            self._register_gauges()
+
+            # Join the cluster, when the relay runs on several nodes
+            self.links = {}
+            if CLUSTER_DIRECTORY:
+                node_id = CLUSTER_NODE_ID if worker_id is None else f'{CLUSTER_NODE_ID}-{worker_id}'
+                self.cluster = Directory(CLUSTER_DIRECTORY, node_id, CLUSTER_ADVERTISE_HOST, self.PORT)
+                self.cluster.start()
 
             # Create the socket
             self.server_socket = self._create_socket()
-            self.sockets_list.append(self.server_socket)
-            log(f'Listening for connections on {self.IP}:{self.PORT}', 'notification') 
-        
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+            for peer_id, worker_socket in (worker_links or {}).items():
+                self._add_worker_link(peer_id, worker_socket)
+            log(f'Listening for connections on {self.IP}:{self.PORT}' + (f' (worker {worker_id})' if worker_id is not None else ''), 'notification')
+
         except Exception as ex:
             log(f'General error [3447] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
             sys.exit()
@@ -59,86 +178,339 @@ class Server:
             # Create the socket
             server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.worker_id is not None:
+                # Every worker listens on the same port, the kernel spreads the new connections
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
             # Bind & Listen
             server_socket.bind((self.IP, self.PORT))
-            server_socket.listen(30)
+            server_socket.listen(1024)
+            server_socket.setblocking(False)
             return server_socket
-        
+
         except Exception as ex:
             log(f'General error [5861] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
             sys.exit()
 
 
-    def _send_message(self, message, client_socket: socket.socket) -> bool:
+    def _add_worker_link(self, peer_id: int, worker_socket: socket.socket) -> None:
+        '''Watch the Unix domain socket to another worker. Both ends run the same relay, no handshake is needed.'''
+        worker_socket.setblocking(False)
+        link = Connection(worker_socket, ('worker', peer_id), self.HEADER_LENGTH)
+        link.handshaking = False
+        link.persistent = True
+        link.worker = True
+        link.socket_id = f'worker-{peer_id}'
+        link.codec, link.compression = negotiate(handshake_offer())
+        link.codecs = set(CODECS)
+        link.compressions = set(COMPRESSORS)
+        self.selector.register(worker_socket, selectors.EVENT_READ, link)
+        self.worker_links[peer_id] = link
+
+
+    def _announce(self, action: str, socket_id: str, tenant: str = None, tags: tuple = ()) -> None:
+        '''Tell the other workers and the other nodes of the cluster that an agent was attached ("publish") or left ("withdraw").
+        The other workers also learn the tenant & tags of the agent, to select it for batch requests.'''
+        for link in list(self.worker_links.values()):
+            self._send_message({'action': action, 'from': socket_id, 'to': 'server', 'tenant': tenant, 'tags': list(tags)}, link)
+        if self.cluster:
+            if action == 'publish':
+                self.cluster.publish(socket_id)
+            else:
+                self.cluster.withdraw(socket_id)
+
+
+    def _send_message(self, message, connection: Connection) -> bool:
         '''Send messages to sockets. If message doesnt't exist, False value will be returned.'''
         # Make sure message exists
         if message:
-            client_socket.send(encode_message(json.dumps(message) if type(message) == dict else message))
+            if connection.binary:
+                self._write(encode_frame(message, connection.codec, connection.compression), connection)
+            else:
+                self._write(encode_message(json.dumps(message) if type(message) == dict else message), connection)
             return True
         return False
 
 
-    def _save_socket(self, socket_id: str, client_socket: socket.socket) -> dict:
-        '''Add socket to cache.'''
+    def _write(self, data, connection: Connection) -> None:
+        '''Write the data as far as the socket allows, the rest is flushed once the socket becomes writable.'''
+        if connection.closed:
+            return
+        BYTES_SENT.inc(len(data))
+
+        # Outbound links queue their frames until their TLS handshake is done
+        if connection.handshaking:
+            connection.writer.append(data)
+            return
         try:
-            # return self.cache.save_socket(socket_id, client_socket)
-            self.socket_mapping[socket_id] = client_socket
-            return {'isError': False}
-        
+            connection.writer.send(connection.client_socket, data)
+
         except Exception as ex:
-            log(f'General error [1720] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
-            return {'isError': True, 'message': 'Failed to save socket'}
+            log(f'Write error [6675] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            self._close_connection(connection)
+            return
 
+        self._update_events(connection)
 
-    def _get_socket(self, socket_id: str) -> dict:
-        '''Get socket from cache.'''
+
+    def _accepts_frame(self, frame: Frame, connection: Connection) -> bool:
+        '''Check if the connection can decode the frame as is (same framing, known codec & compression).'''
+        if not frame.binary or frame.route is None or not connection.binary:
+            return False
+        if CODEC_NAMES.get(frame.codec) not in connection.codecs:
+            return False
+        compression = frame.flags & COMPRESSION_MASK
+        return not compression or COMPRESSION_NAMES.get(compression) in connection.compressions
+
+
+    def _forward(self, frame: Frame, destination: Connection) -> None:
+        '''Forward a frame as it was received, re-encoding it only if the destination cannot decode it.'''
+        if self._accepts_frame(frame, destination):
+            self._write(frame.raw, destination)
+        else:
+            self._send_message(decode_frame(frame), destination)
+
+
+    def _flush(self, connection: Connection) -> None:
+        '''Write the outbound buffer of the connection, without blocking the event loop.'''
+        if connection.closed:
+            return
         try:
-            # return self.cache.get_socket(socket_id)
-            client_socket = self.socket_mapping.get(socket_id, False)
-            if not client_socket:
-                return {'isError': True, 'message': 'Socket does not exist'}
-            return {'isError': False, 'socket': client_socket}
-        
+            connection.writer.flush(connection.client_socket)
+
         except Exception as ex:
-            log(f'General error [8232] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
-            return {'isError': True, 'message': 'Failed to get socket'}
+            log(f'Write error [6674] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            self._close_connection(connection)
+            return
+
+        # Resume the senders, once enough of the backlog has been written
+        if connection.blocked and connection.writer.below_low_watermark():
+            self._resume_sources(connection)
+        self._update_events(connection)
+
+
+    def _pause_source(self, source: Connection, destination: Connection) -> None:
+        '''Stop reading from the source until the destination has drained its outbound buffer.'''
+        if source is destination or source in destination.blocked:
+            return
+        log(f'Pausing {source}, {destination} is not keeping up', 'warning')
+        destination.blocked.add(source)
+        source.paused += 1
+        self._update_events(source)
 
 
-    def _remove_socket(self, socket_id: str) -> dict:
-        '''Remove socket from cache.'''
+    def _resume_sources(self, destination: Connection) -> None:
+        blocked, destination.blocked = destination.blocked, set()
+        for source in blocked:
+            source.paused -= 1
+            if not source.closed:
+                self._update_events(source)
+
+
+    def _update_events(self, connection: Connection) -> None:
+        '''Only read from unpaused connections, and only wait for the socket to become writable while there is pending outbound data.
+        The events of the connections in their TLS handshake are left to the handshake.'''
+        if connection.closed or connection.handshaking:
+            return
+        events = 0 if connection.paused else selectors.EVENT_READ
+        if connection.writer:
+            events |= selectors.EVENT_WRITE
+
         try:
+            key = self.selector.get_key(connection.client_socket)
+        except KeyError:
+            key = None
+
+        if not events:
+            if key:
+                self.selector.unregister(connection.client_socket)
+        elif key is None:
+            self.selector.register(connection.client_socket, events, connection)
+        elif key.events != events:
+            self.selector.modify(connection.client_socket, events, connection)
+
+
+    def _save_socket(self, socket_id: str, connection: Connection, socket_type: str = None, tenant: str = None, tags: tuple = ()) -> dict:
+        '''Add socket to cache.'''
+        response = self.cache.save_socket(socket_id, connection, socket_type, tenant, tags)
+        if not response['isError']:
+            connection.socket_ids.add(socket_id)
+        return response
+
+
+    def _get_socket(self, socket_id: str) -> dict:
+        '''Get socket from cache.'''
+        return self.cache.get_socket(socket_id)
+
+
+    def _remove_socket(self, socket_id: str, connection: Connection = None) -> dict:
+        '''Remove socket from cache, and tell the other workers and nodes of the cluster that the agent left.'''
+        response = self.cache.remove_socket(socket_id, connection)
+        if not response['isError']:
             log(f'Deleting socket: {socket_id}', 'warning')
-            # client_socket = self._get_socket(socket_id)['socket'] # get the socket object
-            # self.sockets_list.remove(client_socket) # delete the socket with socket object
-            # return self.cache.remove_socket(socket_id)
-            del self.socket_mapping[socket_id] # delete the socket with socketId
-            client_socket = self._get_socket(socket_id)['socket'] # get the socket object
-            self.sockets_list.remove(client_socket) # delete the socket with socket object
-            return {'isError': False}
-                    
-        except Exception as ex:
-            log(f'General error [4642] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
-            return {'isError': True, 'message': 'Failed to remove socket'}
+            response['record'].connection.socket_ids.discard(socket_id)
+            if not response['record'].connection.persistent:
+                self._announce('withdraw', socket_id)
+        return response
+
+
+    def _close_connection(self, connection: Connection) -> None:
+        '''Stop watching the connection, close it and forget every socket ID routed to it.'''
+        if connection.closed:
+            return
+        connection.closed = True
+        try:
+            self.selector.unregister(connection.client_socket)
+        except (KeyError, ValueError):
+            pass
+        self._resume_sources(connection)
+        self.timers.cancel(connection)
+        connection.writer.clear()
+
+        # Requests to the connection will never be answered, requests from it are not awaited anymore
+        self.scheduler.forget(connection)
+        for key in list(connection.in_flight):
+            request = self.requests.get(key)
+            if request is not None:
+                if request.destination is connection:
+                    self._fail_request(request, 'Socket disconnected')
+                else:
+                    self._fail_request(request, None, cancel=True)
+
+        for socket_id in connection.socket_ids:
+            if not self.cache.remove_socket(socket_id, connection)['isError'] and not connection.persistent:
+                self._announce('withdraw', socket_id)
+        connection.socket_ids.clear()
+
+        if connection.node:
+            node_id = connection.socket_id[len('node-'):]
+            if self.links.get(node_id) is connection:
+                del self.links[node_id]
+                self.cluster.forget(node_id, failed=connection.handshaking)
+
+        if connection.worker:
+            log(f'Lost the link to {connection.socket_id}', 'danger')
+            self.worker_links.pop(connection.client_address[1], None)
+            for socket_id in [socket_id for socket_id, link in self.worker_routes.items() if link is connection]:
+                del self.worker_routes[socket_id]
+                self.worker_agents.pop(socket_id, None)
+
+        try:
+            connection.client_socket.close()
+        except Exception:
+            pass
+        log(f'Closed connection with socket, peer name: {connection.client_address[0]}:{connection.client_address[1]}', 'warning')
+
+
+    def _begin_request(self, data: dict, source: Connection, destination_id: str, destination: Connection) -> None:
+        '''Track a forwarded request. Only the server the requestor is attached to enforces its deadline.'''
+        self.cache.begin_request(destination_id)
+        correlation_id = data.get('correlationId')
+        if not correlation_id:
+            return
 
+        deadline = budget_deadline(data.get('budget'))
+        if deadline is not None:
+            deadline += REQUEST_DEADLINE_GRACE
+        request = InFlight(correlation_id, data['from'], source, destination_id, destination, deadline)
+        self.requests[request.key] = request
+        source.in_flight.add(request.key)
+        destination.in_flight.add(request.key)
+        if deadline is not None and not source.worker and not source.node:
+            heapq.heappush(self.deadlines, (deadline, request.key))
 
-    def _handle_missing_socket(self, missing_socket_id: str, source_socket_id: str, client_socket: socket.socket) -> None:
-        '''Notify the requestor socket about missing destination socket.'''
+
+    def _owned_request(self, key: tuple, connection: Connection, destination: bool = False) -> InFlight:
+        '''The request of the key, if the connection may end it: its source may cancel it, its destination answer it.
+        Nodes of the cluster answer over their own link, any connection of the same node will do.'''
+        request = self.requests.get(key) if key[1] else None
+        if request is None:
+            return None
+        peer = request.destination if destination else request.source
+        if peer is not connection and not (peer.node and connection.node and peer.socket_id == connection.socket_id):
+            return None
+        return request
+
+
+    def _end_request(self, key: tuple, outcome: str = 'response') -> InFlight:
+        request = self.requests.pop(key, None)
+        if request is None:
+            return None
+        REQUEST_SECONDS.observe(time.monotonic() - request.started, (outcome,))
+        request.source.in_flight.discard(key)
+        request.destination.in_flight.discard(key)
+        self.cache.end_request(request.destination_id)
+
+        # Send the next waiting requests to the agent, in the room left by this one
+        for queued_key, frame in self.scheduler.release(request.destination, key):
+            self._forward(self._spend_budget(queued_key, frame), request.destination)
+
+        # Answered requests stay in the heap until their deadline, rebuild it when they are the majority
+        if len(self.deadlines) > 1024 and len(self.deadlines) > 2 * len(self.requests):
+            self.deadlines = [
+                (pending.deadline, pending.key) for pending in self.requests.values()
+                if pending.deadline is not None and not pending.source.worker and not pending.source.node
+            ]
+            heapq.heapify(self.deadlines)
+        return request
+
+
+    def _spend_budget(self, key: tuple, frame: Frame) -> Frame:
+        '''The frame of a request that waited in the queue of its agent, with the time it waited taken off its budget.'''
+        request = self.requests.get(key)
+        if request is None or request.deadline is None or not frame.route or 'budget' not in frame.route:
+            return frame
+        return frame.reroute({**frame.route, 'budget': request_budget(request.deadline - REQUEST_DEADLINE_GRACE - time.monotonic())})
+
+
+    def _fail_request(self, request: InFlight, message: str, timeout: bool = False, cancel: bool = False, busy: bool = False) -> None:
+        '''Answer the requestor with an error (unless "message" is None), and cancel the request on the destination.'''
+        self._end_request(request.key, 'timeout' if timeout else 'busy' if busy else 'cancel' if message is None else 'error')
+        if message is not None and not request.source.closed:
+            data = {'isError': True, 'message': message}
+            if timeout:
+                data['timeout'] = True
+            if busy:
+                data['busy'] = True
+            self._send_message({'action': 'response', 'from': 'server', 'to': request.source_id, 'correlationId': request.correlation_id, 'data': data}, request.source)
+        if cancel and not request.destination.closed:
+            self._send_message({'action': 'cancel', 'from': request.source_id, 'to': request.destination_id, 'correlationId': request.correlation_id}, request.destination)
+
+
+    def _expire_requests(self) -> None:
+        '''Fail the requests whose deadline passed, and cancel them on their destination.'''
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.deadlines)
+            request = self.requests.get(key)
+            if request is not None and request.deadline == deadline:
+                log(f'Request {request.correlation_id} to {request.destination_id} expired', 'warning')
+                self._fail_request(request, 'Request timed out', timeout=True, cancel=True)
+
+
+    def _handle_missing_socket(self, missing_socket_id: str, source_socket_id: str, connection: Connection, correlation_id: str = None, known: bool = False) -> None:
+        '''Notify the requestor socket about missing destination socket.
+        Socket ID's known from the snapshot of the registry are expected to reconnect, the requestor may retry.'''
         try:
             log(f'Could not find socket: {missing_socket_id}', 'danger')
-            log(f'Sending to socket: {source_socket_id}')  
+            REQUESTS_REJECTED.inc(1, ('missing',))
+            data = {'isError': True, 'message': 'Socket is not registered'}
+            if known:
+                data['reconnecting'] = True
+            log(f'Sending to socket: {source_socket_id}')
             self._send_message(
                 {
                     'action': 'response',
                     'from': 'server',
                     'to': source_socket_id,
-                    'data': {'isError': True, 'message': 'Socket is not registered'},
-                }, client_socket
+                    'correlationId': correlation_id,
+                    'data': data,
+                }, connection
             )
-                    
+
         except Exception as ex:
             log(f'General error [5013] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
-            
+
 
     def _parse_message(self, message: dict) -> tuple:
         '''Parse the essential information from message data.'''
@@ -149,115 +521,455 @@ class Server:
 
 
     def _handle_new_client(self) -> bool:
-        '''Handle new clients.'''
-        try:
-            naked_socket, client_address = self.server_socket.accept()
-            naked_socket.setblocking(1)
-                        
-            # Get SSL wrapped socket
-            ssl_handler = SSL()
-            response = ssl_handler.ssl_wrap_socket(naked_socket) 
-            if response['isError']:
-                log(response['message'], 'danger')
-                return False
-            client_socket = response['socket']
+        '''Accept every pending client. The TLS handshake is driven later by the event loop.'''
+        while True:
+            try:
+                naked_socket, client_address = self.server_socket.accept()
+                naked_socket.setblocking(False)
+                self._enable_keepalive(naked_socket)
 
-            # Validate the client certificate
-            response = ssl_handler.validate_cert(client_socket.getpeercert())
-            if response['isError']:
-                log(response['message'], 'danger')
-                return False
-            log('Client certificate validated successfully', 'success')
+                # Get SSL wrapped socket, without handshaking on the event loop
+                ssl_handler = SSL()
+                response = ssl_handler.ssl_wrap_socket(naked_socket, do_handshake_on_connect=False)
+                if response['isError']:
+                    log(response['message'], 'danger')
+                    naked_socket.close()
+                    continue
+                client_socket = response['socket']
+
+                connection = Connection(client_socket, client_address, self.HEADER_LENGTH)
+                self.selector.register(client_socket, selectors.EVENT_READ, connection)
+                self.timers.schedule(connection, SERVER_HANDSHAKE_TIMEOUT)
+                CONNECTIONS_ACCEPTED.inc()
+
+            except BlockingIOError:
+                return True
 
-            # Receive message
-            message = receive_message(client_socket, self.HEADER_LENGTH)
-            if message is False:
+            except Exception as ex:
+                log(f'General error [5484] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
                 return False
 
-            # Add socket to temporary storage
-            self.sockets_list.append(client_socket)
-
-            # Accept the initial socket connection message
-            data = json.loads(message['payload'])
-            if data['action'] == 'handshake':
-                socket_id = data['from']
-                self._save_socket(socket_id, client_socket)
-                self._send_message(
-                    {
-                        'action': 'inform',
-                        'from': 'server',
-                        'to': socket_id,
-                        'text': 'Handshake accepted',
-                        'level': 'success'
-                    }, client_socket
-                )
-
-            log(f'Accepted new connection {client_address[0]}:{client_address[1] }', 'notification')
-            return True
-        
+
+    def _handle_tls_handshake(self, connection: Connection) -> bool:
+        '''Advance the non-blocking TLS handshake of the connection, then validate the certificate of the peer.
+        Outbound links to the other nodes first wait for their TCP connect.'''
+        try:
+            if connection.connecting:
+                error = connection.client_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise ConnectionError(f'Could not connect to {connection.client_address[0]}:{connection.client_address[1]}: {os.strerror(error)}')
+                connection.connecting = False
+            connection.client_socket.do_handshake()
+
+        except ssl.SSLWantReadError:
+            self.selector.modify(connection.client_socket, selectors.EVENT_READ, connection)
+            return False
+
+        except ssl.SSLWantWriteError:
+            self.selector.modify(connection.client_socket, selectors.EVENT_WRITE, connection)
+            return False
+
         except Exception as ex:
-            log(f'General error [5484] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            log(f'General error [7702] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            self._close_connection(connection)
             return False
 
+        # Validate the certificate of the client, or of the node
+        ssl_handler = SSL()
+        response = ssl_handler.validate_cert(connection.client_socket.getpeercert())
+        if response['isError']:
+            log(response['message'], 'danger')
+            self._close_connection(connection)
+            return False
+
+        connection.handshaking = False
+        self.timers.schedule(connection, SERVER_PING_INTERVAL)
+        if connection.node:
+            ssl_handler.save_session(connection.client_socket, connection.client_address)
+            log(f'Cluster: Linked to {connection.socket_id}', 'success')
+            self._flush(connection)
+            return True
+
+        log('Client certificate validated successfully', 'success')
+        TLS_HANDSHAKE_SECONDS.observe(time.monotonic() - connection.accepted)
+        self._update_events(connection)
+        log(f'Accepted new connection {connection.client_address[0]}:{connection.client_address[1]}', 'notification')
+        return True
+
 
-    def _handle_new_messsage(self, notified_socket: socket.socket) -> bool:
-        '''Handle new messages from connected clients.'''
+    def _enable_keepalive(self, naked_socket: socket.socket) -> None:
+        '''TCP keepalives, for the clients that do not answer pings: the kernel closes their half-open connections.'''
         try:
-            message = receive_message(notified_socket, self.HEADER_LENGTH)
+            naked_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                naked_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, SERVER_KEEPALIVE_IDLE)
+                naked_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(SERVER_KEEPALIVE_IDLE // 6, 1))
+                naked_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
 
-            if message is False:
-                log(f'Closed connection with socket, socket name: {notified_socket.getsockname()}, peer name: {notified_socket.getpeername()}', 'warning')
-                self.sockets_list.remove(notified_socket)
-                return False
+        except OSError as ex:
+            log(f'General error [6938] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+
+    def _check_connections(self) -> None:
+        '''Handle the expired timers of the connections:
+         - Connections still in their TLS handshake after SERVER_HANDSHAKE_TIMEOUT seconds are closed,
+           links to the other nodes after CLUSTER_CONNECT_TIMEOUT seconds
+         - Connections idle for SERVER_PING_INTERVAL seconds are pinged, if they answer pings
+         - Connections which did not send anything within SERVER_PONG_TIMEOUT seconds of the ping are closed
+
+        Closing a connection evicts its socket ID's, and fails the requests awaiting it straight away.
+        Receiving data does not touch the timers, the idle time is only checked once they expire.
+        '''
+        now = time.monotonic()
+        for connection in self.timers.expire(now):
+            if connection.closed:
+                continue
+            if connection.handshaking:
+                log(f'TLS handshake of {connection.client_address[0]}:{connection.client_address[1]} timed out', 'warning')
+                CONNECTIONS_TIMED_OUT.inc(1, ('handshake',))
+                self._close_connection(connection)
+                continue
+
+            # Paused connections are not read, their answer may be waiting in the socket
+            if connection.pinged is not None and not connection.paused:
+                if connection.last_seen < connection.pinged:
+                    log(f'Socket {connection.socket_id} did not answer the ping, closing the connection', 'warning')
+                    CONNECTIONS_TIMED_OUT.inc(1, ('heartbeat',))
+                    self._close_connection(connection)
+                    continue
+                connection.pinged = None
+
+            idle = now - connection.last_seen
+            if idle < SERVER_PING_INTERVAL or connection.paused:
+                self.timers.schedule(connection, SERVER_PING_INTERVAL - idle if idle < SERVER_PING_INTERVAL else SERVER_PING_INTERVAL)
+            elif connection.heartbeat:
+                connection.pinged = now
+                self._send_message({'action': 'ping', 'from': 'server', 'to': connection.socket_id}, connection)
+                self.timers.schedule(connection, SERVER_PONG_TIMEOUT)
+
+
+    def _get_link(self, socket_id: str) -> dict:
+        '''Find the node of the cluster the socket ID is attached to, and the link to it. Links are opened on first use,
+        without blocking the event loop: the connect & TLS handshake are driven by the selector, like the accepted
+        connections, and the frames to the node are queued until the handshake is done.'''
+        response = self.cluster.lookup(socket_id)
+        if response['isError']:
+            return response
+        node_id = response['nodeId']
+
+        link = self.links.get(node_id)
+        if link is not None:
+            return {'isError': False, 'socket': link}
+
+        try:
+            address = (response['host'], response['port'])
+            response = SSL().ssl_connect_nonblocking(address)
+            if response['isError']:
+                self.cluster.forget(node_id, failed=True)
+                return response
+            client_socket = response['socket']
+
+            # Both nodes run the same relay, the link uses the binary framing straight away
+            link = Connection(client_socket, address, self.HEADER_LENGTH)
+            link.connecting = True
+            link.persistent = True
+            link.node = True
+            link.socket_id = f'node-{node_id}'
+            link.codec, link.compression = negotiate(handshake_offer())
+            link.codecs = set(CODECS)
+            link.compressions = set(COMPRESSORS)
+            self.links[node_id] = link
+            self.selector.register(client_socket, selectors.EVENT_WRITE, link)
+            self.timers.schedule(link, CLUSTER_CONNECT_TIMEOUT)
+            self._send_message({
+                'action': 'handshake',
+                'from': f'node-{self.cluster.NODE_ID}',
+                'to': 'server',
+                'type': 'node',
+                'persistent': True,
+                **handshake_offer()
+            }, link)
+            log(f'Cluster: Linking to node {node_id}', 'notification')
+            return {'isError': False, 'socket': link}
+
+        except Exception as ex:
+            log(f'General error [4770] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            self.cluster.forget(node_id, failed=True)
+            return {'isError': True, 'message': 'Failed to link to the node'}
+
+
+    def _handle_handshake(self, data: dict, frame: Frame, connection: Connection) -> None:
+        '''Accept the initial socket connection message.'''
+        socket_id = data['from']
+        connection.socket_id = socket_id
+
+        # Persistent (pooled broker) connections multiplex many requests, and stay open after a response
+        connection.persistent = bool(data.get('persistent'))
+        connection.heartbeat = bool(data.get('heartbeat'))
+        socket_type = data.get('type', 'broker' if connection.persistent else 'agent')
+        connection.node = socket_type == 'node'
+        tags = tuple(data.get('tags') or ())
+        self._save_socket(socket_id, connection, socket_type, data.get('tenant'), tags)
+
+        # Tell the other workers and nodes of the cluster where to find the agent
+        if not connection.persistent:
+            self._announce('publish', socket_id, data.get('tenant'), tags)
+
+        # Clients offering the binary framing get the best codec & compression both sides support
+        connection.binary = frame.binary and data.get('framing') == 'binary'
+        if connection.binary:
+            connection.codec, connection.compression = negotiate(data)
+            connection.codecs = {'json', *data.get('codecs', [])}
+            connection.compressions = set(data.get('compression', []))
+        self._send_message(
+            {
+                'action': 'inform',
+                'from': 'server',
+                'to': socket_id,
+                'text': 'Handshake accepted',
+                'level': 'success',
+                'codec': connection.codec if connection.binary else None,
+                'compression': connection.compression if connection.binary else None
+            }, connection
+        )
+
+
+    def _handle_select(self, data: dict, connection: Connection) -> None:
+        '''Reply with the socket ID's of the agents matching the selector of a batch request: the agents of the tenant
+        having every tag. Agents attached to the other workers are included, the other nodes of a cluster are not.'''
+        selector = data.get('data') or {}
+        tenant = selector.get('tenant')
+        tags = set(selector.get('tags') or ())
+
+        socket_ids = self.cache.find(tenant, 'agent', tags)
+        for socket_id, (agent_tenant, agent_tags) in self.worker_agents.items():
+            if (tenant is None or agent_tenant == tenant) and tags <= agent_tags:
+                socket_ids.append(socket_id)
+
+        self._send_message(
+            {
+                'action': 'response',
+                'from': 'server',
+                'to': data['from'],
+                'correlationId': data.get('correlationId'),
+                'data': {'isError': False, 'sockets': socket_ids}
+            }, connection
+        )
 
+
+    def _handle_stats(self, data: dict, connection: Connection) -> None:
+        '''Reply with the metrics of the server (of this worker, when the server runs several), to broker connections only.'''
+        if connection.persistent and not connection.node and not connection.worker:
+            response = {'isError': False, 'workerId': self.worker_id, 'metrics': metrics.snapshot()}
+        else:
+            response = {'isError': True, 'message': 'Stats are only available to brokers'}
+        self._send_message(
+            {
+                'action': 'response',
+                'from': 'server',
+                'to': data['from'],
+                'correlationId': data.get('correlationId'),
+                'data': response
+            }, connection
+        )
+
+
+    def _register_gauges(self) -> None:
+        '''Gauges of the server, read when the metrics are exported.'''
+        connections = lambda: [key.data for key in self.selector.get_map().values() if key.data is not None]
+        metrics.gauge('relay_connections', 'Open connections of the relay, by kind', ('kind',), lambda: self._count_connections(connections()))
+        metrics.gauge('relay_outbound_bytes', 'Bytes waiting in the write buffers of the connections', function=lambda: sum(len(connection.writer) for connection in connections()))
+        metrics.gauge('relay_sockets', 'Socket IDs registered on the relay', function=lambda: len(self.cache))
+        metrics.gauge('relay_requests_in_flight', 'Requests forwarded and not answered yet', function=lambda: len(self.requests))
+        metrics.gauge('relay_agent_queue_depth', 'Requests waiting for room in the window of their agent', function=lambda: self.scheduler.stats()['queued'])
+
+
+    def _count_connections(self, connections: list) -> dict:
+        counts = {}
+        for connection in connections:
+            kind = 'handshaking' if connection.handshaking else 'node' if connection.node else 'worker' if connection.worker else 'broker' if connection.persistent else 'agent'
+            counts[(kind,)] = counts.get((kind,), 0) + 1
+        return counts
+
+
+    def _handle_readable(self, connection: Connection) -> None:
+        '''Read everything available on the connection, and handle every complete message.'''
+        try:
+            connection.last_seen = time.monotonic()
+            connected = connection.reader.fill(connection.client_socket)
+
+            # Data is received in the format: {MESSAGE_HEADER}{MESSAGE}
+            for frame in connection.reader.frames():
+                self._handle_new_messsage(frame, connection)
+
+        except Exception as ex:
+            log(f'Read error [1193] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            self._close_connection(connection)
+            return
+
+        if not connected:
+            self._close_connection(connection)
+
+
+    def _handle_new_messsage(self, frame: Frame, connection: Connection) -> bool:
+        '''Handle new messages from connected clients.
+
+        Binary frames are routed with the fields of their header, so the payload is never decoded on the way.
+        '''
+        try:
             # Variables
-            data = json.loads(message['payload'])
+            data = frame.route if frame.route is not None else decode_frame(frame)
             destination_socket_id, source_socket_id, action = self._parse_message(data)
+            MESSAGES_RECEIVED.inc(1, (action,))
+            BYTES_RECEIVED.inc(len(frame.raw))
 
             log(f'Received message from {source_socket_id}')
 
+            if action == 'handshake':
+                self._handle_handshake(decode_frame(frame), frame, connection)
+                return True
+
+            # Heartbeats: every frame shows the connection is alive, pings of the other nodes are answered
+            if action == 'pong':
+                return True
+            if action == 'ping' and destination_socket_id == 'server':
+                self._send_message({'action': 'pong', 'from': 'server', 'to': source_socket_id}, connection)
+                return True
+
+            # Reply of a node to the handshake of an inter-node link
+            if action == 'inform' and connection.node:
+                return True
+
+            # Agents attached to, or leaving, another worker
+            if connection.worker and action in ('publish', 'withdraw'):
+                if action == 'publish':
+                    announcement = decode_frame(frame)
+                    self.worker_routes[source_socket_id] = connection
+                    self.worker_agents[source_socket_id] = (announcement.get('tenant'), frozenset(announcement.get('tags') or ()))
+                elif self.worker_routes.get(source_socket_id) is connection:
+                    del self.worker_routes[source_socket_id]
+                    self.worker_agents.pop(source_socket_id, None)
+                return True
+
+            # Selection of the destination agents of a batch request
+            if action == 'select':
+                self._handle_select(decode_frame(frame), connection)
+                return True
+
+            # Metrics of the relay, for the brokers
+            if action == 'stats' and destination_socket_id == 'server':
+                self._handle_stats(decode_frame(frame), connection)
+                return True
+
             # When the socket is closing, delete the socket information
             if action == 'deregister':
-                self._remove_socket(source_socket_id)
+                self._remove_socket(source_socket_id, connection)
                 return False
 
-            # Forward the message to destination sokcet
+            # Requests multiplexed over a persistent connection are routed back by their source socket ID
+            if action == 'request' and connection.persistent:
+                self._save_socket(source_socket_id, connection, 'broker')
+            else:
+                self.cache.touch(source_socket_id)
+
+            # Forward the message to destination sokcet, or to the node of the cluster it is attached to
+            # Frames from workers are only delivered locally, frames from nodes only within the node
             response = self._get_socket(destination_socket_id)
+            if response['isError'] and not connection.worker and destination_socket_id in self.worker_routes:
+                response = {'isError': False, 'socket': self.worker_routes[destination_socket_id]}
+            if response['isError'] and self.cluster and not connection.node and not connection.worker:
+                response = self._get_link(destination_socket_id)
             if response['isError']:
-                self._handle_missing_socket(destination_socket_id, source_socket_id, notified_socket)
+                self._handle_missing_socket(destination_socket_id, source_socket_id, connection, data.get('correlationId'), response.get('known', False))
                 return False
-            destination_socket = response['socket']
-                        
-            # Send the message to the destination socket
+            destination = response['socket']
+
+            # Traced requests & responses get the time they crossed the server, the payload is left as is
+            if data.get('trace') and frame.route is not None:
+                frame = frame.reroute({**frame.route, 'trace': add_hop(frame.route['trace'], f'server.{action}')})
+                data = frame.route
+
+            # Requests to the agents attached here wait for room in the window of the agent
+            if action == 'request':
+                self._begin_request(data, connection, destination_socket_id, destination)
+                key = (source_socket_id, data.get('correlationId'))
+                if key[1] and not (destination.persistent or destination.worker or destination.node):
+                    admission = self.scheduler.submit(destination, key, data.get('priority'), source_socket_id, frame)
+                    if admission == 'queued':
+                        return True
+                    if admission == 'full':
+                        log(f'Queue of socket {destination_socket_id} is full, rejecting request', 'warning')
+                        REQUESTS_REJECTED.inc(1, ('busy',))
+                        self._fail_request(self.requests[key], 'Agent is busy, try again later', busy=True)
+                        return True
+
+            # Only the requestor may cancel its requests, correlation ids are not unique across requestors
+            if action == 'cancel':
+                request = self._owned_request((source_socket_id, data.get('correlationId')), connection)
+                if request is None:
+                    return True
+
+            # Send the message to the destination socket, re-encoding it only if the destination cannot decode it
             log(f'Sending to socket: {destination_socket_id}')
-            self._send_message(data, destination_socket)
+            self._forward(frame, destination)
+
+            # Apply back-pressure to the sender, instead of buffering without limit for a slow destination
+            if destination.writer.above_high_watermark():
+                self._pause_source(connection, destination)
+
+            # Track the requests until they are answered, cancelled or expired. Only the destination of a request answers it
+            if action == 'response':
+                request = self._owned_request((destination_socket_id, data.get('correlationId')), connection, destination=True)
+                if request is None:
+                    self.cache.end_request(source_socket_id)
+                else:
+                    self._end_request(request.key)
+            elif action == 'cancel':
+                self._end_request(request.key, 'cancel')
 
             # Delete the information about the broker socket as it will be terminated
             if action == 'response':
-                self._remove_socket(destination_socket_id)
+                # Persistent connections keep their routes, until the broker deregisters them or disconnects
+                if not destination.persistent:
+                    self._remove_socket(destination_socket_id)
             return True
-        
+
         except Exception as ex:
             log(f'General error [2273] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
             return False
 
 
     def start(self) -> None:
-        '''Listen for messages & new clients.'''
+        '''Listen for messages & new clients. Every socket is non-blocking, so one slow client cannot stall the others.'''
         while True:
-            read_sockets, _, exception_sockets = select.select(self.sockets_list, [], self.sockets_list)
-
-            for notified_socket in read_sockets:
+            # Wake up for the next deadline, if any
+            timeout = max(self.deadlines[0][0] - time.monotonic(), 0) if self.deadlines else None
+            tick = self.timers.next_tick()
+            if tick is not None and (timeout is None or tick < timeout):
+                timeout = tick
+            for key, mask in self.selector.select(timeout):
                 # Endpoint connected
-                if notified_socket == self.server_socket:
+                if key.data is None:
                     self._handle_new_client()
+                    continue
+
+                connection = key.data
+                if connection.handshaking:
+                    self._handle_tls_handshake(connection)
+                    continue
+
+                # Endpoint is ready to receive the rest of its outbound data
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(connection)
 
                 # Endpoint sent a message
-                else:
-                    self._handle_new_messsage(notified_socket)
+                if mask & selectors.EVENT_READ and not connection.closed and not connection.paused:
+                    self._handle_readable(connection)
 
-            for notified_socket in exception_sockets:
-                self.sockets_list.remove(notified_socket)
+            if self.deadlines:
+                self._expire_requests()
+            if self.timers:
+                self._check_connections()
 
 
     def __repr__(self) -> str:
@@ -272,12 +984,63 @@ class Server:
         return self.HEADER_LENGTH
 
 
+def run(server: Server) -> None:
+    # Stop cleanly on SIGTERM, so the snapshot and the cluster directory are up to date
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.start()
+    finally:
+        server.cache.close()
+        if server.cluster:
+            server.cluster.close()
+
+
 def main() -> None:
-    server = Server(HEADER_LENGTH, IP, PORT)
+    workers = SERVER_WORKERS if hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork') else 1
+    if workers <= 1:
+        run(Server(HEADER_LENGTH, IP, PORT))
+        return
+
+    # A Unix domain socket between every pair of workers, created before forking so each worker inherits its ends
+    pairs = {(first, second): socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM) for first in range(workers) for second in range(first + 1, workers)}
+    pids = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            worker_links = {}
+            for (first, second), (first_socket, second_socket) in pairs.items():
+                if worker_id == first:
+                    worker_links[second] = first_socket
+                    second_socket.close()
+                elif worker_id == second:
+                    worker_links[first] = second_socket
+                    first_socket.close()
+                else:
+                    first_socket.close()
+                    second_socket.close()
+            try:
+                run(Server(HEADER_LENGTH, IP, PORT, worker_id, worker_links))
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    for first_socket, second_socket in pairs.values():
+        first_socket.close()
+        second_socket.close()
+    log(f'Started {workers} workers on {IP}:{PORT}', 'notification')
 
-    # Start the server
-    server.start()
+    # The workers depend on each other, if one stops they all stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        pid, _ = os.wait()
+        log(f'Worker process {pid} stopped, stopping the server', 'danger')
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
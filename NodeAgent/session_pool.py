@@ -0,0 +1,232 @@
+import os
+import time
+import atexit
+from contextlib import contextmanager
+from threading import Condition, Event, Thread, Lock
+from utils.chalk import log
+
+# Constants
+AGENT_SESSIONS_PER_DEVICE = int(os.environ.get('AGENT_SESSIONS_PER_DEVICE', 2))
+AGENT_SESSION_IDLE_TIMEOUT = float(os.environ.get('AGENT_SESSION_IDLE_TIMEOUT', 300))
+AGENT_SESSION_CHECK_INTERVAL = float(os.environ.get('AGENT_SESSION_CHECK_INTERVAL', 30))
+
+class SessionPool:
+    '''Warm sessions to the devices (SSH, NETCONF...), by device key, reused by the tasks run against the same device.
+
+    The task handler provides the hooks of the pool:
+     - "open_session(key)": connects to the device and returns the session
+     - "check_session(session)" (optional): returns False if the session is not usable anymore
+     - "close_session(session)" (optional): disconnects the session
+    At most "max_per_key" sessions are open per device, tasks wait for one to be returned when they are all in use.
+    Sessions idle for more than "check_interval" seconds are checked before being reused, and closed after
+    "idle_timeout" seconds without use.
+    '''
+    # Constants
+    MAX_PER_KEY = 0
+    IDLE_TIMEOUT = 0
+    CHECK_INTERVAL = 0
+
+    # Variables
+    idle = {}
+    open = {}
+
+
+    def __init__(
+        self, open_session, check_session=None, close_session=None, max_per_key: int = AGENT_SESSIONS_PER_DEVICE,
+        idle_timeout: float = AGENT_SESSION_IDLE_TIMEOUT, check_interval: float = AGENT_SESSION_CHECK_INTERVAL
+    ) -> None:
+        self.open_session = open_session
+        self.check_session = check_session
+        self.close_session = close_session
+        self.MAX_PER_KEY = max(max_per_key, 1)
+        self.IDLE_TIMEOUT = idle_timeout
+        self.CHECK_INTERVAL = check_interval
+        self.condition = Condition()
+        self.idle = {} # key -> [(session, last used)], the most recently used last
+        self.open = {} # key -> number of open sessions, idle or in use
+        self.stopped = Event()
+        self.reaper = None
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+
+    def acquire(self, key: str, timeout: float = None) -> dict:
+        '''Borrow a session to the device, opening one if none is idle. Waits at most "timeout" seconds
+        when "max_per_key" sessions are already in use.'''
+        if self.open_session is None:
+            return {'isError': True, 'message': 'The task handler does not open sessions'}
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            session = None
+            with self.condition:
+                while True:
+                    idle = self.idle.get(key)
+                    if idle:
+                        session, last_used = idle.pop()
+                        break
+                    if self.open.get(key, 0) < self.MAX_PER_KEY:
+                        self.open[key] = self.open.get(key, 0) + 1
+                        break
+
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return {'isError': True, 'busy': True, 'message': 'Every session to the device is in use'}
+                    self.condition.wait(remaining)
+
+            if session is None:
+                try:
+                    session = self.open_session(key)
+                    self.created += 1
+                    return {'isError': False, 'session': session}
+
+                except Exception as ex:
+                    log(f'General error [5183] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+                    self._forget(key)
+                    return {'isError': True, 'message': 'Failed to open a session to the device'}
+
+            # Sessions idle for a while may have been closed by the device
+            if time.monotonic() - last_used < self.CHECK_INTERVAL or self._healthy(session):
+                self.reused += 1
+                return {'isError': False, 'session': session}
+            self._discard(key, session)
+
+
+    def release(self, key: str, session, healthy: bool = True) -> None:
+        '''Return a borrowed session. Sessions left in an unknown state, e.g. by a failed task, are closed instead.'''
+        if not healthy:
+            self._discard(key, session)
+            return
+
+        with self.condition:
+            self.idle.setdefault(key, []).append((session, time.monotonic()))
+            self.condition.notify()
+            if self.reaper is None:
+                self.reaper = Thread(target=self._reap, daemon=True)
+                self.reaper.start()
+
+
+    @contextmanager
+    def session(self, key: str, timeout: float = None):
+        '''Borrow a session for the duration of a "with" block. An exception in the block closes the session.'''
+        response = self.acquire(key, timeout)
+        if response['isError']:
+            raise RuntimeError(response['message'])
+
+        session = response['session']
+        try:
+            yield session
+
+        except BaseException:
+            self.release(key, session, healthy=False)
+            raise
+
+        self.release(key, session)
+
+
+    def _healthy(self, session) -> bool:
+        if self.check_session is None:
+            return True
+        try:
+            return bool(self.check_session(session))
+
+        except Exception as ex:
+            log(f'General error [8826] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+            return False
+
+
+    def _close(self, session) -> None:
+        if self.close_session is None:
+            return
+        try:
+            self.close_session(session)
+
+        except Exception as ex:
+            log(f'General error [2715] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+
+    def _forget(self, key: str) -> None:
+        '''A session of the device is gone, another task may open one.'''
+        with self.condition:
+            self.open[key] -= 1
+            if not self.open[key]:
+                del self.open[key]
+            self.condition.notify()
+
+
+    def _discard(self, key: str, session) -> None:
+        self.discarded += 1
+        self._close(session)
+        self._forget(key)
+
+
+    def _reap(self) -> None:
+        '''Close the sessions idle for more than "IDLE_TIMEOUT" seconds.'''
+        while not self.stopped.wait(min(self.IDLE_TIMEOUT, self.CHECK_INTERVAL) or 1):
+            expired = []
+            expiry = time.monotonic() - self.IDLE_TIMEOUT
+            with self.condition:
+                for key, idle in list(self.idle.items()):
+                    # The least recently used sessions come first
+                    while idle and idle[0][1] < expiry:
+                        expired.append((key, idle.pop(0)[0]))
+                    if not idle:
+                        del self.idle[key]
+
+            for key, session in expired:
+                log(f'Sessions: Closing idle session to {key}', 'notification')
+                self._discard(key, session)
+
+
+    def close(self) -> None:
+        '''Close every idle session, on shutdown.'''
+        self.stopped.set()
+        with self.condition:
+            idle, self.idle = self.idle, {}
+        for key, sessions in idle.items():
+            for session, _ in sessions:
+                self._discard(key, session)
+
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                'devices': len(self.open),
+                'open': sum(self.open.values()),
+                'idle': sum(len(idle) for idle in self.idle.values()),
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded
+            }
+
+
+    def __len__(self) -> int:
+        return sum(self.open.values())
+
+
+    def __repr__(self) -> str:
+        return f'SessionPool({self.MAX_PER_KEY}, {self.IDLE_TIMEOUT}, {self.CHECK_INTERVAL})'
+
+
+    def __str__(self) -> str:
+        return 'Warm sessions to the devices, reused across tasks'
+
+
+# The session pool of the process, every task worker process has its own
+_shared = None
+_shared_lock = Lock()
+
+def shared_pool() -> SessionPool:
+    '''The session pool of the process, created on first use with the hooks of the task handler.'''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            from app import task_handler
+            _shared = SessionPool(
+                getattr(task_handler, 'open_session', None),
+                getattr(task_handler, 'check_session', None),
+                getattr(task_handler, 'close_session', None)
+            )
+            atexit.register(_shared.close)
+        return _shared
@@ -0,0 +1,223 @@
+import os
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock, Event
+from utils.session_pool import shared_pool
+from utils.chalk import log
+
+# Constants
+AGENT_EXECUTOR = os.environ.get('AGENT_EXECUTOR', 'thread')
+AGENT_WORKERS = int(os.environ.get('AGENT_WORKERS', 4))
+AGENT_QUEUE_SIZE = int(os.environ.get('AGENT_QUEUE_SIZE', 32))
+AGENT_MAX_PER_DESTINATION = int(os.environ.get('AGENT_MAX_PER_DESTINATION', 2))
+
+
+def resolve_destination(data) -> str:
+    '''The device a task runs against, used to limit the concurrency per device. None if the task does not name one.'''
+    if isinstance(data, dict):
+        for key in ('device', 'host', 'destination'):
+            if data.get(key):
+                return str(data[key])
+    return None
+
+
+class TaskContext:
+    '''Deadline, cancellation and output stream of a task.
+
+    - "shared": the task handler declares a "context" argument, and gets the context to check while it runs
+    - "emit": sends a chunk of output to the requestor, when it asked for a stream (threads only)
+    - "session(key)": lends a warm session to the device, from the session pool of the process
+    Worker processes get a copy with the deadline only, as the event and the stream cannot be sent to them.
+    '''
+    __slots__ = ('correlation_id', 'deadline', 'cancelled', 'emit', 'shared', 'started')
+
+
+    def __init__(self, correlation_id: str = None, deadline: float = None, emit=None, shared: bool = False) -> None:
+        self.correlation_id = correlation_id
+        self.deadline = deadline # time.monotonic() after which nobody waits for the result
+        self.cancelled = Event()
+        self.emit = emit
+        self.shared = shared
+        self.started = None # time.time() the task started at, in the agent process (threads only)
+
+
+    def __getstate__(self) -> tuple:
+        return self.correlation_id, self.deadline, self.shared
+
+
+    def __setstate__(self, state: tuple) -> None:
+        self.correlation_id, self.deadline, self.shared = state
+        self.cancelled = Event()
+        self.emit = None
+        self.started = None
+
+
+    def time_left(self) -> float:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+
+    def expired(self) -> bool:
+        return self.cancelled.is_set() or (self.deadline is not None and time.monotonic() >= self.deadline)
+
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+
+    def session(self, key: str):
+        '''Borrow a session to the device for a "with" block, waiting for one at most until the deadline:
+
+            with context.session(data['device']) as session:
+                ...
+        '''
+        return shared_pool().session(key, self.time_left())
+
+
+    def __repr__(self) -> str:
+        return f'TaskContext("{self.correlation_id}", {self.deadline})'
+
+
+def run_task(function, context: TaskContext, *args):
+    '''Run the task, unless it was cancelled or its deadline passed while it was waiting in the queue.
+
+    Task handlers may return a generator to produce their output in chunks: each chunk is emitted as soon as
+    it is produced when the requestor asked for a stream, or else all the chunks are returned at once.
+    '''
+    if context.cancelled.is_set():
+        return {'isError': True, 'cancelled': True, 'message': 'Task cancelled before it started'}
+    if context.deadline is not None and time.monotonic() >= context.deadline:
+        return {'isError': True, 'timeout': True, 'message': 'Deadline exceeded before the task started'}
+
+    context.started = time.time()
+    result = function(*args, context=context) if context.shared else function(*args)
+    if not hasattr(result, '__next__'):
+        return result
+    if context.emit is None:
+        return {'isError': False, 'chunks': list(result)}
+
+    count = 0
+    for chunk in result:
+        if context.cancelled.is_set():
+            result.close()
+            return {'isError': True, 'cancelled': True, 'message': 'Task cancelled', 'chunks': count}
+        context.emit(chunk)
+        count += 1
+    return {'isError': False, 'streamed': True, 'chunks': count}
+
+
+class TaskExecutor:
+    '''Bounded pool of workers for the tasks received by the agent.
+
+    - At most "max_workers" tasks run at once, in threads or in processes ("mode")
+    - At most "max_per_destination" of them run against the same device, the rest wait for their turn
+    - At most "queue_size" tasks wait, after that "submit()" returns False so the agent can answer "busy"
+    - Tasks submitted with a key can be cancelled, until they start running
+    '''
+    # Constants
+    MODE = ''
+    CAPACITY = 0
+    MAX_PER_DESTINATION = 0
+
+
+    def __init__(self, mode: str = AGENT_EXECUTOR, max_workers: int = AGENT_WORKERS, queue_size: int = AGENT_QUEUE_SIZE, max_per_destination: int = AGENT_MAX_PER_DESTINATION) -> None:
+        self.MODE = mode
+        self.CAPACITY = max_workers + queue_size
+        self.MAX_PER_DESTINATION = max(max_per_destination, 1)
+        self.executor = ProcessPoolExecutor(max_workers) if mode == 'process' else ThreadPoolExecutor(max_workers, thread_name_prefix='task')
+        self.lock = Lock()
+        self.total = 0
+        self.running = defaultdict(int)
+        self.waiting = defaultdict(deque)
+        self.futures = {} # key -> future of the task, until it is done
+
+
+    def submit(self, destination: str, callback, function, *args, key: tuple = None) -> bool:
+        '''Schedule "function(*args)". The callback receives the future once it is done.
+        Returns False when the queue is full, and the task is not scheduled.'''
+        with self.lock:
+            if self.total >= self.CAPACITY:
+                return False
+            self.total += 1
+
+            if destination is not None and self.running[destination] >= self.MAX_PER_DESTINATION:
+                self.waiting[destination].append((callback, function, args, key))
+                return True
+            self.running[destination] += 1
+
+        self._dispatch(destination, callback, function, args, key)
+        return True
+
+
+    def cancel(self, key: tuple) -> bool:
+        '''Cancel the task submitted with the key, unless it is already running.
+        The callback of a cancelled task receives a cancelled future.'''
+        with self.lock:
+            found = next(((waiting, task) for waiting in self.waiting.values() for task in waiting if task[3] == key), None)
+            if found is None:
+                future = self.futures.get(key)
+            else:
+                waiting, task = found
+                waiting.remove(task)
+                self.total -= 1
+
+        # Tasks handed to the pool can still be cancelled until a worker picks them up, running ones cannot
+        if found is None:
+            return future.cancel() if future is not None else False
+
+        future = Future()
+        future.cancel()
+        task[0](future)
+        return True
+
+
+    def _dispatch(self, destination: str, callback, function, args: tuple, key: tuple = None) -> None:
+        try:
+            future = self.executor.submit(function, *args)
+        except Exception as ex:
+            future = Future()
+            future.set_exception(ex)
+        if key is not None:
+            with self.lock:
+                self.futures[key] = future
+        future.add_done_callback(lambda future: self._done(destination, callback, future, key))
+
+
+    def _done(self, destination: str, callback, future: Future, key: tuple = None) -> None:
+        '''Hand the result to the callback, then start the next task waiting for the same device.'''
+        try:
+            callback(future)
+        except Exception as ex:
+            log(f'General error [5527] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+        with self.lock:
+            if key is not None and self.futures.get(key) is future:
+                del self.futures[key]
+            self.total -= 1
+            task = None
+            if self.waiting[destination]:
+                task = self.waiting[destination].popleft()
+            else:
+                self.running[destination] -= 1
+                if not self.running[destination]:
+                    del self.running[destination]
+                del self.waiting[destination]
+
+        if task:
+            self._dispatch(destination, *task)
+
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def __len__(self) -> int:
+        return self.total
+
+
+    def __repr__(self) -> str:
+        return f'TaskExecutor("{self.MODE}", {self.CAPACITY}, {self.MAX_PER_DESTINATION})'
+
+
+    def __str__(self) -> str:
+        return 'Bounded pool of workers for agent tasks'
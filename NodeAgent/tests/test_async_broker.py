@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+from utils.async_broker import AsyncBrokerConnection
+from utils.frame_reader import FrameReader
+from utils.message_codec import decode_frame
+
+# Constants
+HEADER_LENGTH = 10
+
+class Writer:
+    '''Stands for the asyncio stream writer of the connection, keeping what is written.'''
+    def __init__(self) -> None:
+        self.data = bytearray()
+
+
+    def write(self, data) -> None:
+        self.data += data
+
+
+    async def drain(self) -> None:
+        pass
+
+
+class AsyncBrokerConnectionTest(unittest.IsolatedAsyncioTestCase):
+    '''Requests multiplexed over one asyncio broker connection, without a server.
+
+        python3 -m unittest discover -s tests -t .
+    '''
+    async def test_same_client_correlation_id(self) -> None:
+        '''Two callers sending the same correlation id each get the response of their own request.'''
+        connection = AsyncBrokerConnection('broker', HEADER_LENGTH, '127.0.0.1', 0)
+        connection.writer = writer = Writer()
+        connection.connected = True
+        connection.drain_lock = asyncio.Lock()
+
+        first = await connection.send_message({'action': 'request', 'from': 'tenant-a', 'to': 'agent', 'correlationId': 'same', 'data': {}})
+        second = await connection.send_message({'action': 'request', 'from': 'tenant-b', 'to': 'agent', 'correlationId': 'same', 'data': {}})
+
+        reader = FrameReader(HEADER_LENGTH)
+        reader.feed(bytes(writer.data))
+        requests = [decode_frame(frame) for frame in reader.frames()]
+        self.assertEqual(len({request['correlationId'] for request in requests}), 2)
+        for request in reversed(requests):
+            connection._handle_message({
+                'action': 'response', 'from': 'agent', 'to': request['from'], 'correlationId': request['correlationId'], 'data': {'for': request['from']}
+            })
+
+        self.assertEqual((await first)['data'], {'for': 'tenant-a'})
+        self.assertEqual((await second)['data'], {'for': 'tenant-b'})
+        self.assertFalse(connection.pending)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import socket
+import unittest
+from utils.broker_pool import BrokerConnection, request_timeout
+from utils.frame_reader import FrameReader
+from utils.message_codec import decode_frame
+
+# Constants
+HEADER_LENGTH = 10
+
+class BrokerConnectionTest(unittest.TestCase):
+    '''Requests multiplexed over one broker connection, without a server: the frames written by the
+    connection are read back, and answered as the agent would.
+
+        python3 -m unittest discover -s tests -t .
+    '''
+    def setUp(self) -> None:
+        self.connection = BrokerConnection('broker', HEADER_LENGTH, '127.0.0.1', 0)
+        self.connection.connected = True
+        self.server, self.client = socket.socketpair()
+        self.server.setblocking(False)
+
+
+    def tearDown(self) -> None:
+        self.server.close()
+        self.client.close()
+
+
+    def sent(self) -> list:
+        '''The frames queued by the connection, decoded.'''
+        self.connection.writer.flush(self.client)
+        reader = FrameReader(HEADER_LENGTH)
+        reader.fill(self.server)
+        return [decode_frame(frame) for frame in reader.frames()]
+
+
+    def test_same_client_correlation_id(self) -> None:
+        '''Two callers sending the same correlation id each get the response of their own request.'''
+        first = self.connection.send_message({'action': 'request', 'from': 'tenant-a', 'to': 'agent', 'correlationId': 'same', 'data': {}})
+        second = self.connection.send_message({'action': 'request', 'from': 'tenant-b', 'to': 'agent', 'correlationId': 'same', 'data': {}})
+
+        requests = self.sent()
+        self.assertEqual(len({request['correlationId'] for request in requests}), 2)
+        for request in reversed(requests):
+            self.connection._handle_message({
+                'action': 'response', 'from': 'agent', 'to': request['from'], 'correlationId': request['correlationId'], 'data': {'for': request['from']}
+            })
+
+        self.assertEqual(first.result(1)['data'], {'for': 'tenant-a'})
+        self.assertEqual(second.result(1)['data'], {'for': 'tenant-b'})
+        self.assertFalse(self.connection.pending)
+
+
+class RequestTimeoutTest(unittest.TestCase):
+    '''The "Request-Timeout" header of the REST API routes.'''
+    def test_clamped(self) -> None:
+        self.assertEqual(request_timeout(None, 120), 120)
+        self.assertEqual(request_timeout('2.5', 120), 2.5)
+        self.assertEqual(request_timeout('600', 120), 120)
+
+
+    def test_invalid(self) -> None:
+        for header in ('', 'soon', '0', '-1', 'nan', 'inf'):
+            self.assertIsNone(request_timeout(header, 120))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import time
+import unittest
+from utils.frame_reader import FrameReader
+from utils.message_codec import encode_frame, decode_frame, request_budget, budget_deadline
+
+
+class RequestBudgetTest(unittest.TestCase):
+    '''The "budget" routing field: seconds left to the requestor, turned into a deadline of the receiving host.
+
+        python3 -m unittest discover -s tests -t .
+    '''
+    def test_budget_is_relative(self) -> None:
+        budget = request_budget(2.5)
+        self.assertEqual(budget, '2.500')
+        received = time.monotonic()
+        self.assertAlmostEqual(budget_deadline(budget, received), received + 2.5)
+
+
+    def test_budget_in_route(self) -> None:
+        reader = FrameReader(10)
+        reader.feed(encode_frame({'action': 'request', 'from': 'a', 'to': 'b', 'correlationId': 'c', 'budget': request_budget(1), 'data': {}}))
+        frame = reader.next_frame()
+        self.assertEqual(frame.route['budget'], '1.000')
+        self.assertEqual(decode_frame(frame)['budget'], '1.000')
+
+
+    def test_spent_budget(self) -> None:
+        self.assertEqual(request_budget(-3), '0.000')
+        self.assertLessEqual(budget_deadline('0'), time.monotonic())
+
+
+    def test_invalid_budget(self) -> None:
+        for budget in (None, '', 'soon', 'nan', 'inf'):
+            self.assertIsNone(budget_deadline(budget))
+
+
+if __name__ == '__main__':
+    unittest.main()
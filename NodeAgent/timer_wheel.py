@@ -0,0 +1,92 @@
+import os
+import math
+import time
+
+# Constants
+SERVER_TIMER_TICK = float(os.environ.get('SERVER_TIMER_TICK', 0.5))
+SERVER_TIMER_SLOTS = int(os.environ.get('SERVER_TIMER_SLOTS', 1024))
+
+class TimerWheel:
+    '''Hashed timer wheel: one timer per key (e.g. per connection), scheduled and cancelled in O(1).
+
+    The wheel has "slots" buckets of "tick" seconds each. A timer goes in the bucket its expiry falls in, modulo the
+    size of the wheel, and every tick only the current bucket is looked at. Timers further than one turn of the wheel
+    stay in their bucket until the turn they expire on. Expiries are rounded up to the next tick.
+    '''
+    # Constants
+    TICK = 0
+    SLOTS = 0
+
+    # Variables
+    buckets = []
+    timers = {}
+
+
+    def __init__(self, tick: float = SERVER_TIMER_TICK, slots: int = SERVER_TIMER_SLOTS) -> None:
+        self.TICK = tick
+        self.SLOTS = max(slots, 1)
+        self.buckets = [{} for _ in range(self.SLOTS)] # key -> expiry
+        self.timers = {}                               # key -> index of its bucket
+        self.ticks = math.floor(time.monotonic() / tick) # ticks processed so far
+
+
+    def schedule(self, key, delay: float) -> None:
+        '''(Re)start the timer of the key, to expire in "delay" seconds.'''
+        self.cancel(key)
+        expiry = time.monotonic() + delay
+        index = max(math.ceil(expiry / self.TICK), self.ticks + 1) % self.SLOTS
+        self.buckets[index][key] = expiry
+        self.timers[key] = index
+
+
+    def cancel(self, key) -> None:
+        index = self.timers.pop(key, None)
+        if index is not None:
+            del self.buckets[index][key]
+
+
+    def expire(self, now: float = None) -> list:
+        '''Advance the wheel to "now", and return the keys of the expired timers.'''
+        now = time.monotonic() if now is None else now
+        target = math.floor(now / self.TICK)
+        expired = []
+        if not self.timers:
+            self.ticks = target
+            return expired
+
+        # Past one turn, every bucket is looked at once
+        start = max(self.ticks + 1, target - self.SLOTS + 1)
+        for tick in range(start, target + 1):
+            bucket = self.buckets[tick % self.SLOTS]
+            if not bucket:
+                continue
+            for key, expiry in list(bucket.items()):
+                if expiry <= now:
+                    del bucket[key]
+                    del self.timers[key]
+                    expired.append(key)
+        self.ticks = target
+        return expired
+
+
+    def next_tick(self) -> float:
+        '''Seconds until the next tick, None if no timer is running.'''
+        if not self.timers:
+            return None
+        return max((self.ticks + 1) * self.TICK - time.monotonic(), 0)
+
+
+    def __contains__(self, key) -> bool:
+        return key in self.timers
+
+
+    def __len__(self) -> int:
+        return len(self.timers)
+
+
+    def __repr__(self) -> str:
+        return f'TimerWheel({self.TICK}, {self.SLOTS})'
+
+
+    def __str__(self) -> str:
+        return 'Hashed timer wheel'
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import uuid
+import random
+import queue
+from threading import Thread, Lock
+from utils.chalk import log
+
+# Constants
+TRACE_FILE = os.environ.get('TRACE_FILE', '')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', 10000))
+
+def start_trace(trace_id: str = None) -> str:
+    '''A new trace context, to set as the "trace" field of a request message.
+
+    The context is a compact string carried in the routing header of the frames, so the relay adds its hops
+    without decoding the payload: "{TRACE_ID} {HOP}={MILLISECONDS} {HOP}={MILLISECONDS}...".
+    Hops are wall clock times in milliseconds, as they are taken on different hosts.
+    '''
+    return trace_id or uuid.uuid4().hex
+
+
+def sampled() -> bool:
+    '''Trace the request even though the caller did not ask for it, for the export.'''
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+
+
+def add_hop(trace: str, hop: str, at: float = None) -> str:
+    '''Append a hop to the trace context, at "at" (time.time()) or now.'''
+    return f'{trace} {hop}={(time.time() if at is None else at) * 1000:.3f}'
+
+
+def parse_trace(trace: str) -> dict:
+    '''"{TRACE_ID} {HOP}={MILLISECONDS}..." -> {'id': ..., 'hops': [(hop, milliseconds)]}'''
+    trace_id, *hops = trace.split(' ')
+    parsed = []
+    for hop in hops:
+        name, _, at = hop.partition('=')
+        try:
+            parsed.append((name, float(at)))
+        except ValueError:
+            continue
+    return {'id': trace_id, 'hops': parsed}
+
+
+def breakdown(trace: str) -> dict:
+    '''Latency breakdown of a trace: the offset of every hop from the first one, and the time spent between two hops,
+    e.g. "server.request>agent.receive" for the relay to agent leg. Offsets are in milliseconds.'''
+    parsed = parse_trace(trace)
+    hops = parsed['hops']
+    start = hops[0][1] if hops else 0
+    return {
+        'id': parsed['id'],
+        'start': start,
+        'total': round(hops[-1][1] - start, 3) if hops else 0,
+        'hops': [[name, round(at - start, 3)] for name, at in hops],
+        'spans': [
+            {'name': f'{previous[0]}>{hop[0]}', 'offset': round(previous[1] - start, 3), 'duration': round(hop[1] - previous[1], 3)}
+            for previous, hop in zip(hops, hops[1:])
+        ]
+    }
+
+
+class TraceExporter:
+    '''Writes the finished traces to a local file, one JSON line each, with the attributes of the request
+    (agent, action...) to build latency breakdowns per agent and per action.
+
+    Traces are queued and written by a background thread, so requests never wait for the disk. When the queue is full,
+    traces are dropped and counted.
+    '''
+    # Constants
+    PATH = ''
+
+    # Variables
+    queue = None
+    dropped = 0
+
+
+    def __init__(self, path: str = TRACE_FILE, queue_size: int = TRACE_QUEUE_SIZE) -> None:
+        self.PATH = path
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.writer = None
+        self.lock = Lock()
+
+
+    def export(self, trace: str, **attributes) -> None:
+        if not self.PATH:
+            return
+        if self.writer is None:
+            with self.lock:
+                if self.writer is None:
+                    self.writer = Thread(target=self._write, daemon=True)
+                    self.writer.start()
+        try:
+            self.queue.put_nowait((trace, attributes))
+        except queue.Full:
+            self.dropped += 1
+
+
+    def _write(self) -> None:
+        while True:
+            trace, attributes = self.queue.get()
+            try:
+                lines = [json.dumps({**breakdown(trace), **attributes})]
+                # Write whatever else is waiting at once
+                while len(lines) < 512:
+                    try:
+                        trace, attributes = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    lines.append(json.dumps({**breakdown(trace), **attributes}))
+
+                with open(self.PATH, 'a') as file:
+                    file.write('\n'.join(lines) + '\n')
+
+            except Exception as ex:
+                log(f'General error [4493] [{os.path.basename(__file__)}]: {str(ex)}', 'danger')
+
+
+    def __len__(self) -> int:
+        return self.queue.qsize()
+
+
+    def __repr__(self) -> str:
+        return f'TraceExporter("{self.PATH}")'
+
+
+    def __str__(self) -> str:
+        return 'Export of the request traces to a local file'
+
+
+# The exporter of the process
+exporter = TraceExporter()
@@ -0,0 +1,97 @@
+import os
+import ssl
+
+# Constants
+SOCKET_HIGH_WATERMARK = int(os.environ.get('SOCKET_HIGH_WATERMARK', 4 * 1024 * 1024))
+SOCKET_LOW_WATERMARK = int(os.environ.get('SOCKET_LOW_WATERMARK', 1024 * 1024))
+COMPACT_SIZE = 65536
+
+class WriteBuffer:
+    '''Outbound bytes of a non-blocking socket.
+
+    "send()" writes as much as the socket accepts and keeps the rest, "flush()" writes more of it once
+    the socket is writable again. Partial writes and SSLWantWriteError never lose data.
+    The watermarks tell the owner when to stop accepting data (above "high") and when to resume (below "low").
+    '''
+    # Constants
+    HIGH_WATERMARK = 0
+    LOW_WATERMARK = 0
+
+
+    def __init__(self, high_watermark: int = SOCKET_HIGH_WATERMARK, low_watermark: int = SOCKET_LOW_WATERMARK) -> None:
+        self.HIGH_WATERMARK = high_watermark
+        self.LOW_WATERMARK = min(low_watermark, high_watermark)
+        self.buffer = bytearray()
+        self.offset = 0 # first byte not yet written
+
+
+    def append(self, data) -> None:
+        self.buffer += data
+
+
+    def send(self, client_socket, data) -> int:
+        '''Write the data, straight from the caller's buffer when nothing is queued before it. Returns the bytes written.'''
+        sent = 0
+        if not self:
+            with memoryview(data) as view:
+                sent = self._write(client_socket, view)
+                if sent < len(view):
+                    self.buffer += view[sent:]
+            return sent
+
+        self.buffer += data
+        return self.flush(client_socket)
+
+
+    def flush(self, client_socket) -> int:
+        '''Write the queued bytes until the socket would block. Returns the bytes written.'''
+        if not self:
+            return 0
+
+        with memoryview(self.buffer) as view, view[self.offset:] as pending:
+            sent = self._write(client_socket, pending)
+        self.offset += sent
+
+        if self.offset == len(self.buffer):
+            self.buffer.clear()
+            self.offset = 0
+        elif self.offset >= COMPACT_SIZE and self.offset * 2 >= len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
+        return sent
+
+
+    def _write(self, client_socket, view: memoryview) -> int:
+        sent = 0
+        try:
+            while sent < len(view):
+                sent += client_socket.send(view[sent:])
+
+        except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+            pass
+        return sent
+
+
+    def clear(self) -> None:
+        self.buffer.clear()
+        self.offset = 0
+
+
+    def above_high_watermark(self) -> bool:
+        return len(self) >= self.HIGH_WATERMARK
+
+
+    def below_low_watermark(self) -> bool:
+        return len(self) <= self.LOW_WATERMARK
+
+
+    def __len__(self) -> int:
+        return len(self.buffer) - self.offset
+
+
+    def __repr__(self) -> str:
+        return f'WriteBuffer({self.HIGH_WATERMARK}, {self.LOW_WATERMARK})'
+
+
+    def __str__(self) -> str:
+        return 'Outbound buffer of a non-blocking socket'